@@ -0,0 +1,240 @@
+"""
+Measure `treehugger exec` and `treehugger print` end to end against local
+stand-ins for the EC2 metadata service, S3 and KMS, across numbers of
+variables, numbers of includes and service latencies.
+
+Run with:
+
+    python -m benchmarks.bench_cli [--vars 10,100,1000] [--includes 0,1,5] [--latency-ms 5,50,200]
+                                   [--error-rate 0.01] [--kms-rate 100] [--output results.json]
+
+from the root of the repository. Each run is a fresh Python process running
+the treehugger CLI on the variables in the fake EC2 user data, with every
+variable encrypted and spread evenly between the user data and its S3
+includes. The wall time of each run is measured from process start to exit,
+so it includes interpreter start up, imports, and finding the region and
+credentials. It is printed as a table with the KMS calls made and peak
+memory, and with --output written as JSON, with the requests seen by each
+service, for tracking regressions between versions.
+
+Extra global arguments can be passed to treehugger with --treehugger-args,
+for example --treehugger-args='--workers 32'. For exec the command itself is
+not executed, so only treehugger's own work is measured.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from .fake_aws import FakeAWS, fake_ciphertext
+
+BUCKET = 'treehugger-benchmark'
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_documents(num_vars, num_includes):
+    """
+    Return the user data YAML and a dict of S3 objects it includes, with
+    `num_vars` encrypted variables spread between them.
+    """
+    include_keys = ['include-{}.yml'.format(i) for i in range(num_includes)]
+    documents = [{} for _ in range(num_includes + 1)]
+    for i in range(num_vars):
+        key = 'BENCHMARK_VAR_{}'.format(i)
+        documents[i % len(documents)][key] = {'encrypted': fake_ciphertext('value-{}'.format(i))}
+
+    main_document = documents[0]
+    main_document['TREEHUGGER_APP'] = 'benchmark'
+    main_document['TREEHUGGER_STAGE'] = 'prod'
+    if include_keys:
+        main_document['include'] = ['s3://{}/{}?versionId=1'.format(BUCKET, key) for key in include_keys]
+    user_data = yaml.safe_dump({'treehugger': main_document}, default_flow_style=False)
+    objects = {
+        '{}/{}'.format(BUCKET, key): yaml.safe_dump(document, default_flow_style=False)
+        for key, document in zip(include_keys, documents[1:])
+    }
+    return user_data, objects
+
+
+def run_once(fake, command, treehugger_args, timeout):
+    """
+    Run one child process against `fake`, returning its result dict. The
+    wall time is measured here, from before the child starts until it exits.
+    """
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if not key.startswith(('AWS_', 'TREEHUGGER_'))
+    }
+    fake.reset_counts()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The region comes from the fake metadata service, and no AWS config
+        # files are read
+        env.update({
+            'AWS_ACCESS_KEY_ID': 'fakekey',
+            'AWS_SECRET_ACCESS_KEY': 'fakesecret',
+            'AWS_CONFIG_FILE': os.path.join(temp_dir, 'aws_config'),
+            'AWS_SHARED_CREDENTIALS_FILE': os.path.join(temp_dir, 'aws_credentials'),
+            'AWS_EC2_METADATA_DISABLED': 'true',
+            # A fresh state directory so nothing is cached between runs
+            'TREEHUGGER_STATE_DIR': os.path.join(temp_dir, 'state'),
+        })
+        os.mkdir(env['TREEHUGGER_STATE_DIR'], 0o700)
+        spec = {
+            'url': fake.url,
+            'argv': treehugger_args + [command] + (['--', 'true'] if command == 'exec' else []),
+            'result_path': os.path.join(temp_dir, 'result.json'),
+        }
+        start = time.monotonic()
+        proc = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.cli_child', json.dumps(spec)],
+            cwd=ROOT_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=timeout,
+        )
+        wall_seconds = time.monotonic() - start
+        try:
+            with open(spec['result_path']) as fp:
+                result = json.load(fp)
+        except (OSError, ValueError):
+            result = {}
+    result['exit_code'] = proc.returncode
+    result['wall_seconds'] = wall_seconds
+    if proc.returncode:
+        stderr_lines = proc.stderr.decode('utf-8', 'replace').strip().splitlines()
+        result['error'] = stderr_lines[-1] if stderr_lines else 'exited with {}'.format(proc.returncode)
+    result['service_requests'] = fake.counts
+    return result
+
+
+def summarize(runs):
+    ok = [run for run in runs if not run.get('exit_code')]
+    if not ok:
+        return {'failures': len(runs)}
+    wall_times = [run['wall_seconds'] for run in ok]
+    return {
+        'failures': len(runs) - len(ok),
+        'wall_seconds_min': min(wall_times),
+        'wall_seconds_median': statistics.median(wall_times),
+        'kms_calls_median': statistics.median(run['kms_calls'] for run in ok),
+        'peak_rss_kib_max': max(run['peak_rss_kib'] for run in ok),
+    }
+
+
+def parse_list(value, type_):
+    return [type_(item) for item in value.split(',') if item.strip()]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--command', choices=('print', 'exec'), default='print')
+    arg_parser.add_argument('--vars', type=str, default='10,100,1000',
+                            help='Comma separated numbers of encrypted variables')
+    arg_parser.add_argument('--includes', type=str, default='0,1,5',
+                            help='Comma separated numbers of S3 includes')
+    arg_parser.add_argument('--latency-ms', type=str, default='5,50,200',
+                            help='Comma separated latencies added to every service call, in milliseconds')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of service calls that fail with a 500')
+    arg_parser.add_argument('--kms-rate', type=float, default=0.0,
+                            help='KMS calls per second allowed before throttling, 0 for no limit')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--timeout', type=float, default=600.0,
+                            help='Seconds to wait for each run')
+    arg_parser.add_argument('--seed', type=int, default=None,
+                            help='Seed for the injected errors')
+    arg_parser.add_argument('--treehugger-args', type=str, default='',
+                            help='Global arguments to pass to treehugger')
+    arg_parser.add_argument('--output', type=str, default=None,
+                            help='Write the results to this file as JSON')
+    args = arg_parser.parse_args()
+
+    treehugger_args = shlex.split(args.treehugger_args)
+    fake = FakeAWS(error_rate=args.error_rate, kms_rate=args.kms_rate, seed=args.seed)
+    fake.start()
+
+    scenarios = []
+    print('{:>6} {:>9} {:>8}  {:>10} {:>10} {:>10} {:>12} {:>9}'.format(
+        'vars', 'includes', 'latency', 'min s', 'median s', 'KMS calls', 'peak RSS KiB', 'failures',
+    ))
+    try:
+        for num_vars, num_includes, latency_ms in itertools.product(
+            parse_list(args.vars, int),
+            parse_list(args.includes, int),
+            parse_list(args.latency_ms, float),
+        ):
+            fake.user_data, fake.objects = make_documents(num_vars, num_includes)
+            fake.latency = latency_ms / 1000
+            runs = [run_once(fake, args.command, treehugger_args, args.timeout) for _ in range(args.repeat)]
+            summary = summarize(runs)
+            scenarios.append({
+                'vars': num_vars,
+                'includes': num_includes,
+                'latency_ms': latency_ms,
+                'summary': summary,
+                'runs': runs,
+            })
+            print('{:>6} {:>9} {:>6.0f}ms  {:>10} {:>10} {:>10} {:>12} {:>9}'.format(
+                num_vars,
+                num_includes,
+                latency_ms,
+                _format(summary.get('wall_seconds_min'), '{:.3f}'),
+                _format(summary.get('wall_seconds_median'), '{:.3f}'),
+                _format(summary.get('kms_calls_median'), '{:.0f}'),
+                _format(summary.get('peak_rss_kib_max'), '{}'),
+                summary['failures'],
+            ))
+            for run in runs:
+                if 'error' in run:
+                    print('    failed: {}'.format(run['error']))
+    finally:
+        fake.stop()
+
+    if args.output:
+        results = {
+            'benchmark': 'bench_cli',
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'git_revision': _git_revision(),
+            'parameters': {
+                'command': args.command,
+                'error_rate': args.error_rate,
+                'kms_rate': args.kms_rate,
+                'repeat': args.repeat,
+                'treehugger_args': treehugger_args,
+            },
+            'scenarios': scenarios,
+        }
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+
+
+def _format(value, format_string):
+    if value is None:
+        return '-'
+    return format_string.format(value)
+
+
+def _git_revision():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare the speed of the YAML and JSON backends treehugger can use to load
+and dump its data, across file sizes.
+
+Run with:
+
+    python -m benchmarks.bench_yaml [--repeat N] [--sizes 10,100,1000,10000]
+
+from the root of the repository.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import timeit
+
+import yaml
+
+from treehugger.yaml import safe_load, save_fp
+
+
+def make_data(num_vars):
+    data = {
+        'TREEHUGGER_APP': 'benchmark',
+        'TREEHUGGER_STAGE': 'prod',
+    }
+    for i in range(num_vars):
+        if i % 2:
+            ciphertext = base64.b64encode(os.urandom(180)).decode('utf-8')
+            data['ENCRYPTED_VAR_{}'.format(i)] = {'encrypted': ciphertext}
+        else:
+            data['PLAIN_VAR_{}'.format(i)] = 'value-{}'.format(i)
+    return data
+
+
+def dump_with(dumper):
+    def dump(data):
+        fp = io.StringIO()
+        yaml.dump(data, fp, Dumper=dumper, allow_unicode=True, width=10000)
+        return fp.getvalue()
+    return dump
+
+
+def treehugger_dump(data):
+    fp = io.StringIO()
+    save_fp(fp, data)
+    return fp.getvalue()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--sizes', type=str, default='10,100,1000,10000')
+    args = arg_parser.parse_args()
+
+    loaders = [('yaml.SafeLoader', lambda text: yaml.load(text, Loader=yaml.SafeLoader))]
+    dumpers = [('yaml.SafeDumper', dump_with(yaml.SafeDumper))]
+    if hasattr(yaml, 'CSafeLoader'):
+        loaders.append(('yaml.CSafeLoader', lambda text: yaml.load(text, Loader=yaml.CSafeLoader)))
+        dumpers.append(('yaml.CSafeDumper', dump_with(yaml.CSafeDumper)))
+    else:
+        print('libyaml is not available, only the pure Python backend will be measured\n')
+    loaders.append(('json.loads', json.loads))
+    loaders.append(('treehugger (YAML)', safe_load))
+    loaders.append(('treehugger (JSON)', safe_load))
+    dumpers.append(('treehugger', treehugger_dump))
+
+    print('{:>8}  {:<20} {:>12} {:>12}'.format('vars', 'backend', 'load ms', 'dump ms'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        data = make_data(size)
+        yaml_text = treehugger_dump(data)
+        json_text = json.dumps(data)
+        for name, load in loaders:
+            text = json_text if 'JSON' in name or name.startswith('json') else yaml_text
+            assert load(text) == data
+            seconds = min(timeit.repeat(lambda: load(text), number=1, repeat=args.repeat))
+            print('{:>8}  {:<20} {:>12.2f} {:>12}'.format(size, name, seconds * 1000, ''))
+        for name, dump in dumpers:
+            assert dump(data) == yaml_text
+            seconds = min(timeit.repeat(lambda: dump(data), number=1, repeat=args.repeat))
+            print('{:>8}  {:<20} {:>12} {:>12.2f}'.format(size, name, '', seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+The process bench_cli times for each run. It imports only what treehugger
+itself would, so interpreter start up, imports and session and credential
+resolution are all measured. Treehugger builds its own session as usual,
+and only the EC2 metadata URLs and the endpoint of each AWS client, which
+treehugger doesn't let be configured, are pointed at the fake services here.
+KMS calls made and peak memory are written as JSON to the file named in the
+spec, since stdout belongs to treehugger.
+"""
+import json
+import os
+import resource
+import sys
+
+
+def main(spec):
+    from treehugger import aws, ec2
+
+    url = spec['url']
+    ec2.TOKEN_URL = url + '/latest/api/token'
+    ec2.USER_DATA_URL = url + '/latest/user-data'
+    ec2.IDENTITY_URL = url + '/latest/dynamic/instance-identity/document'
+    get_session = aws.get_session
+    aws.get_session = lambda *args, **kwargs: _LocalSession(get_session(*args, **kwargs), url)
+    # Do everything up to replacing the process
+    os.execlp = lambda *args: None
+
+    from treehugger.cli import main as cli_main
+    from treehugger.kms import kms_agent
+
+    try:
+        cli_main(spec['argv'])
+    finally:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak_rss //= 1024  # bytes rather than KiB
+        with open(spec['result_path'], 'w') as fp:
+            json.dump({'kms_calls': kms_agent.calls, 'peak_rss_kib': peak_rss}, fp)
+
+
+class _LocalSession(object):
+    """
+    Wraps treehugger's boto3 session so its clients use the fake endpoint.
+    Setting endpoint_url explicitly, rather than with AWS_ENDPOINT_URL, works
+    with botocore before 1.31 too.
+    """
+
+    def __init__(self, session, endpoint_url):
+        self._session = session
+        self._endpoint_url = endpoint_url
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def client(self, service_name, config=None):
+        from botocore.config import Config
+
+        if service_name == 's3':
+            path_style = Config(s3={'addressing_style': 'path'})
+            config = config.merge(path_style) if config is not None else path_style
+        return self._session.client(service_name, endpoint_url=self._endpoint_url, config=config)
+
+
+if __name__ == '__main__':
+    main(json.loads(sys.argv[1]))
@@ -0,0 +1,191 @@
+"""
+A local stand-in for the EC2 instance metadata service, S3 and KMS, serving
+just the calls treehugger makes, with configurable latency, errors and
+throttling. One HTTP server answers for all three:
+
+* Paths under /latest/ are IMDS, serving `user_data` with IMDSv2 tokens.
+* Requests with an X-Amz-Target header are KMS. Decrypt returns the
+  ciphertext as the plaintext, so test data can use any bytes.
+* Anything else is a path style S3 GetObject from `objects`.
+"""
+import base64
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+REGION = 'eu-west-1'
+
+
+class FakeAWS(object):
+    """
+    Runs the server on a random local port in a background thread. `latency`
+    is added to every response, in seconds, `error_rate` is the chance of any
+    call returning a 500, and `kms_rate` limits KMS to that many calls per
+    second, beyond which they're throttled, with 0 meaning no limit.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, kms_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.kms_rate = kms_rate
+        self.user_data = ''
+        self.objects = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._kms_allowance = 0.0
+        self._kms_last = time.monotonic()
+        self.reset_counts()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {
+                service: {'requests': 0, 'errors': 0, 'throttled': 0}
+                for service in ('imds', 's3', 'kms')
+            }
+
+    def _count(self, service, outcome='requests'):
+        with self._lock:
+            self.counts[service][outcome] += 1
+
+    def _inject_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _kms_throttled(self):
+        if not self.kms_rate:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._kms_allowance = min(self.kms_rate, self._kms_allowance + (now - self._kms_last) * self.kms_rate)
+            self._kms_last = now
+            if self._kms_allowance < 1:
+                return True
+            self._kms_allowance -= 1
+            return False
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive like the real services, so connection pooling
+    # is measured too
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.startswith('/latest/'):
+            service = 'imds'
+        elif 'X-Amz-Target' in self.headers:
+            service = 'kms'
+        else:
+            service = 's3'
+        self.fake._count(service)
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+        if self.fake._inject_error():
+            self.fake._count(service, 'errors')
+            self._error(service, 500, 'InternalError', 'Injected error')
+        elif service == 'kms' and self.fake._kms_throttled():
+            self.fake._count(service, 'throttled')
+            self._error(service, 400, 'ThrottlingException', 'Rate exceeded')
+        else:
+            getattr(self, '_handle_' + service)(body)
+
+    def _handle_imds(self, body):
+        if self.path == '/latest/api/token':
+            self._respond(200, b'fake-imds-token')
+        elif self.headers.get('X-aws-ec2-metadata-token') != 'fake-imds-token':
+            self._respond(401, b'')
+        elif self.path == '/latest/user-data':
+            self._respond(200, self.fake.user_data.encode('utf-8'))
+        elif self.path == '/latest/dynamic/instance-identity/document':
+            self._respond(200, json.dumps({'region': REGION}).encode('utf-8'))
+        else:
+            self._respond(404, b'')
+
+    def _handle_s3(self, body):
+        path = self.path.split('?', 1)[0]
+        try:
+            content = self.fake.objects[path.lstrip('/')]
+        except KeyError:
+            self._error('s3', 404, 'NoSuchKey', 'The specified key does not exist.')
+        else:
+            self._respond(200, content.encode('utf-8'), content_type='application/x-yaml')
+
+    def _handle_kms(self, body):
+        operation = self.headers['X-Amz-Target'].split('.')[-1]
+        if operation != 'Decrypt':
+            self._error('kms', 400, 'UnsupportedOperationException', '{} is not faked'.format(operation))
+            return
+        request = json.loads(body.decode('utf-8'))
+        response = {
+            'KeyId': 'arn:aws:kms:{}:123456789012:key/fake'.format(REGION),
+            'Plaintext': request['CiphertextBlob'],
+        }
+        self._respond(200, json.dumps(response).encode('utf-8'), content_type='application/x-amz-json-1.1')
+
+    def _error(self, service, status, code, message):
+        if service == 'kms':
+            body = json.dumps({'__type': code, 'message': message}).encode('utf-8')
+            self._respond(status, body, content_type='application/x-amz-json-1.1')
+        elif service == 's3':
+            body = (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Error><Code>{}</Code><Message>{}</Message></Error>'
+            ).format(code, message).encode('utf-8')
+            self._respond(status, body, content_type='application/xml')
+        else:
+            self._respond(status, message.encode('utf-8'))
+
+    def _respond(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def fake_ciphertext(plaintext):
+    """
+    The base64 ciphertext that the fake KMS decrypts to `plaintext`.
+    """
+    return base64.b64encode(plaintext.encode('utf-8')).decode('utf-8')
@@ -25,13 +25,18 @@ setup(
     author_email='sysadmin@timeout.com',
     url='https://github.com/timeoutdigital/treehugger',
     download_url = 'https://github.com/timeoutdigital/treehugger/archive/3.0.0.tar.gz',
-    packages=find_packages(exclude=['tests', 'tests.*']),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
     include_package_data=True,
     install_requires=[
-        'boto3',
+        # Standard retries and total_max_attempts need botocore 1.15
+        'boto3>=1.12',
+        'botocore>=1.15',
         'PyYAML',
         'requests',
     ],
+    extras_require={
+        'envelope': ['cryptography'],
+    },
     python_requires='>=3.4',
     license='ISC License',
     zip_safe=False,
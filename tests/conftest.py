@@ -1,20 +1,45 @@
 import pytest
 from botocore.stub import Stubber
 
+from treehugger import ec2, s3
 from treehugger.kms import kms_agent
-from treehugger.s3 import s3_client
+from treehugger.s3 import get_s3_client
 
 
 @pytest.fixture(scope='function', autouse=True)
-def kms_stub():
+def kms_stub(monkeypatch):
     kms_agent.reset()
+    # Undo configuration from earlier main() calls
+    monkeypatch.setattr(kms_agent, 'persistent_cache', None)
+    monkeypatch.setattr(kms_agent, 'rate_limiter', None)
+    monkeypatch.setattr(kms_agent, 'regions', ())
+    monkeypatch.setattr(kms_agent, 'hedger', None)
     with Stubber(kms_agent.kms_client) as stubber:
         yield stubber
         stubber.assert_no_pending_responses()
 
 
 @pytest.fixture(scope='function', autouse=True)
-def s3_stub():
-    with Stubber(s3_client) as stubber:
+def s3_stub(monkeypatch):
+    monkeypatch.setattr(s3, 'object_cache', None)
+    with Stubber(get_s3_client()) as stubber:
         yield stubber
         stubber.assert_no_pending_responses()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def state_dir(tmpdir, monkeypatch):
+    path = tmpdir.join('state')
+    monkeypatch.setenv('TREEHUGGER_STATE_DIR', str(path))
+    return path
+
+
+@pytest.fixture(scope='function', autouse=True)
+def imds(requests_mock):
+    """
+    Reset the cached EC2 metadata, and answer IMDSv2 token requests.
+    """
+    ec2.reset()
+    requests_mock.put(ec2.TOKEN_URL, text='imds-token')
+    yield requests_mock
+    ec2.reset()
@@ -0,0 +1,176 @@
+import base64
+import os
+import stat
+import textwrap
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from treehugger import agent
+from treehugger.agent import Agent, fetch_environment, make_server, parse_request
+from treehugger.cli import main
+from treehugger.data import KeyFilter
+
+
+@pytest.fixture
+def server(state_dir):
+    server = make_server(ttl=60)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def env_file(tmpdir):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(base64.b64encode(b'foo').decode('utf-8'))))
+    return tmpfile
+
+
+def add_decrypt_response(kms_stub):
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'foo',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'MY_ENCRYPTED_VAR',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+
+
+def test_fetch_environment(server, env_file, kms_stub):
+    add_decrypt_response(kms_stub)
+
+    environment = fetch_environment(filename=str(env_file))
+    env_file.remove()
+    # Served from the agent without loading again
+    assert fetch_environment(filename=str(env_file)) == environment
+
+    assert environment == {
+        'MY_ENCRYPTED_VAR': 'quux',
+        'MY_UNENCRYPTED_VAR': 'bar',
+        'TREEHUGGER_APP': 'baz',
+        'TREEHUGGER_STAGE': 'qux',
+    }
+    mode = os.stat(server.server_address).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+
+
+def test_fetch_environment_key_filter(server, env_file, kms_stub):
+    add_decrypt_response(kms_stub)
+    fetch_environment(filename=str(env_file))
+
+    assert fetch_environment(filename=str(env_file), key_filter=KeyFilter(excludes=['MY_*'])) == {
+        'MY_UNENCRYPTED_VAR': 'bar',
+        'TREEHUGGER_APP': 'baz',
+        'TREEHUGGER_STAGE': 'qux',
+    }
+
+
+def test_fetch_environment_no_agent(state_dir, env_file):
+    assert fetch_environment(filename=str(env_file)) is None
+
+
+def test_fetch_environment_load_fails(server, tmpdir, capsys):
+    assert fetch_environment(filename=str(tmpdir.join('missing.yml'))) is None
+
+    out, err = capsys.readouterr()
+    assert 'File does not exist: ' in err
+
+
+def test_fetch_environment_other_user(server, env_file, monkeypatch):
+    monkeypatch.setattr(agent, 'socket_path', server.server_address)
+    with mock.patch.object(agent.os, 'getuid', return_value=os.getuid() + 1):
+        assert fetch_environment(filename=str(env_file)) is None
+
+
+def test_agent_coalesces_and_expires():
+    calls = []
+
+    def load(data_url, filename, ignore_missing):
+        calls.append(filename)
+        time.sleep(0.05)
+        return {'A': str(len(calls)), 'TREEHUGGER_APP': 'baz', 'TREEHUGGER_STAGE': 'qux'}
+
+    instance = Agent(ttl=60)
+    with mock.patch.object(agent, 'load_data_or_die', new=load):
+        threads = [
+            threading.Thread(target=instance.get_environment, args=(None, '/test.yml', False))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert calls == ['/test.yml']
+
+        for entry in instance._entries.values():
+            entry.expires = 0.0
+        environment, encrypted_keys = instance.get_environment(None, '/test.yml', False)
+        assert environment['A'] == '2'
+        assert encrypted_keys == []
+
+
+def test_parse_request():
+    assert parse_request(b'{"filename": "/test.yml"}\n') == (None, '/test.yml', False)
+    with pytest.raises(ValueError):
+        parse_request(b'[]\n')
+    with pytest.raises(ValueError):
+        parse_request(b'{"filename": 1}\n')
+    with pytest.raises(ValueError):
+        parse_request(b'{"ignore_missing": "yes"}\n')
+
+
+def test_make_server_already_running(server, capsys):
+    with pytest.raises(SystemExit):
+        make_server(ttl=60)
+
+    out, err = capsys.readouterr()
+    assert 'An agent is already listening on {}'.format(server.server_address) in err
+
+
+def test_make_server_stale_socket(state_dir):
+    server = make_server(ttl=60)
+    server.server_close()  # leaves the socket file behind, like a killed agent
+
+    server = make_server(ttl=60)
+    server.server_close()
+
+
+def test_print_agent(server, env_file, kms_stub, capsys):
+    add_decrypt_response(kms_stub)
+    fetch_environment(filename=str(env_file))
+    env_file.remove()
+
+    main(['print', '--agent', '-f', str(env_file)])
+
+    out, err = capsys.readouterr()
+    assert 'MY_ENCRYPTED_VAR=quux\n' in out
+
+
+def test_print_agent_fallback(state_dir, env_file, kms_stub, capsys):
+    add_decrypt_response(kms_stub)
+
+    main(['-v', 'print', '--agent', '-f', str(env_file)])
+
+    out, err = capsys.readouterr()
+    assert 'MY_ENCRYPTED_VAR=quux\n' in out
+    assert 'Could not use the agent' in err
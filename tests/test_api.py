@@ -0,0 +1,96 @@
+import io
+import os
+import textwrap
+
+import pytest
+
+import treehugger
+from treehugger import api, s3
+from treehugger.kms import kms_agent
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    api.clear_cache()
+    yield
+    api.clear_cache()
+
+
+@pytest.fixture
+def env_file(tmpdir):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    return tmpfile
+
+
+def test_load_environment_memoized(env_file):
+    environment = treehugger.load_environment(str(env_file))
+    env_file.remove()
+
+    assert environment == {'MY_UNENCRYPTED_VAR': 'bar', 'TREEHUGGER_APP': 'baz', 'TREEHUGGER_STAGE': 'qux'}
+    environment['MY_UNENCRYPTED_VAR'] = 'changed'
+    assert treehugger.load_environment(str(env_file))['MY_UNENCRYPTED_VAR'] == 'bar'
+
+
+def test_load_environment_ttl(env_file):
+    treehugger.load_environment(str(env_file), ttl=0)
+    env_file.remove()
+
+    with pytest.raises(treehugger.LoadError) as excinfo:
+        treehugger.load_environment(str(env_file), ttl=0)
+
+    assert str(excinfo.value) == 'File does not exist: {}'.format(env_file)
+
+
+def test_load_environment_treehugger_data(s3_stub, monkeypatch):
+    monkeypatch.setenv('TREEHUGGER_DATA', 's3://bucket/key.yml?versionId=1')
+    s3_stub.add_response(
+        'get_object',
+        expected_params={'Bucket': 'bucket', 'Key': 'key.yml', 'VersionId': '1'},
+        service_response={'Body': io.BytesIO(b'A: b\nTREEHUGGER_APP: baz\nTREEHUGGER_STAGE: qux\n')},
+    )
+
+    assert treehugger.load_environment()['A'] == 'b'
+
+
+def test_load_environment_inherited_by_fork(env_file):
+    treehugger.load_environment(str(env_file))
+    kms_agent.kms_client
+    s3.get_s3_client()
+    env_file.remove()
+
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            ok = (
+                treehugger.load_environment(str(env_file))['MY_UNENCRYPTED_VAR'] == 'bar'
+                and kms_agent._kms_client is None
+                and s3._s3_client is None
+            )
+        finally:
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_load_environment_lazy(tmpdir, kms_stub):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: Zm9v
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+
+    environment = treehugger.load_environment(str(tmpfile), lazy=True)
+
+    assert environment['MY_UNENCRYPTED_VAR'] == 'bar'
+    assert 'MY_ENCRYPTED_VAR' in environment
+    assert treehugger.load_environment(str(tmpfile), lazy=True) is environment
@@ -0,0 +1,58 @@
+import pytest
+import requests
+
+from treehugger import aws
+from treehugger.ec2 import IDENTITY_URL, TOKEN_URL
+
+
+@pytest.fixture
+def fresh_session():
+    aws.reset()
+    yield
+    aws.reset()
+
+
+def test_session_shared(fresh_session):
+    assert aws.get_session() is aws.get_session()
+
+
+def test_create_client_config(fresh_session, monkeypatch):
+    monkeypatch.setattr(aws, 'connect_timeout', 1.5)
+    monkeypatch.setattr(aws, 'read_timeout', 2.5)
+    monkeypatch.setattr(aws, 'retry_mode', 'adaptive')
+    monkeypatch.setattr(aws, 'max_attempts', 4)
+
+    client = aws.create_client('kms', max_pool_connections=20)
+
+    config = client.meta.config
+    assert config.connect_timeout == 1.5
+    assert config.read_timeout == 2.5
+    assert config.max_pool_connections == 20
+    assert config.retries == {'mode': 'adaptive', 'total_max_attempts': 4}
+    assert client.meta.region_name == 'eu-west-1'
+
+
+def test_region_from_ec2_once(fresh_session, monkeypatch, tmpdir, requests_mock):
+    monkeypatch.delenv('AWS_DEFAULT_REGION')
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmpdir.join('missing')))
+    requests_mock.get(IDENTITY_URL, json={'region': 'us-east-2'})
+
+    kms_client = aws.create_client('kms')
+    s3_client = aws.create_client('s3')
+
+    assert kms_client.meta.region_name == 'us-east-2'
+    assert s3_client.meta.region_name == 'us-east-2'
+    assert [r.url for r in requests_mock.request_history if r.method == 'GET'] == [IDENTITY_URL]
+
+
+def test_s3_without_region(fresh_session, monkeypatch, tmpdir, requests_mock):
+    monkeypatch.delenv('AWS_DEFAULT_REGION')
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmpdir.join('missing')))
+    requests_mock.put(TOKEN_URL, exc=requests.exceptions.ConnectTimeout)
+
+    s3_client = aws.create_client('s3', require_region=False)
+
+    assert s3_client.meta.region_name in (None, 'aws-global', 'us-east-1')
+    # KMS still needs a region
+    with pytest.raises(SystemExit):
+        aws.create_client('kms')
@@ -0,0 +1,189 @@
+import os
+import stat
+import subprocess
+from unittest import mock
+
+import pytest
+
+from treehugger.cache import FileCache, KeyringCache, ObjectCache, make_key
+
+
+def test_make_key():
+    key = make_key('abc', {'foo': 'bar', 'baz': 'qux'})
+    assert key == make_key('abc', {'baz': 'qux', 'foo': 'bar'})
+    assert key != make_key('abc', {'foo': 'bar', 'baz': 'quux'})
+    assert key != make_key('abd', {'foo': 'bar', 'baz': 'qux'})
+
+
+def test_file_cache_get_set(state_dir):
+    cache = FileCache(ttl=60, max_entries=10)
+    assert cache.get('foo') is None
+
+    cache.set('foo', 'bar')
+
+    assert cache.get('foo') == 'bar'
+    assert (cache.hits, cache.misses) == (1, 1)
+    mode = os.stat(os.path.join(cache.directory, 'foo')).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+    assert stat.S_IMODE(os.stat(str(state_dir)).st_mode) == 0o700
+
+
+def test_file_cache_expires():
+    cache = FileCache(ttl=60, max_entries=10)
+    with mock.patch('time.time', return_value=1000.0):
+        cache.set('foo', 'bar')
+    with mock.patch('time.time', return_value=1061.0):
+        assert cache.get('foo') is None
+    assert not os.path.exists(os.path.join(cache.directory, 'foo'))
+
+
+def test_file_cache_max_entries():
+    cache = FileCache(ttl=60, max_entries=2)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.set(key, 'value')
+        os.utime(os.path.join(cache.directory, key), (i, i))
+
+    assert sorted(os.listdir(cache.directory)) == ['b', 'c']
+
+
+def test_file_cache_clear():
+    cache = FileCache(ttl=60, max_entries=10)
+    cache.set('foo', 'bar')
+    cache.set('baz', 'qux')
+
+    assert cache.clear() == 2
+    assert cache.get('foo') is None
+
+
+def test_file_cache_insecure_directory(tmpdir, capsys):
+    directory = tmpdir.mkdir('insecure')
+    directory.chmod(0o755)
+
+    with mock.patch.dict(os.environ, {'TREEHUGGER_STATE_DIR': str(directory)}), pytest.raises(SystemExit):
+        FileCache(ttl=60, max_entries=10)
+
+    out, err = capsys.readouterr()
+    assert 'must be a directory accessible only by the current user' in err
+
+
+class FakeKeyctl(object):
+
+    def __init__(self):
+        # Key ID -> (type, description, payload, ID of the keyring it's in)
+        self.keys = {}
+        self.calls = []
+
+    def add(self, key_type, description, payload, keyring_id):
+        key_id = str(len(self.keys) + 100)
+        self.keys[key_id] = (key_type, description, payload, keyring_id)
+        return key_id
+
+    def __call__(self, args, input=None, **kwargs):
+        command = args[1]
+        self.calls.append(command)
+        if command == 'search':
+            for key_id, (key_type, description, _, keyring_id) in self.keys.items():
+                if (key_type, description, keyring_id) == (args[3], args[4], args[2]):
+                    return key_id + '\n'
+            raise subprocess.CalledProcessError(1, args)
+        elif command == 'newring':
+            return self.add('keyring', args[2], None, args[3]) + '\n'
+        elif command == 'padd':
+            return self.add(args[2], args[3], input, args[4]) + '\n'
+        elif command == 'pipe':
+            if args[2] not in self.keys:
+                raise subprocess.CalledProcessError(1, args)
+            return self.keys[args[2]][2]
+        elif command == 'rlist':
+            return ' '.join(key_id for key_id, key in self.keys.items() if key[3] == args[2]) + '\n'
+        elif command == 'rdescribe':
+            key_type, description = self.keys[args[2]][:2]
+            return '{};0;0;3f010000;{}\n'.format(key_type, description)
+        elif command == 'unlink':
+            del self.keys[args[2]]
+            return ''
+        elif command == 'clear':
+            for key_id in [key_id for key_id, key in self.keys.items() if key[3] == args[2]]:
+                del self.keys[key_id]
+            return ''
+        elif command == 'timeout':
+            return ''
+        raise AssertionError(args)
+
+
+def test_keyring_cache():
+    keyctl = FakeKeyctl()
+    with mock.patch('subprocess.check_output', new=keyctl), mock.patch('time.time', side_effect=[1, 2]):
+        cache = KeyringCache(ttl=60, max_entries=1)
+        assert cache.get('foo') is None
+        cache.set('foo', 'bar')
+        cache.set('baz', 'qux')  # over max_entries, so foo is evicted
+        assert cache.get('foo') is None
+        assert cache.get('baz') == 'qux'
+        assert cache.clear() == 1
+
+    # Only the treehugger keyring is left
+    assert [key[:2] for key in keyctl.keys.values()] == [('keyring', 'treehugger')]
+
+
+def test_keyring_cache_lists_once():
+    keyctl = FakeKeyctl()
+    ring_id = keyctl.add('keyring', 'treehugger', None, '@u')
+    keyctl.add('user', 'treehugger:1000:old', 'old-value', ring_id)
+    keyctl.add('user', 'unrelated', 'other', ring_id)
+
+    with mock.patch('subprocess.check_output', new=keyctl):
+        cache = KeyringCache(ttl=60, max_entries=100)
+        assert cache.get('old') == 'old-value'
+        for i in range(20):
+            cache.set('key{}'.format(i), 'value')
+
+    # search, rlist and two rdescribes, then a pipe, and a padd and timeout per entry
+    assert len(keyctl.calls) == 4 + 1 + 20 * 2
+    assert keyctl.calls.count('rlist') == 1
+
+
+def test_keyring_cache_no_keyctl(capsys):
+    with mock.patch('subprocess.check_output', side_effect=FileNotFoundError):
+        with pytest.raises(SystemExit):
+            KeyringCache(ttl=60, max_entries=1).get('foo')
+
+    out, err = capsys.readouterr()
+    assert 'requires the "keyctl" program' in err
+
+
+def test_object_cache_get_set(state_dir):
+    cache = ObjectCache(max_bytes=1000)
+    key = cache.make_key('bucket', 'key.yml', '1')
+    assert key != cache.make_key('bucket', 'key.yml', '2')
+    assert cache.get(key) is None
+    assert cache.get_parsed(key) is None
+
+    cache.set(key, b'A: b')
+    cache.set_parsed(key, {'A': 'b'})
+
+    assert cache.get(key) == b'A: b'
+    assert cache.get_parsed(key) == {'A': 'b'}
+    assert (cache.hits, cache.misses) == (2, 1)
+    mode = os.stat(os.path.join(cache.directory, key)).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+
+
+def test_object_cache_set_parsed_not_json(state_dir):
+    cache = ObjectCache(max_bytes=1000)
+    cache.set_parsed('foo', {1: 'b'})
+    assert cache.get_parsed('foo') is None
+
+
+def test_object_cache_evicts_least_recently_used(state_dir):
+    cache = ObjectCache(max_bytes=10)
+    cache.set('a', b'aaaa')
+    cache.set('b', b'bbbb')
+    os.utime(os.path.join(cache.directory, 'a'), (1, 1))
+    os.utime(os.path.join(cache.directory, 'b'), (2, 2))
+    assert cache.get('a') == b'aaaa'  # now more recently used than b
+
+    cache.set('c', b'cccc')
+
+    assert sorted(os.listdir(cache.directory)) == ['a', 'c']
+    assert cache.clear() == 2
@@ -2,15 +2,20 @@ import base64
 import io
 import json
 import os
+import stat
+import sys
 import textwrap
+import threading
+import time
 from unittest import mock
 
 import pytest
 import yaml
 
 from treehugger import __version__
-from treehugger.cli import main
+from treehugger.cli import batch, main
 from treehugger.ec2 import USER_DATA_URL
+from treehugger.kms import kms_agent
 
 
 def test_help(capsys):
@@ -165,6 +170,120 @@ def test_decrypt(tmpdir, kms_stub):
     assert data['TREEHUGGER_STAGE'] == 'qux'
 
 
+def test_decrypt_directories_and_globs(tmpdir, kms_stub, capsys):
+    tmpdir.join('app', 'prod.yml').write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        TREEHUGGER_APP: app
+        TREEHUGGER_STAGE: prod
+    '''.format(base64.b64encode(b'foo').decode('utf-8'))), ensure=True)
+    tmpdir.join('app', 'nested', 'test.yaml').write(textwrap.dedent('''\
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: app
+        TREEHUGGER_STAGE: test
+    '''), ensure=True)
+    tmpdir.join('app', 'README.txt').write('Not YAML')
+    tmpdir.join('other.yml').write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        TREEHUGGER_APP: other
+        TREEHUGGER_STAGE: prod
+    '''.format(base64.b64encode(b'bar').decode('utf-8'))))
+    for ciphertext, app in [(b'foo', 'app'), (b'bar', 'other')]:
+        kms_stub.add_response(
+            'decrypt',
+            expected_params={
+                'CiphertextBlob': ciphertext,
+                'EncryptionContext': {
+                    'treehugger_app': app,
+                    'treehugger_key': 'MY_ENCRYPTED_VAR',
+                    'treehugger_stage': 'prod',
+                }
+            },
+            service_response={
+                'KeyId': 'treehugger',
+                'Plaintext': b'plain-' + ciphertext,
+            }
+        )
+
+    main(['-w', '1', 'decrypt-file', str(tmpdir.join('app')), str(tmpdir.join('*.yml'))])
+
+    out, err = capsys.readouterr()
+    assert out.startswith('Successfully decrypted 3 files (2 variables, 2 KMS calls) in ')
+    assert yaml.safe_load(tmpdir.join('app', 'prod.yml').read())['MY_ENCRYPTED_VAR'] == {'to_encrypt': 'plain-foo'}
+    assert yaml.safe_load(tmpdir.join('other.yml').read())['MY_ENCRYPTED_VAR'] == {'to_encrypt': 'plain-bar'}
+    assert tmpdir.join('app', 'README.txt').read() == 'Not YAML'
+
+
+def test_decrypt_process_pool(tmpdir, capsys, monkeypatch):
+    monkeypatch.setattr(batch, 'PROCESS_POOL_MIN_FILES', 2)
+    for stage in ('prod', 'test'):
+        tmpdir.join('{}.yml'.format(stage)).write(
+            '{"MY_UNENCRYPTED_VAR": "bar", "TREEHUGGER_APP": "app", "TREEHUGGER_STAGE": "%s"}' % stage
+        )
+
+    main(['-w', '2', 'decrypt-file', str(tmpdir)])
+
+    out, err = capsys.readouterr()
+    assert out.startswith('Successfully decrypted 2 files (0 variables, 0 KMS calls) in ')
+    assert tmpdir.join('test.yml').read() == 'MY_UNENCRYPTED_VAR: bar\nTREEHUGGER_APP: app\nTREEHUGGER_STAGE: test\n'
+
+
+def test_decrypt_process_pool_before_python_3_7(tmpdir, capsys, monkeypatch):
+    # ProcessPoolExecutor has no mp_context argument
+    monkeypatch.setattr(batch, 'PROCESS_POOL_MIN_FILES', 2)
+    monkeypatch.setattr(sys, 'version_info', (3, 6, 9))
+    for stage in ('prod', 'test'):
+        tmpdir.join('{}.yml'.format(stage)).write(
+            '{"MY_UNENCRYPTED_VAR": "bar", "TREEHUGGER_APP": "app", "TREEHUGGER_STAGE": "%s"}' % stage
+        )
+
+    main(['-w', '2', 'decrypt-file', str(tmpdir)])
+
+    out, err = capsys.readouterr()
+    assert out.startswith('Successfully decrypted 2 files (0 variables, 0 KMS calls) in ')
+    assert tmpdir.join('test.yml').read() == 'MY_UNENCRYPTED_VAR: bar\nTREEHUGGER_APP: app\nTREEHUGGER_STAGE: test\n'
+
+
+def test_decrypt_files_share_workers(tmpdir, capsys, monkeypatch):
+    for app in ('one', 'two', 'three', 'four'):
+        tmpdir.join('{}.yml'.format(app)).write(textwrap.dedent('''\
+            TREEHUGGER_APP: {}
+            TREEHUGGER_STAGE: prod
+        '''.format(app)) + ''.join(
+            'VAR_{}:\n  encrypted: {}\n'.format(i, base64.b64encode(b'foo').decode('utf-8'))
+            for i in range(4)
+        ))
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def kms_decrypt_now(base64_ciphertext, encryption_context):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return b'bar'
+
+    monkeypatch.setattr(kms_agent, '_kms_decrypt_now', kms_decrypt_now)
+
+    main(['-w', '2', 'decrypt-file', str(tmpdir)])
+
+    out, err = capsys.readouterr()
+    assert out.startswith('Successfully decrypted 4 files (16 variables, ')
+    # At most --workers KMS calls at once across all the files
+    assert in_flight[1] == 2
+
+
+def test_encrypt_glob_no_matches(tmpdir, capsys):
+    with pytest.raises(SystemExit):
+        main(['encrypt-file', str(tmpdir.join('*.yml'))])
+
+    out, err = capsys.readouterr()
+    assert 'No files match {}'.format(tmpdir.join('*.yml')) in err
+
+
 def test_edit(tmpdir, kms_stub):
     tmpfile = tmpdir.join('test.yml')
     encrypted_var = base64.b64encode(b'foo')
@@ -662,3 +781,423 @@ def test_print_json_single_line(tmpdir, capsys):
         "TREEHUGGER_APP": "baz",
         "TREEHUGGER_STAGE": "qux"
     }
+
+
+def test_workers_env_var(tmpdir):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+
+    with mock.patch.dict(os.environ, {'TREEHUGGER_WORKERS': '3'}):
+        main(['print', '-f', str(tmpfile)])
+
+    assert kms_agent.workers == 3
+
+
+def test_workers_invalid(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        main(['--workers', '0', 'print'])
+
+    assert excinfo.value.code == 1
+    out, err = capsys.readouterr()
+    assert 'Number of workers must be a positive integer' in err
+
+
+def test_encrypt_envelope_then_print(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          to_encrypt: foo
+        MY_ENCRYPTED_VAR2:
+          to_encrypt: foo2
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    kms_stub.add_response(
+        'generate_data_key',
+        expected_params={
+            'KeyId': 'alias/treehugger',
+            'KeySpec': 'AES_256',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+            'CiphertextBlob': b'wrapped',
+        }
+    )
+
+    main(['encrypt-file', '--envelope', str(tmpfile)])
+
+    data = yaml.safe_load(tmpfile.read())
+    assert data['treehugger_data_key'] == base64.b64encode(b'wrapped').decode('utf-8')
+    assert set(data['MY_ENCRYPTED_VAR']) == {'envelope_encrypted'}
+    assert set(data['MY_ENCRYPTED_VAR2']) == {'envelope_encrypted'}
+
+    kms_agent.reset()
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'wrapped',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+        }
+    )
+    capsys.readouterr()
+
+    main(['print', '-f', str(tmpfile)])
+    out, err = capsys.readouterr()
+
+    assert out.split('\n') == [
+        'MY_ENCRYPTED_VAR=foo',
+        'MY_ENCRYPTED_VAR2=foo2',
+        'TREEHUGGER_APP=baz',
+        'TREEHUGGER_STAGE=qux',
+        '',
+    ]
+
+
+def test_edit_envelope_reuses_data_key(tmpdir, kms_stub):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          to_encrypt: foo
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    kms_stub.add_response(
+        'generate_data_key',
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+            'CiphertextBlob': b'wrapped',
+        }
+    )
+    main(['encrypt-file', '--envelope', str(tmpfile)])
+    before = yaml.safe_load(tmpfile.read())
+
+    kms_agent.reset()
+    kms_stub.add_response(
+        'decrypt',
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+        }
+    )
+
+    def fake_call(command):
+        with open(command[1], 'a') as fp:
+            fp.write('MY_ENCRYPTED_VAR2: {to_encrypt: foo2}\n')
+        return 0
+
+    with mock.patch.dict(os.environ, {'EDITOR': 'nano'}), mock.patch('subprocess.call', new=fake_call):
+        main(['edit', str(tmpfile)])
+
+    after = yaml.safe_load(tmpfile.read())
+    assert after['treehugger_data_key'] == before['treehugger_data_key']
+    assert after['MY_ENCRYPTED_VAR'] == before['MY_ENCRYPTED_VAR']
+    assert set(after['MY_ENCRYPTED_VAR2']) == {'envelope_encrypted'}
+
+
+def test_print_cache_verbose(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    encrypted_var = base64.b64encode(b'foo')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {encrypted_var}
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(encrypted_var=encrypted_var.decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+
+    main(['--cache', 'file', 'print', '-f', str(tmpfile)])
+    kms_agent.reset()
+    main(['-v', '--cache', 'file', 'print', '-f', str(tmpfile)])
+    out, err = capsys.readouterr()
+
+    assert out.count('MY_ENCRYPTED_VAR=quux') == 2
+    assert 'Decrypted value cache (file): 1 hits, 0 misses' in err
+
+    with mock.patch('treehugger.cache.keyctl_available', return_value=False):
+        main(['cache', 'clear'])
+    out, err = capsys.readouterr()
+    assert 'Removed 1 cached values' in out
+
+
+def test_print_s3_cache(tmpdir, s3_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        include: s3://my-bucket/my_file.yml?versionId=2
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    s3_stub.add_response(
+        'get_object',
+        expected_params={
+            'Bucket': 'my-bucket',
+            'Key': 'my_file.yml',
+            'VersionId': '2',
+        },
+        service_response={
+            'Body': io.BytesIO(b'MY_INCLUDED_VAR: IliveinS3'),
+        }
+    )
+
+    main(['--s3-cache', 'print', '-f', str(tmpfile)])
+    main(['-v', '--s3-cache', 'print', '-f', str(tmpfile)])
+    out, err = capsys.readouterr()
+
+    assert out.count('MY_INCLUDED_VAR=IliveinS3\n') == 2
+    assert 'S3 object cache: 1 hits, 0 misses' in err
+
+    with mock.patch('treehugger.cache.keyctl_available', return_value=False):
+        main(['cache', 'clear'])
+    out, err = capsys.readouterr()
+    assert 'Removed 2 cached values' in out
+
+
+def test_exec_supervise(tmpdir, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    code = 'import os, sys; sys.exit(4 if os.environ["MY_UNENCRYPTED_VAR"] == "bar" else 1)'
+
+    with mock.patch('signal.signal'), pytest.raises(SystemExit) as excinfo:
+        main(['exec', '-f', str(tmpfile), '--supervise', '--', sys.executable, '-c', code])
+
+    assert excinfo.value.code == 4
+
+
+def test_exec_supervise_unknown_signal(tmpdir, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write('TREEHUGGER_APP: baz\nTREEHUGGER_STAGE: qux\n')
+
+    with pytest.raises(SystemExit):
+        main(['exec', '-f', str(tmpfile), '--supervise', '--reload-signal', 'nope', '--', 'true'])
+
+    out, err = capsys.readouterr()
+    assert "Unknown signal 'nope'" in err
+
+
+def test_cache_unknown(capsys):
+    with pytest.raises(SystemExit):
+        main(['--cache', 'nope', 'print'])
+
+    out, err = capsys.readouterr()
+    assert "Unknown cache 'nope', choose from: file, keyring" in err
+
+
+def test_print_kms_rate_verbose(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {encrypted_var}
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(encrypted_var=base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+
+    main(['-v', '--kms-rate', '10', '--kms-rate-shared', 'print', '-f', str(tmpfile)])
+    out, err = capsys.readouterr()
+
+    assert 'MY_ENCRYPTED_VAR=quux' in out
+    assert 'KMS rate limiter: 1 requests waited 0.000s in total' in err
+
+
+def test_aws_retry_mode_invalid(capsys):
+    with pytest.raises(SystemExit):
+        main(['--aws-retry-mode', 'nope', 'print'])
+
+    out, err = capsys.readouterr()
+    assert 'AWS retry mode must be one of legacy, standard, or adaptive' in err
+
+
+def test_print_key_filters(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        DB_PASSWORD:
+          encrypted: {db_password}
+        DB_READONLY_PASSWORD:
+          encrypted: IGNOREME
+        API_KEY:
+          encrypted: IGNOREME
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(db_password=base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'foo',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'DB_PASSWORD',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+
+    main(['-v', 'print', '-f', str(tmpfile), '--prefix', 'DB_', '--exclude', '*_READONLY_*'])
+    out, err = capsys.readouterr()
+
+    assert out.split('\n') == [
+        'DB_PASSWORD=quux',
+        'MY_UNENCRYPTED_VAR=bar',
+        'TREEHUGGER_APP=baz',
+        'TREEHUGGER_STAGE=qux',
+        '',
+    ]
+    assert 'Skipped decrypting 2 variables' in err
+
+
+def test_exec_only(tmpdir, kms_stub):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {encrypted_var}
+        OTHER_ENCRYPTED_VAR:
+          encrypted: IGNOREME
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(encrypted_var=base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'foo',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'MY_ENCRYPTED_VAR',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+
+    with mock.patch('os.execlp'), mock.patch('os.environ', new={}) as mock_environ:
+        main(['exec', '-f', str(tmpfile), '--only', 'MY_ENCRYPTED_VAR,MISSING_VAR', '--', 'env'])
+
+    assert mock_environ == {
+        'MY_ENCRYPTED_VAR': 'quux',
+        'MY_UNENCRYPTED_VAR': 'bar',
+        'TREEHUGGER_APP': 'baz',
+        'TREEHUGGER_STAGE': 'qux',
+    }
+
+
+def test_print_outputs(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        MY_UNENCRYPTED_VAR: "it's $HOME"
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'foo',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'MY_ENCRYPTED_VAR',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+    json_file = tmpdir.join('env.json')
+    docker_file = tmpdir.join('env.docker')
+    systemd_file = tmpdir.join('env.systemd')
+
+    main([
+        'print', '-f', str(tmpfile),
+        '--output', 'json:{}'.format(json_file),
+        '--output', 'docker:{}'.format(docker_file),
+        '--output', 'systemd:{}'.format(systemd_file),
+        '--output', 'dotenv:-',
+    ])
+    out, err = capsys.readouterr()
+
+    assert json.loads(json_file.read()) == {
+        'MY_ENCRYPTED_VAR': 'quux',
+        'MY_UNENCRYPTED_VAR': "it's $HOME",
+        'TREEHUGGER_APP': 'baz',
+        'TREEHUGGER_STAGE': 'qux',
+    }
+    assert docker_file.read() == textwrap.dedent('''\
+        MY_ENCRYPTED_VAR=quux
+        MY_UNENCRYPTED_VAR=it's $HOME
+        TREEHUGGER_APP=baz
+        TREEHUGGER_STAGE=qux
+    ''')
+    assert systemd_file.read().splitlines()[1] == 'MY_UNENCRYPTED_VAR="it\'s \\$HOME"'
+    assert out.splitlines() == [
+        "MY_ENCRYPTED_VAR='quux'",
+        'MY_UNENCRYPTED_VAR="it\'s $HOME"',
+        "TREEHUGGER_APP='baz'",
+        "TREEHUGGER_STAGE='qux'",
+    ]
+    for path in (json_file, docker_file, systemd_file):
+        assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o600
+
+
+def test_print_output_unknown_format(tmpdir, capsys):
+    with pytest.raises(SystemExit):
+        main(['print', '-f', str(tmpdir.join('test.yml')), '--output', 'yaml:-'])
+
+    out, err = capsys.readouterr()
+    assert "Unknown output format 'yaml', choose from: docker, dotenv, json, shell, systemd" in err
+
+
+def test_print_output_docker_newline(tmpdir, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_VAR: "foo\\nbar"
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    json_file = tmpdir.join('env.json')
+
+    with pytest.raises(SystemExit):
+        main(['print', '-f', str(tmpfile), '--output', 'json:{}'.format(json_file), '--output', 'docker:-'])
+
+    out, err = capsys.readouterr()
+    assert "MY_VAR contains a newline, which can't be written to a docker env file" in err
+    assert not json_file.check()
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from treehugger.concurrency import BackgroundPool, map_in_order
+
+
+def test_map_in_order_serial():
+    assert map_in_order(lambda x: x * 2, [1, 2, 3], workers=1) == [2, 4, 6]
+
+
+def test_map_in_order_concurrent_keeps_order():
+    barrier = threading.Barrier(3)
+
+    def func(x):
+        # All three calls must be in flight at once to get past the barrier
+        barrier.wait(timeout=5)
+        return x * 2
+
+    assert map_in_order(func, [3, 2, 1], workers=3) == [6, 4, 2]
+
+
+def test_map_in_order_empty():
+    assert map_in_order(lambda x: x, [], workers=4) == []
+
+
+def test_map_in_order_raises_earliest_failure():
+    finished = []
+
+    def func(x):
+        if x in (2, 3):
+            raise ValueError(x)
+        finished.append(x)
+        return x
+
+    with pytest.raises(ValueError) as excinfo:
+        map_in_order(func, [1, 2, 3, 4], workers=4)
+
+    assert excinfo.value.args == (2,)
+    assert sorted(finished) == [1, 4]
+
+
+def test_background_pool_runs():
+    pool = BackgroundPool(workers=2)
+
+    futures = [pool.submit(lambda x=x: x * 2) for x in range(4)]
+
+    assert [future.result(timeout=5) for future in futures] == [0, 2, 4, 6]
+
+
+def test_background_pool_exception():
+    pool = BackgroundPool(workers=1)
+
+    def fail():
+        raise SystemExit(1)
+
+    with pytest.raises(SystemExit):
+        pool.submit(fail).result(timeout=5)
+
+
+def test_background_pool_cancel_before_start():
+    pool = BackgroundPool(workers=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(timeout=5)
+
+    pool.submit(block)
+    started.wait(timeout=5)
+    ran = []
+    future = pool.submit(lambda: ran.append(None))
+
+    assert future.cancel()
+    release.set()
+    assert pool.submit(lambda: 'done').result(timeout=5) == 'done'
+    assert ran == []
@@ -1,8 +1,12 @@
 import base64
+import threading
+import time
 
 import pytest
 
-from treehugger.data import Encrypted, EnvironmentDict, ToEncrypt
+from treehugger import envelope
+from treehugger.data import Encrypted, EnvelopeEncrypted, EnvironmentDict, KeyFilter, ToEncrypt
+from treehugger.kms import kms_agent
 
 
 def test_from_yaml_dict_success_plain():
@@ -170,3 +174,278 @@ def test_remove_all_encrypted_plain():
         TREEHUGGER_STAGE='bar',
         baz='qux',
     )
+
+
+def test_from_yaml_dict_fail_dict_unknown():
+    with pytest.raises(ValueError):
+        EnvironmentDict.from_yaml_dict({'key': {'unknown': 'foo'}})
+
+
+def test_from_yaml_dict_envelope():
+    obj = EnvironmentDict.from_yaml_dict({
+        'foo': {'envelope_encrypted': 'bar'},
+        'treehugger_data_key': 'baz',
+    })
+    assert obj == EnvironmentDict({'foo': EnvelopeEncrypted('bar')})
+    assert obj.wrapped_data_key == 'baz'
+    assert obj.to_yaml_dict() == {
+        'foo': {'envelope_encrypted': 'bar'},
+        'treehugger_data_key': 'baz',
+    }
+
+
+def test_encrypt_all_to_encrypt_envelope(kms_stub):
+    obj = EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=ToEncrypt('qux'),
+        corge=ToEncrypt('grault'),
+    )
+    kms_stub.add_response(
+        'generate_data_key',
+        expected_params={
+            'KeyId': 'alias/treehugger',
+            'KeySpec': 'AES_256',
+            'EncryptionContext': {
+                'treehugger_app': 'foo',
+                'treehugger_stage': 'bar',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+            'CiphertextBlob': b'wrapped',
+        }
+    )
+
+    encrypted = obj.encrypt_all_to_encrypt(envelope=True)
+
+    assert encrypted.wrapped_data_key == base64.b64encode(b'wrapped').decode('utf-8')
+    assert isinstance(encrypted['baz'], EnvelopeEncrypted)
+    assert isinstance(encrypted['corge'], EnvelopeEncrypted)
+
+    kms_agent.reset()
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'wrapped',
+            'EncryptionContext': {
+                'treehugger_app': 'foo',
+                'treehugger_stage': 'bar',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+        }
+    )
+    assert encrypted.decrypt_all_encrypted(plain=True) == EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz='qux',
+        corge='grault',
+    )
+
+
+def test_decrypt_all_encrypted_envelope_missing_data_key():
+    obj = EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=EnvelopeEncrypted('qux'),
+    )
+    with pytest.raises(ValueError):
+        obj.decrypt_all_encrypted()
+
+
+def test_remove_all_encrypted_envelope():
+    obj = EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=EnvelopeEncrypted('qux'),
+    )
+    assert obj.remove_all_encrypted() == EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+    )
+
+
+def add_decrypt_response(kms_stub, key, ciphertext, plaintext):
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': ciphertext,
+            'EncryptionContext': {
+                'treehugger_app': 'foo',
+                'treehugger_key': key,
+                'treehugger_stage': 'bar',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': plaintext,
+        }
+    )
+
+
+def make_lazy_env_dict():
+    return EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=Encrypted(base64.b64encode(b'qux').decode('utf-8')),
+        corge=ToEncrypt('grault'),
+        garply=Encrypted(base64.b64encode(b'waldo').decode('utf-8')),
+    )
+
+
+def test_decrypt_lazily(kms_stub):
+    lazy = make_lazy_env_dict().decrypt_lazily()
+
+    # No KMS calls needed for these
+    assert sorted(lazy) == ['TREEHUGGER_APP', 'TREEHUGGER_STAGE', 'baz', 'corge', 'garply']
+    assert len(lazy) == 5
+    assert 'baz' in lazy
+    assert lazy['corge'] == 'grault'
+    assert 'qux' not in repr(lazy)
+
+    add_decrypt_response(kms_stub, 'baz', b'qux', b'quux')
+    assert lazy['baz'] == 'quux'
+    assert lazy['baz'] == 'quux'  # memoized
+    kms_stub.assert_no_pending_responses()
+
+    add_decrypt_response(kms_stub, 'garply', b'waldo', b'fred')
+    assert dict(lazy) == {
+        'TREEHUGGER_APP': 'foo',
+        'TREEHUGGER_STAGE': 'bar',
+        'baz': 'quux',
+        'corge': 'grault',
+        'garply': 'fred',
+    }
+
+
+def test_decrypt_lazily_prefetch(kms_stub):
+    lazy = make_lazy_env_dict().decrypt_lazily()
+    add_decrypt_response(kms_stub, 'garply', b'waldo', b'fred')
+
+    lazy.prefetch(['garply', 'corge'])
+    kms_stub.assert_no_pending_responses()
+
+    assert lazy['garply'] == 'fred'
+    assert lazy.get('missing') is None
+
+
+def test_decrypt_lazily_keys(kms_stub):
+    lazy = make_lazy_env_dict().decrypt_lazily()
+
+    # No KMS calls needed
+    assert 'baz' in lazy.keys()
+    assert sorted(lazy.keys()) == ['TREEHUGGER_APP', 'TREEHUGGER_STAGE', 'baz', 'corge', 'garply']
+
+
+def test_decrypt_lazily_threads_different_keys():
+    env_dict = make_lazy_env_dict()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def decrypt_values(keys):
+        # Both threads must be decrypting at once to get past this
+        barrier.wait()
+        return {key: 'plain-' + key for key in keys}
+
+    env_dict.decrypt_values = decrypt_values
+    lazy = env_dict.decrypt_lazily()
+    results = {}
+    threads = [
+        threading.Thread(target=lambda key=key: results.update({key: lazy[key]}))
+        for key in ('baz', 'garply')
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {'baz': 'plain-baz', 'garply': 'plain-garply'}
+
+
+def test_decrypt_lazily_threads_same_key():
+    env_dict = make_lazy_env_dict()
+    calls = []
+    release = threading.Event()
+
+    def decrypt_values(keys):
+        calls.append(keys)
+        release.wait(5)
+        return {key: 'plain-' + key for key in keys}
+
+    env_dict.decrypt_values = decrypt_values
+    lazy = env_dict.decrypt_lazily()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(lazy['baz'])) for _ in range(2)]
+    threads[0].start()
+    while not calls:
+        time.sleep(0.01)
+    threads[1].start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [['baz']]
+    assert results == ['plain-baz', 'plain-baz']
+
+
+def test_select_encrypted():
+    obj = EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=ToEncrypt('qux'),
+        corge=Encrypted('grault'),
+        garply=EnvelopeEncrypted('waldo'),
+    )
+    obj.wrapped_data_key = 'fred'
+    selected = obj.select_encrypted(KeyFilter(only=['corge']))
+    assert selected == EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=ToEncrypt('qux'),
+        corge=Encrypted('grault'),
+    )
+    assert selected.wrapped_data_key == 'fred'
+
+
+def test_key_filter():
+    assert KeyFilter()('A')
+    assert KeyFilter(only=['A'])('A')
+    assert not KeyFilter(only=['A'])('AB')
+    assert KeyFilter(only=['A'], prefixes=['DB_'])('DB_PASSWORD')
+    assert not KeyFilter(prefixes=['DB_'])('API_KEY')
+    assert not KeyFilter(excludes=['*_KEY'])('API_KEY')
+    assert not KeyFilter(prefixes=['API_'], excludes=['*_KEY'])('API_KEY')
+    assert KeyFilter(excludes=['*_KEY'])('API_KEYS')
+
+
+def test_decrypt_all_encrypted_envelope_several_data_keys(kms_stub):
+    context = {'treehugger_app': 'foo', 'treehugger_stage': 'bar'}
+    data_key_one = b'1' * 32
+    data_key_two = b'2' * 32
+    obj = EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz=EnvelopeEncrypted(
+            envelope.encrypt_value(data_key_one, 'qux', dict(context, treehugger_key='baz')),
+            'd3JhcHBlZC1vbmU=',
+        ),
+        corge=EnvelopeEncrypted(envelope.encrypt_value(data_key_two, 'grault', dict(context, treehugger_key='corge'))),
+    )
+    obj.wrapped_data_key = 'd3JhcHBlZC10d28='
+    for wrapped, plaintext in ((b'wrapped-one', data_key_one), (b'wrapped-two', data_key_two)):
+        kms_stub.add_response(
+            'decrypt',
+            expected_params={'CiphertextBlob': wrapped, 'EncryptionContext': context},
+            service_response={'KeyId': 'treehugger', 'Plaintext': plaintext},
+        )
+
+    assert obj.decrypt_all_encrypted(plain=True) == EnvironmentDict(
+        TREEHUGGER_APP='foo',
+        TREEHUGGER_STAGE='bar',
+        baz='qux',
+        corge='grault',
+    )
@@ -1,7 +1,11 @@
+import os
+from unittest import mock
+
 import pytest
 import requests
 
-from treehugger.ec2 import USER_DATA_URL, load_user_data_as_yaml_or_die
+from treehugger import ec2, limits
+from treehugger.ec2 import IDENTITY_URL, TOKEN_URL, USER_DATA_URL, get_current_region, load_user_data_as_yaml_or_die
 
 
 def test_success(requests_mock):
@@ -45,6 +49,16 @@ def test_not_yaml_dict(requests_mock, capsys):
     assert 'EC2 user data is not a YAML dictionary' in err
 
 
+def test_user_data_too_large(requests_mock, monkeypatch, capsys):
+    monkeypatch.setattr(limits, 'max_bytes', 10)
+    requests_mock.get(USER_DATA_URL, status_code=200, text='treehugger: {foo: bar}')
+    with pytest.raises(SystemExit):
+        load_user_data_as_yaml_or_die()
+
+    out, err = capsys.readouterr()
+    assert 'EC2 user data is larger than the limit of 10 bytes' in err
+
+
 def test_missing_treehugger(requests_mock, capsys):
     requests_mock.get(USER_DATA_URL, status_code=200, text='foo: bar')
     with pytest.raises(SystemExit):
@@ -52,3 +66,172 @@ def test_missing_treehugger(requests_mock, capsys):
 
     out, err = capsys.readouterr()
     assert 'YAML in EC2 user data does not have a key "treehugger"' in err
+
+
+def test_imdsv2_token_reused(requests_mock):
+    requests_mock.get(USER_DATA_URL, text='treehugger: {foo: bar}', status_code=200)
+    requests_mock.get(IDENTITY_URL, json={'region': 'eu-west-2'})
+
+    load_user_data_as_yaml_or_die()
+    get_current_region()
+
+    token_requests = [r for r in requests_mock.request_history if r.url == TOKEN_URL]
+    assert len(token_requests) == 1
+    assert token_requests[0].headers['X-aws-ec2-metadata-token-ttl-seconds'] == '21600'
+    for request in requests_mock.request_history:
+        if request.method == 'GET':
+            assert request.headers['X-aws-ec2-metadata-token'] == 'imds-token'
+
+
+def test_imdsv2_token_expiry(requests_mock):
+    requests_mock.get(IDENTITY_URL, json={'region': 'eu-west-2'})
+
+    with mock.patch('time.monotonic', return_value=0.0):
+        ec2.get_metadata_token()
+    with mock.patch('time.monotonic', return_value=float(ec2.TOKEN_TTL)):
+        ec2.get_metadata_token()
+
+    assert len([r for r in requests_mock.request_history if r.url == TOKEN_URL]) == 2
+
+
+def test_imdsv2_token_rejected(requests_mock):
+    requests_mock.get(
+        USER_DATA_URL,
+        [{'status_code': 401}, {'text': 'treehugger: {foo: bar}', 'status_code': 200}],
+    )
+
+    assert load_user_data_as_yaml_or_die() == {'foo': 'bar'}
+    assert len([r for r in requests_mock.request_history if r.url == TOKEN_URL]) == 2
+
+
+def test_imdsv1_fallback(requests_mock):
+    requests_mock.put(TOKEN_URL, status_code=404)
+    requests_mock.get(USER_DATA_URL, text='treehugger: {foo: bar}', status_code=200)
+
+    assert load_user_data_as_yaml_or_die() == {'foo': 'bar'}
+    assert 'X-aws-ec2-metadata-token' not in requests_mock.last_request.headers
+
+
+def test_region_cached(requests_mock):
+    requests_mock.get(IDENTITY_URL, json={'region': 'eu-west-2'})
+
+    assert get_current_region() == 'eu-west-2'
+    assert get_current_region() == 'eu-west-2'
+    assert len([r for r in requests_mock.request_history if r.url == IDENTITY_URL]) == 1
+
+
+def test_identity_disk_cache(requests_mock, state_dir, monkeypatch):
+    monkeypatch.setattr(ec2, 'disk_cache', True)
+    requests_mock.get(IDENTITY_URL, json={'region': 'eu-west-2'})
+    if not os.path.exists('/proc/sys/kernel/random/boot_id'):
+        pytest.skip('Needs Linux boot_id')
+
+    assert get_current_region() == 'eu-west-2'
+    ec2.reset()
+    # Second "process" reads it from disk
+    assert get_current_region() == 'eu-west-2'
+
+    assert len([r for r in requests_mock.request_history if r.url == IDENTITY_URL]) == 1
+    assert any(name.startswith('ec2-identity-') for name in os.listdir(str(state_dir)))
+
+
+def test_probe_unreachable_remembered(requests_mock, capsys, monkeypatch):
+    if not os.path.exists('/proc/sys/kernel/random/boot_id'):
+        pytest.skip('Needs Linux boot_id')
+    monkeypatch.setattr(ec2, 'negative_cache_ttl', 600)
+    monkeypatch.setattr(ec2, '_may_be_ec2', lambda: False)
+    requests_mock.put(TOKEN_URL, exc=requests.exceptions.ConnectTimeout)
+
+    with pytest.raises(SystemExit):
+        load_user_data_as_yaml_or_die()
+    ec2.reset()
+    with pytest.raises(SystemExit):
+        load_user_data_as_yaml_or_die()
+
+    assert requests_mock.call_count == 1
+    _, err = capsys.readouterr()
+    assert err.count('Could not connect to EC2 metadata service') == 2
+
+
+def test_probe_unreachable_not_remembered(requests_mock, monkeypatch):
+    monkeypatch.setattr(ec2, 'negative_cache_ttl', 0)
+    requests_mock.put(TOKEN_URL, exc=requests.exceptions.ConnectTimeout)
+
+    for _ in range(2):
+        ec2.reset()
+        with pytest.raises(ec2.MetadataServiceUnavailable):
+            ec2.get_metadata_token()
+
+    assert requests_mock.call_count == 2
+
+
+def test_probe_unreachable_on_ec2_not_remembered(requests_mock, monkeypatch):
+    # Early in boot, before the network is up
+    monkeypatch.setattr(ec2, 'negative_cache_ttl', 600)
+    monkeypatch.setattr(ec2, '_may_be_ec2', lambda: True)
+    requests_mock.put(TOKEN_URL, exc=requests.exceptions.ConnectionError)
+
+    for _ in range(2):
+        ec2.reset()
+        with pytest.raises(ec2.MetadataServiceUnavailable):
+            ec2.get_metadata_token()
+
+    assert requests_mock.call_count == 2
+
+
+@pytest.mark.parametrize('contents,expected', [
+    ({'sys_vendor': 'Amazon EC2\n'}, True),
+    ({'sys_vendor': 'Xen\n', 'bios_version': '4.11.amazon\n'}, True),
+    ({'uuid': 'ec2e1916-9099-7caf-fd21-012345abcdef\n'}, True),
+    ({'sys_vendor': 'QEMU\n', 'bios_vendor': 'SeaBIOS\n'}, False),
+    ({}, True),
+])
+def test_may_be_ec2(tmpdir, monkeypatch, contents, expected):
+    for name, content in contents.items():
+        tmpdir.join(name).write(content)
+    paths = [str(tmpdir.join(name)) for name in ('sys_vendor', 'bios_vendor', 'bios_version', 'uuid')]
+    monkeypatch.setattr(ec2, 'EC2_IDENTITY_PATHS', paths)
+
+    assert ec2._may_be_ec2() is expected
+
+
+def test_probe_read_timeout_uses_imdsv1(requests_mock, state_dir, monkeypatch):
+    monkeypatch.setattr(ec2, 'negative_cache_ttl', 600)
+    requests_mock.put(TOKEN_URL, exc=requests.exceptions.ReadTimeout)
+    requests_mock.get(USER_DATA_URL, text='treehugger: {foo: bar}', status_code=200)
+
+    assert load_user_data_as_yaml_or_die() == {'foo': 'bar'}
+    assert 'X-aws-ec2-metadata-token' not in requests_mock.last_request.headers
+    # Not remembered as unreachable
+    assert not os.path.exists(str(state_dir)) or not any(
+        name.startswith('ec2-unreachable-') for name in os.listdir(str(state_dir))
+    )
+
+
+def test_probe_debug_output(requests_mock, capsys, monkeypatch):
+    monkeypatch.setattr('treehugger.messaging.verbose', True)
+
+    ec2.get_metadata_token()
+
+    _, err = capsys.readouterr()
+    assert 'EC2 metadata service probe took' in err
+
+
+def test_probe_timeout(requests_mock, monkeypatch):
+    monkeypatch.setattr(ec2, 'probe_timeout', 0.25)
+
+    ec2.get_metadata_token()
+
+    assert requests_mock.last_request.timeout == 0.25
+
+
+def test_session_retries(monkeypatch):
+    monkeypatch.setattr(ec2, '_session', None)
+    monkeypatch.setattr(ec2, 'connect_retries', 1)
+    monkeypatch.setattr(ec2, 'read_retries', 4)
+
+    session = ec2.get_session()
+
+    retries = session.get_adapter(USER_DATA_URL).max_retries
+    assert (retries.connect, retries.read) == (1, 4)
+    assert session.get_adapter(TOKEN_URL).max_retries.total == 0
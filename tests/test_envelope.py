@@ -0,0 +1,41 @@
+import pytest
+
+from treehugger.envelope import decrypt_value, encrypt_value
+from treehugger.messaging import Fatal
+
+DATA_KEY = b'k' * 32
+
+
+def test_round_trip():
+    context = {'treehugger_key': 'foo'}
+    ciphertext = encrypt_value(DATA_KEY, 'bar', context)
+
+    assert isinstance(ciphertext, str)
+    assert decrypt_value(DATA_KEY, ciphertext, context) == 'bar'
+
+
+def test_random_nonce():
+    context = {'treehugger_key': 'foo'}
+    assert encrypt_value(DATA_KEY, 'bar', context) != encrypt_value(DATA_KEY, 'bar', context)
+
+
+def test_context_is_bound():
+    ciphertext = encrypt_value(DATA_KEY, 'bar', {'treehugger_key': 'foo'})
+
+    with pytest.raises(Fatal) as excinfo:
+        decrypt_value(DATA_KEY, ciphertext, {'treehugger_key': 'baz'})
+    assert excinfo.value.message.startswith('Could not decrypt envelope encrypted value baz')
+
+
+def test_wrong_key():
+    context = {'treehugger_key': 'foo'}
+    ciphertext = encrypt_value(DATA_KEY, 'bar', context)
+
+    with pytest.raises(Fatal) as excinfo:
+        decrypt_value(b'x' * 32, ciphertext, context)
+    assert excinfo.value.message.startswith('Could not decrypt envelope encrypted value foo')
+
+
+def test_corrupt_ciphertext():
+    with pytest.raises(Fatal):
+        decrypt_value(DATA_KEY, 'not base64!', {'treehugger_key': 'foo'})
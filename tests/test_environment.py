@@ -0,0 +1,105 @@
+import base64
+import textwrap
+import threading
+from unittest import mock
+
+from treehugger import yaml
+from treehugger.environment import EnvironmentLoader, load_data_overlapped_or_die
+from treehugger.kms import kms_agent
+
+
+def write_env_file(tmpfile, ciphertext, unencrypted):
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        MY_UNENCRYPTED_VAR: {}
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(base64.b64encode(ciphertext).decode('utf-8'), unencrypted)))
+
+
+def add_decrypt_response(kms_stub, ciphertext, plaintext):
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': ciphertext,
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'MY_ENCRYPTED_VAR',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': plaintext,
+        }
+    )
+
+
+def test_environment_loader_only_decrypts_changes(tmpdir, kms_stub):
+    tmpfile = tmpdir.join('test.yml')
+    loader = EnvironmentLoader(filename=str(tmpfile))
+    add_decrypt_response(kms_stub, b'foo', b'quux')
+    write_env_file(tmpfile, b'foo', 'bar')
+
+    assert loader.load()['MY_ENCRYPTED_VAR'] == 'quux'
+
+    # Only the unencrypted value changes, so no KMS calls
+    write_env_file(tmpfile, b'foo', 'baz')
+    environment = loader.load()
+    assert environment['MY_ENCRYPTED_VAR'] == 'quux'
+    assert environment['MY_UNENCRYPTED_VAR'] == 'baz'
+
+    add_decrypt_response(kms_stub, b'foo2', b'quux2')
+    write_env_file(tmpfile, b'foo2', 'baz')
+    assert loader.load()['MY_ENCRYPTED_VAR'] == 'quux2'
+
+
+def test_load_data_overlapped_decrypts_while_fetching_includes(tmpdir, monkeypatch):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        include: s3://my-bucket/my_file.yml?versionId=2
+        MY_ENCRYPTED_VAR:
+          encrypted: Zm9v
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    decrypting = threading.Event()
+    decrypted = []
+
+    def kms_decrypt_now(base64_ciphertext, encryption_context):
+        decrypting.set()
+        decrypted.append(encryption_context['treehugger_key'])
+        return base64.b64decode(base64_ciphertext)[::-1]
+
+    def load_s3_or_die(url):
+        # The top level document's values are already being decrypted
+        assert decrypting.wait(timeout=5)
+        return {'MY_INCLUDED_VAR': {'encrypted': 'YmFy'}}
+
+    monkeypatch.setattr(kms_agent, 'kms_client', object())
+    monkeypatch.setattr(kms_agent, '_kms_decrypt_now', kms_decrypt_now)
+    monkeypatch.setattr(yaml, 'load_s3_or_die', load_s3_or_die)
+
+    environment = EnvironmentLoader(filename=str(tmpfile)).load()
+
+    assert environment['MY_ENCRYPTED_VAR'] == 'oof'
+    assert environment['MY_INCLUDED_VAR'] == 'rab'
+    assert sorted(decrypted) == ['MY_ENCRYPTED_VAR', 'MY_INCLUDED_VAR']
+    assert kms_agent.prefetches == 2
+
+
+def test_load_data_overlapped_no_warm_up_without_encrypted_values(tmpdir, monkeypatch):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        include: s3://my-bucket/my_file.yml?versionId=2
+        MY_UNENCRYPTED_VAR: bar
+    '''))
+    monkeypatch.setattr(yaml, 'load_s3_or_die', lambda url: {'MY_INCLUDED_VAR': 'baz'})
+    warm_up = mock.Mock()
+    monkeypatch.setattr(kms_agent, 'warm_up', warm_up)
+
+    data = load_data_overlapped_or_die(filename=str(tmpfile))
+
+    assert data == {'MY_INCLUDED_VAR': 'baz', 'MY_UNENCRYPTED_VAR': 'bar'}
+    warm_up.assert_not_called()
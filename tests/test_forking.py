@@ -0,0 +1,57 @@
+import base64
+import os
+
+from treehugger import forking, s3
+from treehugger.cache import KeyringCache, ObjectCache
+from treehugger.data import Encrypted, EnvironmentDict
+from treehugger.kms import kms_agent
+from treehugger.ratelimit import RateLimiter
+
+
+def test_check_fork_without_register_at_fork(monkeypatch):
+    monkeypatch.delattr(os, 'register_at_fork', raising=False)
+    monkeypatch.setattr(forking, '_after_fork_funcs', [])
+    calls = []
+    forking.register_after_fork(lambda: calls.append(1))
+
+    forking.check_fork()
+    assert calls == []
+
+    # As if in a forked child
+    monkeypatch.setattr(forking, '_pid', -1)
+    forking.check_fork()
+    forking.check_fork()
+    assert calls == [1]
+
+
+def test_locks_replaced_after_fork(monkeypatch, tmpdir):
+    lazy = EnvironmentDict(A=Encrypted(base64.b64encode(b'b').decode('utf-8'))).decrypt_lazily()
+    monkeypatch.setattr(kms_agent, 'rate_limiter', RateLimiter(10))
+    monkeypatch.setattr(kms_agent, 'persistent_cache', KeyringCache(ttl=60, max_entries=10))
+    monkeypatch.setattr(s3, 'object_cache', ObjectCache(max_bytes=1000, directory=str(tmpdir)))
+    locks = [
+        lambda: lazy._lock,
+        lambda: kms_agent.rate_limiter._lock,
+        lambda: kms_agent.persistent_cache._lock,
+        lambda: kms_agent.persistent_cache._entries_lock,
+        lambda: s3.object_cache._lock,
+    ]
+    # As if other threads held them when the process forked
+    for get_lock in locks:
+        get_lock().acquire()
+
+    try:
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                forking.check_fork()
+                ok = all(get_lock().acquire(blocking=False) for get_lock in locks)
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+    finally:
+        for get_lock in locks:
+            get_lock().release()
+
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
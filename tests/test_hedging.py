@@ -0,0 +1,146 @@
+import base64
+import threading
+import time
+
+import pytest
+
+from treehugger import hedging, messaging
+from treehugger.hedging import Hedger
+from treehugger.kms import kms_agent
+
+
+def slow_then_fast():
+    calls = []
+    lock = threading.Lock()
+
+    def func():
+        with lock:
+            calls.append(None)
+            number = len(calls)
+        if number == 1:
+            time.sleep(0.5)
+            return 'slow'
+        return 'fast'
+
+    return func, calls
+
+
+def test_slow_call_hedged():
+    func, calls = slow_then_fast()
+    hedger = Hedger(delay=0.05)
+
+    assert hedger.call(func) == 'fast'
+    assert len(calls) == 2
+    assert (hedger.calls, hedger.hedges, hedger.wins) == (1, 1, 1)
+
+
+def test_fast_call_not_hedged():
+    hedger = Hedger(delay=0.5)
+
+    assert hedger.call(lambda: 'fast') == 'fast'
+    assert (hedger.calls, hedger.hedges, hedger.wins) == (1, 0, 0)
+
+
+def test_disabled_without_delay():
+    hedger = Hedger()
+
+    assert hedger.get_delay() is None
+    assert hedger.call(lambda: 'fast') == 'fast'
+    assert hedger.hedges == 0
+
+
+def test_hedges_capped():
+    hedger = Hedger(delay=0.01, max_ratio=0.0)
+
+    def slow():
+        time.sleep(0.05)
+        return 'slow'
+
+    assert hedger.call(slow) == 'slow'
+    assert hedger.call(slow) == 'slow'
+    assert (hedger.calls, hedger.hedges) == (2, 1)
+
+
+def test_hedge_lost():
+    hedger = Hedger(delay=0.05)
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.1)
+            return 'first'
+        time.sleep(1.0)
+        return 'second'
+
+    assert hedger.call(func) == 'first'
+    assert (hedger.hedges, hedger.wins) == (1, 0)
+
+
+def test_failed_call_waits_for_hedge():
+    hedger = Hedger(delay=0.05)
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.1)
+            raise ValueError('first')
+        time.sleep(0.1)
+        return 'second'
+
+    assert hedger.call(func) == 'second'
+    assert hedger.wins == 1
+
+
+def test_both_fail_raises_first_exception():
+    hedger = Hedger(delay=0.05)
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.1)
+            raise ValueError('first')
+        raise KeyError('second')
+
+    with pytest.raises(ValueError) as excinfo:
+        hedger.call(func)
+    assert str(excinfo.value) == 'first'
+
+
+def test_percentile_delay(monkeypatch):
+    monkeypatch.setattr(hedging, 'MIN_SAMPLES', 4)
+    hedger = Hedger(delay=2.0, percentile=50)
+    assert hedger.get_delay() == 2.0
+
+    hedger._latencies.extend([0.4, 0.1, 0.3, 0.2])
+
+    assert hedger.get_delay() == 0.3
+
+
+def test_report(capsys, monkeypatch):
+    monkeypatch.setattr(messaging, 'verbose', True)
+    func, calls = slow_then_fast()
+    hedger = Hedger(delay=0.05)
+    hedger.call(func)
+
+    hedger.report()
+
+    out, err = capsys.readouterr()
+    assert 'KMS hedging: 1 of 1 calls hedged, 1 hedges won' in err
+
+
+def test_kms_agent_hedges_decrypt(kms_stub, monkeypatch):
+    monkeypatch.setattr(kms_agent, 'hedger', Hedger(delay=60.0))
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': {'foo': 'bar'},
+        },
+        service_response={'KeyId': 'treehugger', 'Plaintext': b'qux'},
+    )
+
+    assert kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), {'foo': 'bar'}) == 'qux'
+    assert kms_agent.hedger.calls == 1
@@ -0,0 +1,64 @@
+"""
+Regression tests for treehugger's cold start. Importing the CLI, and running
+commands that never touch AWS, should not pay for importing boto3, requests,
+or PyYAML.
+"""
+import os
+import subprocess
+import sys
+import textwrap
+
+HEAVY_MODULES = {'boto3', 'botocore', 'requests', 'urllib3', 'yaml'}
+
+# Cumulative import time budget for treehugger.cli, in microseconds. This is
+# generous compared to the ~10ms it takes today, but far below the ~250ms+
+# that importing boto3 eagerly costs.
+IMPORT_BUDGET_US = int(os.environ.get('TREEHUGGER_IMPORT_BUDGET_US', '100000'))
+
+
+def run_importtime(code):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        cumulative[name.strip()] = int(cumulative_us)
+    return result.stdout, cumulative
+
+
+def test_cli_import_is_light():
+    _, cumulative = run_importtime('import treehugger.cli')
+
+    assert not HEAVY_MODULES & set(cumulative)
+    assert cumulative['treehugger.cli'] < IMPORT_BUDGET_US
+
+
+def test_local_unencrypted_print_skips_aws(tmpdir):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: IGNOREME
+        MY_UNENCRYPTED_VAR: bar
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''))
+    code = textwrap.dedent('''\
+        import sys
+        from treehugger.cli import main
+        main(['print', '-f', {filename!r}, '--only-unencrypted'])
+        print(sorted(m for m in sys.modules if m.split('.')[0] in {heavy!r}))
+    ''').format(filename=str(tmpfile), heavy=HEAVY_MODULES)
+
+    out, _ = run_importtime(code)
+
+    assert 'MY_UNENCRYPTED_VAR=bar' in out
+    imported = out.strip().splitlines()[-1]
+    assert 'boto' not in imported
+    assert 'requests' not in imported
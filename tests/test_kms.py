@@ -1,6 +1,16 @@
 import base64
+import threading
+import time
+from concurrent import futures
+from unittest import mock
 
+import pytest
+from botocore.exceptions import ClientError
+
+from treehugger.cache import FileCache
 from treehugger.kms import kms_agent
+from treehugger.messaging import Fatal, die
+from treehugger.ratelimit import RateLimiter
 
 
 def test_decrypt(kms_stub):
@@ -121,3 +131,322 @@ def test_decrypt_encrypt_context_change_no_cache(kms_stub):
 
     assert isinstance(ciphertext_blob2, str)
     assert ciphertext_blob2 == base64.b64encode(b'quux').decode('utf-8')
+
+
+def test_decrypt_many(kms_stub):
+    context = {'foo': 'bar'}
+    context2 = {'foo': 'bar2'}
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': context
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'qux',
+        }
+    )
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz2',
+            'EncryptionContext': context2
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'qux2',
+        }
+    )
+
+    with mock.patch.object(kms_agent, 'workers', 1):
+        plaintexts = kms_agent.decrypt_many([
+            (base64.b64encode(b'baz').decode('utf-8'), context),
+            (base64.b64encode(b'baz2').decode('utf-8'), context2),
+        ])
+
+    assert plaintexts == ['qux', 'qux2']
+
+
+def test_decrypt_many_concurrent_order():
+    def fake_decrypt(base64_ciphertext, encryption_context):
+        return base64_ciphertext.upper()
+
+    with mock.patch.object(kms_agent, 'workers', 4), \
+            mock.patch.object(kms_agent, 'decrypt', side_effect=fake_decrypt):
+        plaintexts = kms_agent.decrypt_many([('a', {}), ('b', {}), ('c', {})])
+
+    assert plaintexts == ['A', 'B', 'C']
+
+
+def test_encrypt_many_uses_cache(kms_stub):
+    context = {'foo': 'bar'}
+    kms_stub.add_response(
+        'encrypt',
+        expected_params={
+            'KeyId': 'alias/treehugger',
+            'Plaintext': b'baz',
+            'EncryptionContext': context
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'CiphertextBlob': b'qux',
+        }
+    )
+
+    kms_agent.encrypt('baz', context)
+    ciphertexts = kms_agent.encrypt_many([('baz', context)])
+
+    assert ciphertexts == [base64.b64encode(b'qux').decode('utf-8')]
+
+
+def test_get_data_key_generates_once(kms_stub):
+    context = {'foo': 'bar'}
+    kms_stub.add_response(
+        'generate_data_key',
+        expected_params={
+            'KeyId': 'alias/treehugger',
+            'KeySpec': 'AES_256',
+            'EncryptionContext': context,
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+            'CiphertextBlob': b'wrapped',
+        }
+    )
+
+    data_key = kms_agent.get_data_key(context)
+    data_key2 = kms_agent.get_data_key(context)
+
+    assert data_key == (b'k' * 32, base64.b64encode(b'wrapped').decode('utf-8'))
+    assert data_key2 == data_key
+
+
+def test_get_data_key_unwraps_once(kms_stub):
+    context = {'foo': 'bar'}
+    wrapped = base64.b64encode(b'wrapped').decode('utf-8')
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'wrapped',
+            'EncryptionContext': context,
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'k' * 32,
+        }
+    )
+
+    kms_agent.get_data_key(context, wrapped)
+    # Reused for new values under the same context
+    data_key = kms_agent.get_data_key(context)
+
+    assert data_key == (b'k' * 32, wrapped)
+
+
+def test_envelope_encrypt_cached_after_decrypt():
+    context = {'foo': 'bar'}
+    data_key = (b'k' * 32, 'wrapped')
+    ciphertext = kms_agent.envelope_encrypt('baz', context, data_key)
+    kms_agent.reset()
+
+    plaintext = kms_agent.envelope_decrypt(ciphertext, context, data_key)
+
+    assert plaintext == 'baz'
+    assert kms_agent.envelope_encrypt('baz', context, data_key) == ciphertext
+    assert kms_agent.envelope_encrypt('baz', context, (b'k' * 32, 'other')) != ciphertext
+
+
+def test_decrypt_persistent_cache(kms_stub):
+    context = {'foo': 'bar'}
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': context
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'qux',
+        }
+    )
+    ciphertext_blob = base64.b64encode(b'baz').decode('utf-8')
+    persistent_cache = FileCache(ttl=60, max_entries=10)
+
+    with mock.patch.object(kms_agent, 'persistent_cache', persistent_cache):
+        plaintext = kms_agent.decrypt(ciphertext_blob, context)
+        kms_agent.reset()
+        # Served from the persistent cache, no second KMS call
+        plaintext2 = kms_agent.decrypt(ciphertext_blob, context)
+
+    assert plaintext == plaintext2 == 'qux'
+    assert (persistent_cache.hits, persistent_cache.misses) == (1, 1)
+
+
+def test_decrypt_throttled_retries(kms_stub):
+    context = {'foo': 'bar'}
+    kms_stub.add_client_error('decrypt', service_error_code='ThrottlingException')
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': context
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'qux',
+        }
+    )
+    limiter = RateLimiter(rate=100)
+
+    with mock.patch.object(kms_agent, 'rate_limiter', limiter), mock.patch('time.sleep') as mock_sleep:
+        plaintext = kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), context)
+
+    assert plaintext == 'qux'
+    assert limiter.requests == 2
+    assert limiter.throttles == 1
+    assert mock_sleep.call_count == 1
+
+
+def test_decrypt_rate_limited_retries_server_errors(kms_stub):
+    context = {'foo': 'bar'}
+    kms_stub.add_client_error('decrypt', service_error_code='KMSInternalException', http_status_code=500)
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': context
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'qux',
+        }
+    )
+    limiter = RateLimiter(rate=100)
+
+    with mock.patch.object(kms_agent, 'rate_limiter', limiter), mock.patch('time.sleep'):
+        plaintext = kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), context)
+
+    assert plaintext == 'qux'
+    assert limiter.requests == 2
+    # Not throttling, so the rate isn't cut
+    assert limiter.throttles == 0
+
+
+def test_decrypt_rate_limited_no_retry_for_client_errors(kms_stub):
+    kms_stub.add_client_error('decrypt', service_error_code='AccessDeniedException', http_status_code=400)
+    limiter = RateLimiter(rate=100)
+
+    with mock.patch.object(kms_agent, 'rate_limiter', limiter), pytest.raises(ClientError):
+        kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), {'foo': 'bar'})
+
+    assert limiter.requests == 1
+
+
+def test_decrypt_throttled_gives_up(kms_stub):
+    kms_stub.add_client_error('decrypt', service_error_code='ThrottlingException')
+    kms_stub.add_client_error('decrypt', service_error_code='ThrottlingException')
+    limiter = RateLimiter(rate=100)
+
+    with mock.patch.object(kms_agent, 'rate_limiter', limiter), \
+            mock.patch.object(kms_agent, 'max_attempts', 2), \
+            mock.patch('time.sleep'), \
+            pytest.raises(ClientError):
+        kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), {'foo': 'bar'})
+
+    assert limiter.throttles == 2
+
+
+def test_start_jitter_once(kms_stub):
+    for _ in range(2):
+        kms_stub.add_response(
+            'decrypt',
+            service_response={
+                'KeyId': 'treehugger',
+                'Plaintext': b'qux',
+            }
+        )
+
+    with mock.patch.object(kms_agent, 'start_jitter', 2.0), \
+            mock.patch('random.uniform', return_value=1.5), \
+            mock.patch('time.sleep') as mock_sleep:
+        kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), {'foo': 'bar'})
+        kms_agent.decrypt(base64.b64encode(b'baz2').decode('utf-8'), {'foo': 'bar'})
+
+    mock_sleep.assert_called_once_with(1.5)
+
+
+def test_prefetch_decrypts_used(kms_stub):
+    context = {'foo': 'bar'}
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': context
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'qux',
+        }
+    )
+    ciphertext_blob = base64.b64encode(b'baz').decode('utf-8')
+
+    kms_agent.prefetch_decrypts([(ciphertext_blob, context), (ciphertext_blob, context)])
+    futures.wait(kms_agent._prefetched.values(), timeout=5)
+
+    assert kms_agent.decrypt(ciphertext_blob, context) == 'qux'
+    assert (kms_agent.calls, kms_agent.prefetches, kms_agent.prefetches_used) == (1, 1, 1)
+
+
+def test_prefetch_decrypts_failure_raised(kms_stub):
+    kms_stub.add_client_error('decrypt', service_error_code='InvalidCiphertextException')
+    ciphertext_blob = base64.b64encode(b'baz').decode('utf-8')
+
+    kms_agent.prefetch_decrypts([(ciphertext_blob, {'foo': 'bar'})])
+    futures.wait(kms_agent._prefetched.values(), timeout=5)
+
+    with pytest.raises(ClientError):
+        kms_agent.decrypt(ciphertext_blob, {'foo': 'bar'})
+    assert kms_agent.calls == 1
+
+
+def test_warm_up_creates_client(monkeypatch):
+    monkeypatch.setattr(kms_agent, 'kms_client', None)
+    created = threading.Event()
+    client = object()
+
+    def create_client(**config_kwargs):
+        created.set()
+        return client
+
+    monkeypatch.setattr(kms_agent, '_create_client', create_client)
+
+    kms_agent.warm_up()
+
+    assert created.wait(timeout=5)
+    assert kms_agent.kms_client is client
+
+
+def test_warm_up_failure_raised_when_needed(monkeypatch, capsys):
+    monkeypatch.setattr(kms_agent, 'kms_client', None)
+    calls = []
+
+    def create_client(**config_kwargs):
+        calls.append(None)
+        die('No AWS region is configured')
+
+    monkeypatch.setattr(kms_agent, '_create_client', create_client)
+
+    kms_agent.warm_up()
+    for _ in range(100):
+        if kms_agent._warm_up_failure is not None:
+            break
+        time.sleep(0.01)
+
+    with pytest.raises(Fatal):
+        kms_agent.kms_client
+    # die() printed the message once, from the warm up
+    out, err = capsys.readouterr()
+    assert err == 'No AWS region is configured\n'
+    assert len(calls) == 1
@@ -0,0 +1,142 @@
+import base64
+
+import botocore.session
+import pytest
+import requests
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+
+from treehugger import aws, messaging
+from treehugger.ec2 import TOKEN_URL
+from treehugger.kms import kms_agent
+from treehugger.kms_regions import RegionPool, is_failover_error
+
+DECRYPT_RESPONSE = {
+    'KeyId': 'treehugger',
+    'Plaintext': b'qux',
+}
+
+
+@pytest.fixture
+def clients():
+    session = botocore.session.get_session()
+    clients = {
+        region: session.create_client('kms', region_name=region)
+        for region in ('eu-west-1', 'us-east-1', 'ap-southeast-2')
+    }
+    stubbers = {region: Stubber(client) for region, client in clients.items()}
+    for stubber in stubbers.values():
+        stubber.activate()
+    yield clients, stubbers
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def make_pool(clients, local_region='eu-west-1'):
+    return RegionPool(['us-east-1', 'eu-west-1', 'ap-southeast-2'], clients.__getitem__, local_region=local_region)
+
+
+def decrypt(client):
+    return client.decrypt(CiphertextBlob=b'baz')['Plaintext']
+
+
+def test_local_region_first(clients):
+    clients, stubbers = clients
+    stubbers['eu-west-1'].add_response('decrypt', DECRYPT_RESPONSE)
+
+    pool = make_pool(clients)
+
+    assert pool.call(decrypt) == b'qux'
+    assert [region.name for region in pool.ordered()] == ['eu-west-1', 'us-east-1', 'ap-southeast-2']
+
+
+def test_fastest_region_first(clients):
+    clients, stubbers = clients
+    pool = make_pool(clients, local_region=None)
+    pool.regions[1].latency = 0.1
+    pool.regions[2].latency = 0.05
+
+    assert [region.name for region in pool.ordered()] == ['ap-southeast-2', 'eu-west-1', 'us-east-1']
+
+
+def test_failover(clients, monkeypatch, capsys):
+    monkeypatch.setattr(messaging, 'verbose', True)
+    clients, stubbers = clients
+    stubbers['eu-west-1'].add_client_error('decrypt', 'KMSInternalException', http_status_code=500)
+    stubbers['us-east-1'].add_response('decrypt', DECRYPT_RESPONSE)
+    stubbers['us-east-1'].add_response('decrypt', DECRYPT_RESPONSE)
+    pool = make_pool(clients)
+
+    assert pool.call(decrypt) == b'qux'
+    # The failed region is avoided until its cooldown ends
+    assert pool.call(decrypt) == b'qux'
+
+    assert pool.failovers == 1
+    assert [region.name for region in pool.ordered()] == ['us-east-1', 'ap-southeast-2', 'eu-west-1']
+    pool.report()
+    out, err = capsys.readouterr()
+    assert 'KMS in eu-west-1 failed with KMSInternalException, failing over to us-east-1' in err
+    assert 'KMS region us-east-1: 2 calls' in err
+    assert 'KMS region eu-west-1: 0 calls, mean 0.0ms, 1 failures, avoided until cooldown ends' in err
+    assert 'KMS failed over between regions 1 times' in err
+
+
+def test_all_regions_fail(clients):
+    clients, stubbers = clients
+    for stubber in stubbers.values():
+        stubber.add_client_error('decrypt', 'ThrottlingException', http_status_code=400)
+    pool = make_pool(clients)
+
+    with pytest.raises(ClientError):
+        pool.call(decrypt)
+
+    assert pool.failovers == 2
+
+
+def test_no_failover_for_bad_request(clients):
+    clients, stubbers = clients
+    stubbers['eu-west-1'].add_client_error('decrypt', 'InvalidCiphertextException', http_status_code=400)
+    pool = make_pool(clients)
+
+    with pytest.raises(ClientError):
+        pool.call(decrypt)
+
+    assert pool.failovers == 0
+
+
+def test_is_failover_error():
+    assert is_failover_error(EndpointConnectionError(endpoint_url='https://kms.eu-west-1.amazonaws.com'))
+    assert not is_failover_error(ValueError())
+
+
+def test_kms_agent_uses_regions(clients, monkeypatch):
+    clients, stubbers = clients
+    stubbers['eu-west-1'].add_client_error('decrypt', 'KMSInternalException', http_status_code=500)
+    stubbers['us-east-1'].add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'baz',
+            'EncryptionContext': {'foo': 'bar'},
+        },
+        service_response=DECRYPT_RESPONSE,
+    )
+    monkeypatch.setattr(kms_agent, 'regions', ('us-east-1', 'eu-west-1'))
+    monkeypatch.setattr(kms_agent, '_region_pool', make_pool(clients))
+
+    assert kms_agent.decrypt(base64.b64encode(b'baz').decode('utf-8'), {'foo': 'bar'}) == 'qux'
+
+
+def test_kms_agent_regions_without_default_region(monkeypatch, tmpdir, requests_mock):
+    monkeypatch.delenv('AWS_DEFAULT_REGION')
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmpdir.join('missing')))
+    requests_mock.put(TOKEN_URL, exc=requests.exceptions.ConnectTimeout)
+    monkeypatch.setattr(kms_agent, 'regions', ('eu-west-1', 'us-east-1'))
+    aws.reset()
+    try:
+        pool = kms_agent.region_pool
+
+        assert [region.name for region in pool.ordered()] == ['eu-west-1', 'us-east-1']
+        assert [pool._get_client(region).meta.region_name for region in pool.regions] == ['eu-west-1', 'us-east-1']
+    finally:
+        aws.reset()
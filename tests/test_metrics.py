@@ -0,0 +1,139 @@
+import base64
+import socket
+import textwrap
+
+import pytest
+from botocore.exceptions import ClientError
+
+from treehugger import metrics
+from treehugger.cli import main
+
+
+@pytest.fixture
+def registry():
+    metrics.configure(statsd='127.0.0.1:8125')
+    yield metrics._registry
+    metrics.configure()
+
+
+def test_disabled():
+    metrics.configure()
+    metrics.increment('test_total')
+    with metrics.timer('test'):
+        pass
+    assert not metrics.is_enabled()
+    metrics.write()
+
+
+def test_format_prometheus(registry):
+    metrics.increment('test_bytes_total', 10)
+    metrics.increment('test_bytes_total', 5)
+    with metrics.timer('test_requests', path='/a"b'):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer('test_requests', path='/a"b'):
+            raise ValueError()
+
+    lines = metrics.format_prometheus(registry).splitlines()
+
+    assert lines[:5] == [
+        '# TYPE treehugger_test_bytes_total counter',
+        'treehugger_test_bytes_total 15',
+        '# TYPE treehugger_test_requests_total counter',
+        'treehugger_test_requests_total{outcome="error",path="/a\\"b"} 1',
+        'treehugger_test_requests_total{outcome="ok",path="/a\\"b"} 1',
+    ]
+    assert lines[5] == '# TYPE treehugger_test_requests_duration_seconds histogram'
+    assert 'treehugger_test_requests_duration_seconds_bucket{path="/a\\"b",le="+Inf"} 2' in lines
+    assert 'treehugger_test_requests_duration_seconds_count{path="/a\\"b"} 2' in lines
+    assert lines[-2] == '# TYPE treehugger_last_run_timestamp_seconds gauge'
+
+
+def test_histogram_buckets():
+    histogram = metrics.Histogram()
+    histogram.observe(0.02)
+    histogram.observe(20.0)
+    assert histogram.bucket_counts == [0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    assert histogram.count == 2
+
+
+def test_send_statsd(registry):
+    metrics.increment('test_total', operation='decrypt')
+    registry.observe('test_duration_seconds', 0.0125, {})
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+
+        metrics.send_statsd(registry, sock.getsockname())
+
+        packet = sock.recv(65536)
+    assert packet.decode('utf-8').splitlines() == [
+        'treehugger_test_total:1|c|#operation:decrypt',
+        'treehugger_test_duration:12.500|ms',
+    ]
+
+
+def test_parse_statsd_address(capsys):
+    assert metrics.parse_statsd_address('localhost:8125') == ('localhost', 8125)
+    assert metrics.parse_statsd_address('[::1]:8125') == ('::1', 8125)
+    with pytest.raises(SystemExit):
+        metrics.parse_statsd_address('localhost')
+
+    out, err = capsys.readouterr()
+    assert "StatsD address must be like host:port, got 'localhost'" in err
+
+
+def test_print_metrics_textfile(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'foo',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'MY_ENCRYPTED_VAR',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+    textfile = tmpdir.join('treehugger.prom')
+
+    try:
+        main(['--metrics-textfile', str(textfile), 'print', '-f', str(tmpfile)])
+    finally:
+        metrics.configure()
+
+    lines = textfile.read().splitlines()
+    assert 'treehugger_kms_requests_total{operation="decrypt",outcome="ok"} 1' in lines
+    assert 'treehugger_kms_requests_duration_seconds_count{operation="decrypt"} 1' in lines
+
+
+def test_print_metrics_textfile_on_failure(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_client_error('decrypt', service_error_code='AccessDeniedException', http_status_code=400)
+    textfile = tmpdir.join('treehugger.prom')
+
+    try:
+        with pytest.raises(ClientError):
+            main(['--metrics-textfile', str(textfile), 'print', '-f', str(tmpfile)])
+    finally:
+        metrics.configure()
+
+    lines = textfile.read().splitlines()
+    assert 'treehugger_kms_requests_total{operation="decrypt",outcome="error"} 1' in lines
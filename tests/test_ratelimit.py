@@ -0,0 +1,114 @@
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+
+from treehugger.ratelimit import RateLimiter, backoff_delay, is_throttling_error, is_transient_error
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with mock.patch('time.time', new=clock.time), mock.patch('time.sleep', new=clock.sleep):
+        yield clock
+
+
+def test_burst_then_wait(clock):
+    limiter = RateLimiter(rate=2, burst=2)
+
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == pytest.approx(0.5)
+    assert limiter.acquire() == pytest.approx(0.5)
+    assert clock.slept == [pytest.approx(0.5), pytest.approx(0.5)]
+    assert limiter.requests == 4
+    assert limiter.total_wait == pytest.approx(1.0)
+
+
+def test_refills(clock):
+    limiter = RateLimiter(rate=2, burst=1)
+
+    limiter.acquire()
+    clock.now += 10
+    assert limiter.acquire() == 0
+
+
+def test_adapts_to_throttling(clock):
+    limiter = RateLimiter(rate=8)
+
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.rate == 2
+    assert limiter.throttles == 2
+
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(2.4)
+
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 8
+
+
+def test_minimum_rate(clock):
+    limiter = RateLimiter(rate=4)
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.rate == 1
+
+
+def test_shared_lock_file(clock, tmpdir):
+    lock_file = str(tmpdir.join('rate.lock'))
+    limiter = RateLimiter(rate=1, burst=1, lock_file=lock_file)
+    limiter2 = RateLimiter(rate=1, burst=1, lock_file=lock_file)
+
+    assert limiter.acquire() == 0
+    # The other "process" shares the now empty bucket
+    assert limiter2.acquire() == pytest.approx(1.0)
+
+    limiter.on_throttle()
+    limiter2.on_throttle()
+    assert limiter.rate == limiter2.rate == 1
+
+
+def test_backoff_delay():
+    with mock.patch('random.uniform', side_effect=lambda a, b: b):
+        assert backoff_delay(1, max_backoff=5) == pytest.approx(0.1)
+        assert backoff_delay(3, max_backoff=5) == pytest.approx(0.4)
+        assert backoff_delay(10, max_backoff=5) == 5
+
+
+def test_is_throttling_error():
+    throttled = ClientError({'Error': {'Code': 'ThrottlingException'}}, 'Decrypt')
+    denied = ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'Decrypt')
+    assert is_throttling_error(throttled)
+    assert not is_throttling_error(denied)
+    assert not is_throttling_error(ValueError())
+
+
+def test_is_transient_error():
+    internal = ClientError({'Error': {'Code': 'KMSInternalException'}}, 'Decrypt')
+    unavailable = ClientError(
+        {'Error': {'Code': 'Unknown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}},
+        'Decrypt',
+    )
+    denied = ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'Decrypt')
+    assert is_transient_error(internal)
+    assert is_transient_error(unavailable)
+    assert is_transient_error(EndpointConnectionError(endpoint_url='https://kms'))
+    assert is_transient_error(ReadTimeoutError(endpoint_url='https://kms'))
+    assert not is_transient_error(denied)
+    assert not is_transient_error(ValueError())
@@ -1,6 +1,10 @@
+import io
+from unittest import mock
+
 import pytest
 
-from treehugger.s3 import split_s3_url
+from treehugger import limits
+from treehugger.s3 import fetch_s3_content_or_die, split_s3_url
 
 
 def test_split_s3_url():
@@ -18,3 +22,31 @@ def test_incorrect_scheme_split_s3_url():
     test_s3_url = 'https://bucket/key?versionId=7'
     with pytest.raises(SystemExit):
         split_s3_url(test_s3_url)
+
+
+def test_fetch_s3_content_or_die_too_large(s3_stub, monkeypatch, capsys):
+    monkeypatch.setattr(limits, 'max_bytes', 10)
+    s3_stub.add_response(
+        'get_object',
+        expected_params={'Bucket': 'bucket', 'Key': 'key.yml', 'VersionId': '1'},
+        service_response={'Body': io.BytesIO(b'A: ' + b'b' * 20)},
+    )
+    with pytest.raises(SystemExit):
+        fetch_s3_content_or_die('s3://bucket/key.yml?versionId=1')
+
+    out, err = capsys.readouterr()
+    assert 's3://bucket/key.yml?versionId=1 is larger than the limit of 10 bytes' in err
+
+
+def test_fetch_s3_content_or_die_content_length_too_large(s3_stub, monkeypatch, capsys):
+    monkeypatch.setattr(limits, 'max_bytes', 10)
+    body = mock.Mock()
+    s3_stub.add_response(
+        'get_object',
+        expected_params={'Bucket': 'bucket', 'Key': 'key.yml', 'VersionId': '1'},
+        service_response={'Body': body, 'ContentLength': 11},
+    )
+    with pytest.raises(SystemExit):
+        fetch_s3_content_or_die('s3://bucket/key.yml?versionId=1')
+
+    assert not body.read.called
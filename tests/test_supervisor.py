@@ -0,0 +1,177 @@
+import os
+import signal
+import sys
+import textwrap
+import threading
+import time
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from treehugger.supervisor import FORWARDED_SIGNALS, Supervisor, exit_with_status
+
+
+@pytest.fixture(autouse=True)
+def restore_signal_handlers():
+    signums = [signal.SIGHUP] + [getattr(signal, name) for name in FORWARDED_SIGNALS if hasattr(signal, name)]
+    handlers = {signum: signal.getsignal(signum) for signum in signums}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def python_command(code):
+    return [sys.executable, '-c', textwrap.dedent(code)]
+
+
+def send_sighup_when_exists(path):
+    def send():
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGHUP)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    return thread
+
+
+def test_run_returns_exit_status():
+    supervisor = Supervisor(python_command('import os, sys; sys.exit(int(os.environ["A"]))'), load=None)
+    assert supervisor.run({'A': '3'}) == 3
+
+
+def test_sighup_restarts_on_change(tmpdir):
+    output = tmpdir.join('output')
+    command = python_command('''
+        import os, sys, time
+        with open({!r}, 'a') as fp:
+            fp.write(os.environ['A'] + '\\n')
+        if os.environ['A'] == 'c':
+            sys.exit(0)
+        time.sleep(10)
+    '''.format(str(output)))
+    supervisor = Supervisor(command, load=lambda: {'A': 'c'})
+
+    thread = send_sighup_when_exists(str(output))
+    assert supervisor.run({'A': 'b'}) == 0
+    thread.join()
+
+    assert output.read() == 'b\nc\n'
+
+
+def test_reload_interval_sends_signal(tmpdir):
+    ready = tmpdir.join('ready')
+    command = python_command('''
+        import signal, sys, time
+        signal.signal(signal.SIGUSR1, lambda signum, frame: sys.exit(7))
+        open({!r}, 'w').close()
+        time.sleep(10)
+    '''.format(str(ready)))
+    environments = iter([{'A': 'b'}, {'A': 'c'}])
+
+    def load():
+        if not ready.check():
+            return {'A': 'b'}  # not ready for the signal yet
+        return next(environments)
+
+    supervisor = Supervisor(command, load=load, reload_interval=0.05, reload_signal=signal.SIGUSR1)
+
+    assert supervisor.run({'A': 'b'}) == 7
+
+
+def test_forwards_signals(tmpdir):
+    ready = tmpdir.join('ready')
+    command = python_command('''
+        import signal, sys, time
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(5))
+        open({!r}, 'w').close()
+        time.sleep(10)
+    '''.format(str(ready)))
+    supervisor = Supervisor(command, load=None)
+
+    def send():
+        while not ready.check():
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    assert supervisor.run({}) == 5
+    thread.join()
+
+
+def test_reload_unchanged():
+    supervisor = Supervisor(['true'], load=lambda: {'A': 'b'})
+    supervisor.environment = {'A': 'b'}
+    supervisor.child = mock.Mock()
+
+    supervisor.reload()
+
+    assert supervisor.child.mock_calls == []
+
+
+def test_reload_failure_keeps_environment(capsys):
+    def load():
+        raise SystemExit(1)
+
+    supervisor = Supervisor(['true'], load=load, reload_signal=signal.SIGUSR1)
+    supervisor.environment = {'A': 'b'}
+    supervisor.child = mock.Mock()
+
+    supervisor.reload()
+
+    assert supervisor.environment == {'A': 'b'}
+    assert supervisor.child.mock_calls == []
+    out, err = capsys.readouterr()
+    assert 'Reloading failed, keeping the current environment' in err
+
+
+def test_reload_exception_keeps_supervising(tmpdir, capsys):
+    output = tmpdir.join('output')
+    command = python_command('''
+        import os, sys, time
+        with open({!r}, 'a') as fp:
+            fp.write(os.environ['A'] + '\\n')
+        if os.environ['A'] == 'c':
+            sys.exit(0)
+        time.sleep(10)
+    '''.format(str(output)))
+    calls = []
+
+    def load():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'Decrypt')
+        if not output.check():
+            return {'A': 'b'}  # the command hasn't started yet
+        return {'A': 'c'}
+
+    supervisor = Supervisor(command, load=load, reload_interval=0.05)
+
+    assert supervisor.run({'A': 'b'}) == 0
+
+    assert output.read() == 'b\nc\n'
+    out, err = capsys.readouterr()
+    assert 'Reloading failed, keeping the current environment: ClientError' in err
+
+
+def test_command_not_found(capsys):
+    with pytest.raises(SystemExit):
+        Supervisor(['treehugger-test-no-such-command'], load=None).run({})
+
+    out, err = capsys.readouterr()
+    assert 'Command not found: treehugger-test-no-such-command' in err
+
+
+def test_exit_with_status():
+    with pytest.raises(SystemExit) as excinfo:
+        exit_with_status(3)
+    assert excinfo.value.code == 3
+
+    with mock.patch('os.kill') as mock_kill, mock.patch('signal.signal') as mock_signal:
+        with pytest.raises(SystemExit) as excinfo:
+            exit_with_status(-signal.SIGTERM)
+    assert excinfo.value.code == 128 + signal.SIGTERM
+    mock_signal.assert_called_once_with(signal.SIGTERM, signal.SIG_DFL)
+    mock_kill.assert_called_once_with(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,123 @@
+import base64
+import json
+import textwrap
+import threading
+from unittest import mock
+
+import pytest
+
+from treehugger import trace
+from treehugger.cli import main
+
+
+@pytest.fixture
+def trace_file(tmpdir):
+    path = tmpdir.join('trace.jsonl')
+    trace.configure(str(path))
+    yield path
+    trace.configure('')
+
+
+def read_spans(path):
+    return [json.loads(line) for line in path.read().splitlines()]
+
+
+def test_span_disabled():
+    trace.configure('')
+    span = trace.span('test')
+    with span:
+        span.set(foo='bar')
+    assert span is trace.span('other')
+
+
+def test_span_nesting(trace_file):
+    with trace.span('outer', foo='bar'):
+        with trace.span('inner') as span:
+            span.set(size=3)
+
+    inner, outer = read_spans(trace_file)
+    assert inner['name'] == 'inner'
+    assert inner['size'] == 3
+    assert inner['parent_id'] == outer['id']
+    assert outer['name'] == 'outer'
+    assert outer['foo'] == 'bar'
+    assert outer['parent_id'] is None
+    assert outer['duration_ms'] >= inner['duration_ms']
+    assert outer['thread'] == threading.current_thread().name
+
+
+def test_span_error(trace_file):
+    with pytest.raises(ValueError):
+        with trace.span('failing'):
+            raise ValueError()
+
+    span, = read_spans(trace_file)
+    assert span['error'] == 'ValueError'
+
+
+def test_attempt_spans(trace_file):
+    http_response = mock.Mock(status_code=400)
+    with trace.span('kms.decrypt'):
+        trace._on_request_created(request=None, operation_name='Decrypt')
+        trace._on_needs_retry(
+            response=(http_response, {'Error': {'Code': 'ThrottlingException'}}),
+            attempts=1,
+            caught_exception=None,
+        )
+        trace._on_request_created(request=None, operation_name='Decrypt')
+        trace._on_needs_retry(response=(mock.Mock(status_code=200), {}), attempts=2, caught_exception=None)
+
+    first, second, call = read_spans(trace_file)
+    assert first['name'] == 'aws.attempt'
+    assert first['attempt'] == 1
+    assert first['status'] == 400
+    assert first['error'] == 'ThrottlingException'
+    assert first['parent_id'] == call['id']
+    assert second['attempt'] == 2
+    assert 'error' not in second
+
+
+def test_configure_unwritable(tmpdir, capsys):
+    with pytest.raises(SystemExit):
+        trace.configure(str(tmpdir.join('missing', 'trace.jsonl')))
+
+    out, err = capsys.readouterr()
+    assert 'Could not open trace file' in err
+    assert not trace.is_enabled()
+
+
+def test_print_trace(tmpdir, kms_stub, capsys):
+    tmpfile = tmpdir.join('test.yml')
+    tmpfile.write(textwrap.dedent('''\
+        MY_ENCRYPTED_VAR:
+          encrypted: {}
+        TREEHUGGER_APP: baz
+        TREEHUGGER_STAGE: qux
+    '''.format(base64.b64encode(b'foo').decode('utf-8'))))
+    kms_stub.add_response(
+        'decrypt',
+        expected_params={
+            'CiphertextBlob': b'foo',
+            'EncryptionContext': {
+                'treehugger_app': 'baz',
+                'treehugger_key': 'MY_ENCRYPTED_VAR',
+                'treehugger_stage': 'qux',
+            }
+        },
+        service_response={
+            'KeyId': 'treehugger',
+            'Plaintext': b'quux',
+        }
+    )
+    trace_path = tmpdir.join('trace.jsonl')
+
+    try:
+        main(['--trace', str(trace_path), 'print', '-f', str(tmpfile)])
+    finally:
+        trace.configure('')
+
+    out, err = capsys.readouterr()
+    assert out == 'MY_ENCRYPTED_VAR=quux\nTREEHUGGER_APP=baz\nTREEHUGGER_STAGE=qux\n'
+    spans = read_spans(trace_path)
+    assert [span['name'] for span in spans] == ['yaml.safe_load', 'kms.decrypt']
+    assert spans[1]['key'] == 'MY_ENCRYPTED_VAR'
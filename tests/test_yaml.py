@@ -1,6 +1,11 @@
 import io
+from unittest import mock
 
-from treehugger.yaml import include_remote_yaml_data_or_die
+import pytest
+import yaml
+
+from treehugger import yaml as treehugger_yaml
+from treehugger.yaml import get_loader, include_remote_yaml_data_or_die, safe_load, save_fp
 
 
 def test_include_remote_yaml_data_or_die(s3_stub):
@@ -25,3 +30,179 @@ def test_include_remote_yaml_data_or_die(s3_stub):
         'X': 'y',
         'Z': 'zzz',
     }
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    contents = {}
+
+    def fake_fetch(url):
+        return contents[url]
+
+    monkeypatch.setattr(treehugger_yaml, 'fetch_s3_content_or_die', fake_fetch)
+    return contents
+
+
+def test_include_list_later_overrides_earlier(fake_s3):
+    fake_s3['s3://bucket/one.yml'] = b'A: one\nB: one'
+    fake_s3['s3://bucket/two.yml'] = b'B: two'
+    data = {'A': 'local', 'C': 'local', 'include': ['s3://bucket/one.yml', 's3://bucket/two.yml']}
+    assert include_remote_yaml_data_or_die(data) == {'A': 'one', 'B': 'two', 'C': 'local'}
+
+
+def test_include_nested(fake_s3):
+    fake_s3['s3://bucket/one.yml'] = b'include: s3://bucket/two.yml\nA: one\nB: one'
+    fake_s3['s3://bucket/two.yml'] = b'B: two\nC: two'
+    data = {'include': 's3://bucket/one.yml', 'D': 'local'}
+    assert include_remote_yaml_data_or_die(data) == {'A': 'one', 'B': 'two', 'C': 'two', 'D': 'local'}
+
+
+def test_include_shared_document_fetched_once(fake_s3):
+    fake_s3['s3://bucket/one.yml'] = b'include: s3://bucket/common.yml\nA: one'
+    fake_s3['s3://bucket/two.yml'] = b'include: s3://bucket/common.yml\nB: two'
+    fake_s3['s3://bucket/common.yml'] = b'C: common'
+    data = {'include': ['s3://bucket/one.yml', 's3://bucket/two.yml']}
+    with mock.patch.object(treehugger_yaml, 'load_include_or_die', wraps=treehugger_yaml.load_include_or_die) as load:
+        assert include_remote_yaml_data_or_die(data) == {'A': 'one', 'B': 'two', 'C': 'common'}
+    assert load.call_count == 3
+
+
+def test_include_cycle(fake_s3, capsys):
+    fake_s3['s3://bucket/one.yml'] = b'include: s3://bucket/two.yml'
+    fake_s3['s3://bucket/two.yml'] = b'include: s3://bucket/one.yml'
+    with pytest.raises(SystemExit):
+        include_remote_yaml_data_or_die({'include': 's3://bucket/one.yml'})
+    out, err = capsys.readouterr()
+    assert 'Include cycle: s3://bucket/one.yml -> s3://bucket/two.yml -> s3://bucket/one.yml' in err
+
+
+def test_include_depth_limit(fake_s3, monkeypatch, capsys):
+    monkeypatch.setattr(treehugger_yaml, 'max_include_depth', 1)
+    fake_s3['s3://bucket/one.yml'] = b'include: s3://bucket/two.yml'
+    fake_s3['s3://bucket/two.yml'] = b'A: two'
+    with pytest.raises(SystemExit):
+        include_remote_yaml_data_or_die({'include': 's3://bucket/one.yml'})
+    out, err = capsys.readouterr()
+    assert 'Includes are nested more than 1 deep' in err
+
+
+def test_include_not_a_string(capsys):
+    with pytest.raises(SystemExit):
+        include_remote_yaml_data_or_die({'include': ['s3://bucket/one.yml', 1]})
+    out, err = capsys.readouterr()
+    assert "'include' value should be a string or a list of strings" in err
+
+
+def test_include_not_a_dictionary(fake_s3, capsys):
+    fake_s3['s3://bucket/one.yml'] = b'- A\n- B'
+    with pytest.raises(SystemExit):
+        include_remote_yaml_data_or_die({'include': 's3://bucket/one.yml'})
+    out, err = capsys.readouterr()
+    assert 's3://bucket/one.yml is not a YAML dictionary' in err
+
+
+def test_safe_load_max_nodes(monkeypatch, capsys):
+    monkeypatch.setattr(treehugger_yaml, 'max_nodes', 5)
+    assert safe_load('A: b\nC: d') == {'A': 'b', 'C': 'd'}
+    with pytest.raises(SystemExit):
+        safe_load('A: b\nC: d\nE: f', name='test.yml')
+
+    out, err = capsys.readouterr()
+    assert 'test.yml has more than 5 nodes' in err
+
+
+def test_safe_load_alias_expansion(capsys):
+    lines = ['a0: &a0 [lol, lol, lol, lol, lol, lol, lol, lol, lol]']
+    for i in range(1, 9):
+        lines.append('a{i}: &a{i} [{refs}]'.format(i=i, refs=', '.join(['*a{}'.format(i - 1)] * 9)))
+    with pytest.raises(SystemExit):
+        safe_load('\n'.join(lines))
+
+    out, err = capsys.readouterr()
+    assert 'YAML has more than 1000 aliases' in err
+
+
+def test_safe_load_max_aliases(monkeypatch, capsys):
+    monkeypatch.setattr(treehugger_yaml, 'max_aliases', 1)
+    assert safe_load('A: &a b\nC: *a') == {'A': 'b', 'C': 'b'}
+    with pytest.raises(SystemExit):
+        safe_load('A: &a b\nC: *a\nD: *a')
+
+    out, err = capsys.readouterr()
+    assert 'YAML has more than 1 aliases' in err
+
+
+def test_safe_load_recursive_alias(capsys):
+    with pytest.raises(SystemExit):
+        safe_load('A: &a [*a]')
+
+    out, err = capsys.readouterr()
+    assert 'YAML has more than 1000 aliases' in err
+
+
+def test_safe_load_parse_timeout(monkeypatch, capsys):
+    monkeypatch.setattr(treehugger_yaml, 'parse_timeout', -1)
+    with pytest.raises(SystemExit):
+        safe_load('A: b')
+
+    out, err = capsys.readouterr()
+    assert 'YAML took more than -1s to parse' in err
+
+
+def test_safe_load_json_fast_path():
+    with mock.patch('yaml.load') as mock_load:
+        assert safe_load(b'{"A": "b", "C": {"encrypted": "d"}}') == {'A': 'b', 'C': {'encrypted': 'd'}}
+        assert safe_load(' {"A": "b"}') == {'A': 'b'}
+    assert not mock_load.called
+
+
+def test_safe_load_yaml_flow_style():
+    # Valid YAML, but not JSON
+    assert safe_load('{A: b, C: {encrypted: d}}') == {'A': 'b', 'C': {'encrypted': 'd'}}
+
+
+def test_safe_load_file():
+    assert safe_load(io.StringIO('A: b\n')) == {'A': 'b'}
+
+
+def test_safe_load_pure_python_fallback(monkeypatch):
+    monkeypatch.delattr(yaml, 'CSafeLoader', raising=False)
+
+    assert get_loader() is yaml.SafeLoader
+    assert safe_load('A: b\n') == {'A': 'b'}
+
+
+def test_save_fp_identical_output(monkeypatch):
+    data = {
+        'A': 'b',
+        'C': {'to_encrypt': 'ünïcödé ' * 20},
+        'D': {'encrypted': 'x' * 5000},
+        'E': 'multi\nline',
+        'F': '123',
+        'G': 'yes',
+        'H': 'emoji \U0001F600',
+        'I': 'control \x85 \x07 \u2028',
+    }
+    fast = io.StringIO()
+    save_fp(fast, data)
+    monkeypatch.delattr(yaml, 'CSafeDumper', raising=False)
+    slow = io.StringIO()
+    save_fp(slow, data)
+
+    assert fast.getvalue() == slow.getvalue()
+    assert safe_load(fast.getvalue()) == data
+    assert "H: emoji \U0001F600\n" in fast.getvalue()
+
+
+def test_include_envelope_data_keys_kept(fake_s3):
+    fake_s3['s3://bucket/one.yml'] = b'A:\n  envelope_encrypted: one\ntreehugger_data_key: key-one'
+    data = {
+        'B': {'envelope_encrypted': 'local'},
+        'treehugger_data_key': 'key-local',
+        'include': 's3://bucket/one.yml',
+    }
+    assert include_remote_yaml_data_or_die(data) == {
+        'A': {'envelope_encrypted': 'one', 'data_key': 'key-one'},
+        'B': {'envelope_encrypted': 'local', 'data_key': 'key-local'},
+        'treehugger_data_key': 'key-one',
+    }
@@ -1 +1,3 @@
+from .api import LoadError, load_environment  # noqa: F401
+
 __version__ = '3.0.0'
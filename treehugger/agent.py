@@ -0,0 +1,207 @@
+"""
+A host-local agent that loads and decrypts environments once, and serves them
+to `treehugger exec --agent` and `treehugger print --agent` over a Unix
+socket, so only the first process on a host pays for the EC2, S3 and KMS
+calls.
+
+The protocol is one line of JSON each way. Requests are like
+{"data_url": null, "filename": "/path/to/file.yml", "ignore_missing": false}
+and responses are {"environment": {...}, "encrypted_keys": [...]} or
+{"error": "..."}. The encrypted keys let clients apply --only, --prefix and
+--exclude themselves.
+"""
+import contextlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from .data import Encrypted, EnvironmentDict
+from .environment import load_data_or_die
+from .messaging import debug, die
+from .os_ext import get_state_dir, patch_umask
+
+SOCKET_NAME = 'agent.sock'
+MAX_REQUEST_BYTES = 64 * 1024
+
+# Set from global command line arguments, None meaning the state directory
+socket_path = None
+# How long clients wait for a response, which may need a full load
+client_timeout = 30.0
+
+
+def get_socket_path():
+    if socket_path:
+        return socket_path
+    return os.path.join(get_state_dir(), SOCKET_NAME)
+
+
+def fetch_environment(data_url=None, filename=None, ignore_missing=False, key_filter=None):
+    """
+    Return the decrypted environment from the agent, or None if there's no
+    agent or it failed, so the caller can load it directly. Encrypted values
+    rejected by `key_filter` are left out.
+    """
+    path = get_socket_path()
+    request = {
+        'data_url': data_url,
+        'filename': os.path.abspath(filename) if filename else None,
+        'ignore_missing': ignore_missing,
+    }
+    start = time.monotonic()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(client_timeout)
+            sock.connect(path)
+            check_peer(sock)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as fp:
+                line = fp.readline()
+        response = json.loads(line.decode('utf-8'))
+    except (OSError, ValueError) as exc:
+        debug('Could not use the agent at {}: {}'.format(path, exc))
+        return None
+    if 'environment' not in response:
+        debug('The agent at {} failed: {}'.format(path, response.get('error')))
+        return None
+    debug('Fetched the environment from the agent in {:.1f}ms'.format((time.monotonic() - start) * 1000))
+    environment = response['environment']
+    if key_filter is not None:
+        rejected = {key for key in response.get('encrypted_keys', []) if not key_filter(key)}
+        environment = {key: value for key, value in environment.items() if key not in rejected}
+    return environment
+
+
+def check_peer(sock):
+    """
+    Raise PermissionError unless the process at the other end of the socket
+    belongs to the current user. Where SO_PEERCRED isn't available, the
+    private state directory is the only protection.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    if uid != os.getuid():
+        raise PermissionError('Peer is owned by uid {}'.format(uid))
+
+
+class Agent(object):
+    """
+    Loads environments on demand and keeps them for `ttl` seconds. Concurrent
+    requests for the same environment wait for a single load.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get_environment(self, data_url, filename, ignore_missing):
+        """
+        Return the decrypted environment and a list of the keys that were
+        encrypted.
+        """
+        key = (data_url, filename, ignore_missing)
+        with self._lock:
+            entry = self._entries.setdefault(key, _Entry())
+        with entry.lock:
+            if entry.environment is None or entry.expires <= time.monotonic():
+                start = time.monotonic()
+                env_dict = EnvironmentDict.from_yaml_dict(load_data_or_die(data_url, filename, ignore_missing))
+                entry.environment = env_dict.decrypt_all_encrypted(plain=True)
+                entry.encrypted_keys = sorted(key for key, value in env_dict.items() if isinstance(value, Encrypted))
+                entry.expires = time.monotonic() + self.ttl
+                debug('Loaded environment for {} in {:.1f}ms'.format(
+                    data_url or filename or 'EC2 user data',
+                    (time.monotonic() - start) * 1000,
+                ))
+            return entry.environment, entry.encrypted_keys
+
+
+class _Entry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.environment = None
+        self.encrypted_keys = []
+        self.expires = 0.0
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            check_peer(self.request)
+        except PermissionError as exc:
+            debug('Refused agent connection: {}'.format(exc))
+            return
+        try:
+            data_url, filename, ignore_missing = parse_request(self.rfile.readline(MAX_REQUEST_BYTES))
+        except ValueError as exc:
+            response = {'error': 'Invalid request: {}'.format(exc)}
+        else:
+            try:
+                environment, encrypted_keys = self.server.agent.get_environment(data_url, filename, ignore_missing)
+                response = {'environment': environment, 'encrypted_keys': encrypted_keys}
+            except SystemExit:
+                # The reason has been printed on the agent's stderr by die()
+                response = {'error': 'Failed to load the environment'}
+        # The client may have given up waiting
+        with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def parse_request(line):
+    request = json.loads(line.decode('utf-8'))
+    if not isinstance(request, dict):
+        raise ValueError('not a JSON object')
+    data_url = request.get('data_url')
+    filename = request.get('filename')
+    ignore_missing = request.get('ignore_missing', False)
+    if not all(value is None or isinstance(value, str) for value in (data_url, filename)):
+        raise ValueError('data_url and filename must be strings or null')
+    if not isinstance(ignore_missing, bool):
+        raise ValueError('ignore_missing must be a boolean')
+    return data_url, filename, ignore_missing
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(ttl):
+    path = get_socket_path()
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except OSError:
+                os.unlink(path)  # left behind by an agent that was killed
+            else:
+                die('An agent is already listening on {}'.format(path))
+    with patch_umask(0o177):
+        server = _Server(path, _Handler)
+    server.agent = Agent(ttl)
+    return server
+
+
+def serve(ttl):
+    server = make_server(ttl)
+    debug('Agent listening on {}'.format(server.server_address))
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(server.server_address)
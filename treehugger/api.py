@@ -0,0 +1,80 @@
+"""
+Loading environments from Python, without running the treehugger command.
+"""
+import os
+import threading
+import time
+
+from .data import EnvironmentDict
+from .environment import load_data_or_die, load_environment_or_die
+from .forking import check_fork, register_after_fork
+from .messaging import Fatal
+
+_lock = threading.Lock()
+# (data_url, filename, lazy) -> (expiry time or None, environment)
+_cache = {}
+
+
+class LoadError(Exception):
+    """
+    Loading the environment failed, for the reason given in the message.
+    """
+
+
+def load_environment(source=None, ttl=None, lazy=False):
+    """
+    Load and decrypt an environment, returning a dict of its variables.
+
+    `source` is an S3 URL, a path to a file, or None to use the
+    TREEHUGGER_DATA environment variable if it's set and EC2 User Data if
+    not. The result is memoized per source for `ttl` seconds, or for the life
+    of the process if `ttl` is None. Forked processes inherit it, so pre-fork
+    servers can load once in the parent.
+
+    With `lazy`, a read-only data.LazyDecryptedDict is returned instead,
+    which only decrypts values as they're used. It's shared by all callers
+    for the source, and its prefetch() method decrypts a list of keys
+    concurrently.
+
+    Raises LoadError for the errors the treehugger command exits with.
+    """
+    check_fork()
+    data_url, filename = _resolve_source(source)
+    key = (data_url, filename, lazy)
+    with _lock:
+        cached = _cache.get(key)
+        if cached is None or (cached[0] is not None and cached[0] <= time.monotonic()):
+            try:
+                if lazy:
+                    environment = EnvironmentDict.from_yaml_dict(load_data_or_die(data_url, filename)).decrypt_lazily()
+                else:
+                    environment = load_environment_or_die(data_url, filename)
+            except Fatal as exc:
+                raise LoadError(exc.message) from exc
+            expires = None if ttl is None else time.monotonic() + ttl
+            cached = _cache[key] = (expires, environment)
+    if lazy:
+        return cached[1]
+    return dict(cached[1])
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def _resolve_source(source):
+    if source is None:
+        return os.environ.get('TREEHUGGER_DATA'), None
+    if source.startswith('s3://'):
+        return source, None
+    return None, os.path.abspath(source)
+
+
+def _after_fork_in_child():
+    # Another thread may have held the lock when the process forked
+    global _lock
+    _lock = threading.Lock()
+
+
+register_after_fork(_after_fork_in_child)
@@ -0,0 +1,98 @@
+"""
+A single boto3 session shared by every AWS client treehugger creates, so
+credentials and region are resolved once per process, with connection
+settings suited to running on the boot path.
+"""
+import threading
+
+from . import metrics, trace
+from .forking import check_fork, register_after_fork
+from .messaging import die
+
+# Set from global command line arguments
+connect_timeout = 5.0
+read_timeout = 15.0
+retry_mode = 'standard'
+max_attempts = 3
+max_pool_connections = 10
+
+_lock = threading.RLock()
+_session = None
+# The session without a region, once the metadata service has failed to give one
+_regionless_session = None
+
+
+def get_session(require_region=True):
+    """
+    Return the shared session. If no region is configured and the EC2
+    metadata service can't supply one, this dies - unless `require_region` is
+    false, in which case a session without a region is returned, for S3's
+    global endpoint or clients given their own region. That session isn't
+    the shared one, so that later callers needing a region still look for it.
+    """
+    global _session, _regionless_session
+    check_fork()
+    with _lock:
+        if _session is None:
+            if _regionless_session is not None and not require_region:
+                return _regionless_session
+
+            import boto3
+
+            session = boto3.session.Session()
+            if session.region_name is None:
+                from .ec2 import MetadataServiceUnavailable, get_current_region
+
+                try:
+                    region_name = get_current_region()
+                except MetadataServiceUnavailable:
+                    if not require_region:
+                        _regionless_session = session
+                        return session
+                    die('No AWS region is configured, and the EC2 metadata service is unavailable to find one')
+                session = boto3.session.Session(region_name=region_name)
+            # Resolve credentials up front, the session's clients then all share them
+            session.get_credentials()
+            _session = session
+        return _session
+
+
+def create_client(service_name, require_region=True, **config_kwargs):
+    """
+    Create a client from the shared session. `config_kwargs` override the
+    module level connection settings, as botocore Config arguments.
+    `require_region` is passed to get_session().
+    """
+    from botocore.config import Config
+
+    check_fork()
+    kwargs = {
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+        'max_pool_connections': max_pool_connections,
+        'retries': {'mode': retry_mode, 'total_max_attempts': max_attempts},
+    }
+    kwargs.update(config_kwargs)
+    with _lock, trace.span('aws.create_client', service=service_name):
+        client = get_session(require_region).client(service_name, config=Config(**kwargs))
+    if trace.is_enabled():
+        trace.instrument_client(client)
+    if metrics.is_enabled():
+        metrics.instrument_client(client)
+    return client
+
+
+def reset():
+    global _session, _regionless_session
+    with _lock:
+        _session = None
+        _regionless_session = None
+
+
+def _after_fork_in_child():
+    # Another thread may have held the lock when the process forked
+    global _lock
+    _lock = threading.RLock()
+
+
+register_after_fork(_after_fork_in_child)
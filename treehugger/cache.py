@@ -0,0 +1,342 @@
+"""
+Persistent caches of decrypted values, so that restarting `treehugger exec`
+doesn't repeat every KMS call. Entries are keyed by a hash of the ciphertext
+and its encryption context, and expire after a TTL.
+
+Also a cache of versioned S3 objects, which never change so never expire.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from .messaging import die
+from .os_ext import atomic_write, get_state_dir
+
+
+def make_key(base64_ciphertext, encryption_context):
+    blob = json.dumps([base64_ciphertext, encryption_context], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class BaseCache(object):
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._set(key, value)
+
+    def clear(self):
+        """
+        Remove all entries, returning how many there were.
+        """
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _after_fork_in_child(self):
+        # Another thread may have held the lock when the process forked
+        self._lock = threading.Lock()
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+
+class FileCache(BaseCache):
+    """
+    One 0600 file per entry, in a private directory on tmpfs.
+    """
+    name = 'file'
+
+    def __init__(self, ttl, max_entries, directory=None):
+        super().__init__(ttl, max_entries)
+        if directory is None:
+            directory = get_state_dir('cache')
+        self.directory = directory
+
+    def _get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'r') as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] <= time.time():
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            return None
+        return entry['value']
+
+    def _set(self, key, value):
+        self._evict(self.max_entries - 1)
+        entry = {'expires': time.time() + self.ttl, 'value': value}
+        atomic_write(os.path.join(self.directory, key), json.dumps(entry).encode('utf-8'))
+
+    def clear(self):
+        return self._evict(0)
+
+    def _evict(self, keep):
+        """
+        Delete the oldest entries so that at most `keep` remain, returning
+        the number deleted.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            with contextlib.suppress(OSError):
+                entries.append((os.stat(path).st_mtime, path))
+        entries.sort()
+        removed = 0
+        for _, path in entries[:max(0, len(entries) - keep)]:
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+                removed += 1
+        return removed
+
+
+class KeyringCache(BaseCache):
+    """
+    Entries in a "treehugger" keyring linked from the Linux kernel user
+    keyring, via the `keyctl` program from keyutils. The kernel expires them
+    after the TTL itself. The keyring is listed once per process, and each
+    entry's description holds its creation time, so the oldest can be
+    evicted to keep at most max_entries.
+    """
+    name = 'keyring'
+    keyring_name = 'treehugger'
+    prefix = 'treehugger:'
+
+    def __init__(self, ttl, max_entries):
+        super().__init__(ttl, max_entries)
+        self._keyring_id = None
+        # Cache key -> (created in ms, key ID)
+        self._entries = None
+        self._entries_lock = threading.Lock()
+
+    def _after_fork_in_child(self):
+        super()._after_fork_in_child()
+        self._entries_lock = threading.Lock()
+
+    def _get(self, key):
+        entries = self._get_entries()
+        with self._entries_lock:
+            entry = entries.get(key)
+        if entry is None:
+            return None
+        try:
+            return self._keyctl('pipe', entry[1])
+        except subprocess.CalledProcessError:
+            # Expired, or evicted by another process
+            with self._entries_lock:
+                if entries.get(key) == entry:
+                    del entries[key]
+            return None
+
+    def _set(self, key, value):
+        entries = self._get_entries()
+        with self._entries_lock:
+            stale = []
+            if key in entries:
+                stale.append(entries.pop(key)[1])
+            oldest_first = sorted(entries.items(), key=lambda item: item[1])
+            for cache_key, (created, key_id) in oldest_first[:max(0, len(entries) - self.max_entries + 1)]:
+                del entries[cache_key]
+                stale.append(key_id)
+        for key_id in stale:
+            with contextlib.suppress(subprocess.CalledProcessError):
+                self._keyctl('unlink', key_id, self._keyring_id)
+
+        created = int(time.time() * 1000)
+        description = '{}{}:{}'.format(self.prefix, created, key)
+        key_id = self._keyctl('padd', 'user', description, self._keyring_id, input=value).strip()
+        self._keyctl('timeout', key_id, str(int(self.ttl)))
+        with self._entries_lock:
+            entries[key] = (created, key_id)
+
+    def clear(self):
+        entries = self._get_entries()
+        with self._entries_lock:
+            count = len(entries)
+            entries.clear()
+        self._keyctl('clear', self._keyring_id)
+        return count
+
+    def _get_entries(self):
+        with self._entries_lock:
+            if self._entries is None:
+                self._keyring_id = self._find_or_create_keyring()
+                self._entries = self._list_entries()
+            return self._entries
+
+    def _find_or_create_keyring(self):
+        try:
+            return self._keyctl('search', '@u', 'keyring', self.keyring_name).strip()
+        except subprocess.CalledProcessError:
+            return self._keyctl('newring', self.keyring_name, '@u').strip()
+
+    def _list_entries(self):
+        entries = {}
+        for key_id in self._keyctl('rlist', self._keyring_id).split():
+            try:
+                description = self._keyctl('rdescribe', key_id).strip()
+            except subprocess.CalledProcessError:
+                continue  # expired since listing
+            # Format is type;uid;gid;perm;description
+            description = description.split(';', 4)[-1]
+            if not description.startswith(self.prefix):
+                continue
+            created, _, key = description[len(self.prefix):].partition(':')
+            if created.isdigit() and key:
+                entries[key] = (int(created), key_id)
+        return entries
+
+    def _keyctl(self, *args, input=None):
+        try:
+            return subprocess.check_output(
+                ('keyctl',) + args,
+                input=input,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            )
+        except FileNotFoundError:
+            die('The keyring cache requires the "keyctl" program from keyutils')
+
+
+class ObjectCache(object):
+    """
+    Versioned S3 objects, keyed by a hash of their bucket, key and version,
+    in 0600 files in a private directory on tmpfs. Each entry may also have a
+    JSON file holding its parsed form, so hits can skip parsing YAML. The
+    least recently used files are evicted to keep the total under max_bytes.
+    """
+    parsed_suffix = '.json'
+
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        if directory is None:
+            directory = get_state_dir('s3')
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(bucket_name, key, version):
+        blob = json.dumps([bucket_name, key, version], separators=(',', ':'))
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _after_fork_in_child(self):
+        # Another thread may have held the lock when the process forked
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        content = self._read(key)
+        self._count(content is not None)
+        return content
+
+    def get_parsed(self, key):
+        """
+        Only hits are counted, since a miss is followed by a get() of the
+        raw object.
+        """
+        blob = self._read(key + self.parsed_suffix)
+        if blob is None:
+            return None
+        self._count(True)
+        return json.loads(blob.decode('utf-8'))
+
+    def set(self, key, content):
+        self._write(key, content)
+
+    def set_parsed(self, key, data):
+        try:
+            blob = json.dumps(data, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return
+        # Skip anything JSON can't represent exactly, such as integer keys
+        if json.loads(blob) != data:
+            return
+        self._write(key + self.parsed_suffix, blob.encode('utf-8'))
+
+    def clear(self):
+        return self._evict(0)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _read(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as fp:
+                content = fp.read()
+        except OSError:
+            return None
+        # Update the mtime, which eviction treats as the last use
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return content
+
+    def _write(self, name, content):
+        atomic_write(os.path.join(self.directory, name), content)
+        self._evict(self.max_bytes)
+
+    def _evict(self, max_bytes):
+        """
+        Delete the least recently used files until the rest total at most
+        max_bytes, returning the number deleted.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            with contextlib.suppress(OSError):
+                st = os.stat(path)
+                entries.append((st.st_mtime, path, st.st_size))
+                total += st.st_size
+        entries.sort()
+        removed = 0
+        for _, path, size in entries:
+            if total <= max_bytes:
+                break
+            total -= size
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+                removed += 1
+        return removed
+
+
+def keyctl_available():
+    return shutil.which('keyctl') is not None
+
+
+backends = {
+    FileCache.name: FileCache,
+    KeyringCache.name: KeyringCache,
+}
@@ -1,12 +1,21 @@
 import sys
 
+from .. import agent as agent_module
+from .. import aws, ec2, limits, messaging, metrics, s3, trace, yaml
 from ..kms import kms_agent
+from . import utils as cli_utils
+from .agent import agent
+from .cache import cache
 from .decrypt_file import decrypt_file
 from .edit import edit
 from .encrypt_file import encrypt_file
 from .execute import execute
 from .parser import parser
 from .print_out import print_out
+from .utils import (
+    finish, get_hedger, get_object_cache, get_persistent_cache, get_rate_limiter, is_enabled, parse_non_negative_float,
+    parse_non_negative_int, parse_positive_int, parse_regions, parse_retry_mode
+)
 
 
 def main(args_list=None):
@@ -15,14 +24,50 @@ def main(args_list=None):
     args = parser.parse_args(args_list)
 
     # Global arguments
+    messaging.verbose = args.verbose
+    trace.configure(str(args.trace))
+    metrics.configure(str(args.metrics_textfile), str(args.statsd))
+    aws.connect_timeout = parse_non_negative_float(args.aws_connect_timeout, 'AWS connect timeout')
+    aws.read_timeout = parse_non_negative_float(args.aws_read_timeout, 'AWS read timeout')
+    aws.retry_mode = parse_retry_mode(args.aws_retry_mode)
+    aws.max_attempts = parse_positive_int(args.aws_max_attempts, 'AWS max attempts')
+    aws.max_pool_connections = parse_positive_int(args.aws_max_pool_connections, 'AWS max pool connections')
+    ec2.disk_cache = is_enabled(args.imds_cache)
+    ec2.probe_timeout = parse_non_negative_float(args.imds_probe_timeout, 'IMDS probe timeout')
+    ec2.connect_retries = parse_non_negative_int(args.imds_connect_retries, 'IMDS connect retries')
+    ec2.read_retries = parse_non_negative_int(args.imds_read_retries, 'IMDS read retries')
+    ec2.negative_cache_ttl = parse_non_negative_int(args.imds_negative_cache_ttl, 'IMDS negative cache TTL')
     kms_agent.key_id = str(args.key_id)
+    kms_agent.workers = parse_positive_int(args.workers, 'Number of workers')
+    yaml.workers = kms_agent.workers
+    yaml.max_include_depth = parse_positive_int(args.include_depth, 'Include depth')
+    yaml.max_nodes = parse_positive_int(args.yaml_max_nodes, 'YAML max nodes')
+    yaml.max_aliases = parse_non_negative_int(args.yaml_max_aliases, 'YAML max aliases')
+    yaml.parse_timeout = parse_non_negative_float(args.yaml_parse_timeout, 'YAML parse timeout')
+    limits.max_bytes = parse_positive_int(args.max_data_bytes, 'Max data bytes')
+    s3.object_cache = get_object_cache(args)
+    agent_module.socket_path = str(args.agent_socket) or None
+    kms_agent.persistent_cache = get_persistent_cache(args)
+    kms_agent.rate_limiter = get_rate_limiter(args)
+    kms_agent.max_attempts = parse_positive_int(args.kms_max_attempts, 'KMS max attempts')
+    kms_agent.max_backoff = parse_non_negative_float(args.kms_max_backoff, 'KMS max backoff')
+    kms_agent.start_jitter = parse_non_negative_float(args.kms_start_jitter, 'KMS start jitter')
+    kms_agent.regions = parse_regions(args.kms_regions)
+    kms_agent.hedger = get_hedger(args)
 
-    # Call specific function
+    # Call specific function, reporting even if it fails, since the metrics
+    # of failed runs matter most
     func = command_funcs[args.command_name]
-    func(args)
+    cli_utils.finished = False
+    try:
+        func(args)
+    finally:
+        finish()
 
 
 command_funcs = {
+    'agent': agent,
+    'cache': cache,
     'decrypt-file': decrypt_file,
     'edit': edit,
     'encrypt-file': encrypt_file,
@@ -0,0 +1,23 @@
+from .parser import VarOrDefault, subparsers
+from .utils import parse_positive_int
+
+agent_parser = subparsers.add_parser(
+    'agent',
+    description='''
+        Run an agent that loads and decrypts environments once, and serves
+        them to "exec --agent" and "print --agent" over a Unix socket.
+    ''',
+)
+agent_parser.add_argument(
+    '--ttl',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AGENT_TTL', '300'),
+    dest='ttl',
+    help='How long, in seconds, to serve an environment before loading it again.',
+)
+
+
+def agent(args):
+    from .. import agent as agent_module
+
+    agent_module.serve(parse_positive_int(args.ttl, 'Agent TTL'))
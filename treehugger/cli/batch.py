@@ -0,0 +1,112 @@
+"""
+Encrypting or decrypting many files in one process, sharing the KMS agent's
+clients and cache between them.
+"""
+import glob
+import os
+import sys
+import time
+
+from .. import yaml
+from ..data import EnvironmentDict
+from ..kms import kms_agent
+from ..messaging import die
+
+YAML_EXTENSIONS = ('.yml', '.yaml')
+
+# Parse and dump YAML in a process pool when there are at least this many
+# files, since it's CPU bound and threads would contend for the GIL
+PROCESS_POOL_MIN_FILES = 50
+
+
+def expand_paths(paths):
+    """
+    Expand globs and directories, which are searched recursively for YAML
+    files, into a list of filenames without duplicates. Other paths are kept
+    as they are.
+    """
+    filenames = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                die('No files match {}'.format(path))
+        else:
+            matches = [path]
+        for match in matches:
+            if os.path.isdir(match):
+                filenames.extend(find_yaml_files(match))
+            else:
+                filenames.append(match)
+    return list(dict.fromkeys(filenames))
+
+
+def find_yaml_files(directory):
+    filenames = []
+    for dirpath, dirnames, names in os.walk(directory):
+        dirnames.sort()
+        for name in sorted(names):
+            if name.endswith(YAML_EXTENSIONS):
+                filenames.append(os.path.join(dirpath, name))
+    return filenames
+
+
+def transform_files(filenames, transform, value_type, verb):
+    """
+    Load every file, pass the list of their EnvironmentDicts through
+    `transform`, which makes the KMS calls for all of them together, save
+    the results, and print a summary. `value_type` is the class of the values
+    being transformed, to count them.
+    """
+    start = time.monotonic()
+    calls_before = kms_agent.calls
+
+    datas = _map_yaml(yaml.load_file_or_die, filenames)
+    env_dicts = [EnvironmentDict.from_yaml_dict(data) for data in datas]
+    variables = sum(
+        1
+        for env_dict in env_dicts
+        for value in env_dict.values()
+        if isinstance(value, value_type)
+    )
+    new_env_dicts = transform(env_dicts)
+    _map_yaml(_save_file, [
+        (filename, env_dict.to_yaml_dict())
+        for filename, env_dict in zip(filenames, new_env_dicts)
+    ])
+
+    print('Successfully {} {} ({}, {}) in {:.2f}s'.format(
+        verb,
+        _plural(len(filenames), 'file'),
+        _plural(variables, 'variable'),
+        _plural(kms_agent.calls - calls_before, 'KMS call'),
+        time.monotonic() - start,
+    ))
+
+
+def _map_yaml(func, items):
+    if len(items) < PROCESS_POOL_MIN_FILES or kms_agent.workers <= 1:
+        return [func(item) for item in items]
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Fork so the children inherit the YAML limits set from the command line.
+    # Before Python 3.7 the pool can only use the default start method, which
+    # is fork on Unix.
+    pool_kwargs = {'max_workers': min(kms_agent.workers, os.cpu_count() or 1)}
+    if sys.version_info >= (3, 7):
+        pool_kwargs['mp_context'] = multiprocessing.get_context('fork')
+    elif multiprocessing.get_start_method() != 'fork':
+        return [func(item) for item in items]
+    with ProcessPoolExecutor(**pool_kwargs) as executor:
+        return list(executor.map(func, items, chunksize=8))
+
+
+def _save_file(filename_and_data):
+    filename, data = filename_and_data
+    yaml.save_file(filename, data)
+
+
+def _plural(count, noun):
+    return '{} {}{}'.format(count, noun, '' if count == 1 else 's')
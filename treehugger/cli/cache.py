@@ -0,0 +1,20 @@
+from .parser import subparsers
+
+cache_parser = subparsers.add_parser(
+    'cache',
+    description='Manage the caches of decrypted values used with --cache, and S3 objects used with --s3-cache.',
+)
+cache_parser.add_argument('action', choices=['clear'], help='"clear" removes all cached values and objects')
+
+
+def cache(args):
+    from .. import cache as cache_module
+
+    # args.action can only be 'clear' for now
+    removed = 0
+    for name, backend in sorted(cache_module.backends.items()):
+        if name == 'keyring' and not cache_module.keyctl_available():
+            continue
+        removed += backend(ttl=0, max_entries=0).clear()
+    removed += cache_module.ObjectCache(max_bytes=0).clear()
+    print('Removed {} cached values'.format(removed))
@@ -1,18 +1,18 @@
-from .. import yaml
+from ..data import Encrypted, decrypt_all_encrypted_many
+from .batch import expand_paths, transform_files
 from .parser import subparsers
-from .utils import load_and_decrypt_file
 
 decrypt_file_parser = subparsers.add_parser(
     'decrypt-file',
-    description='Decrypt a Treehugger YAML file in-place.',
+    description='Decrypt Treehugger YAML files in-place.',
 )
-decrypt_file_parser.add_argument('filename', type=str, help='The path to the file to decrypt')
+decrypt_file_parser.add_argument('paths', type=str, nargs='+', metavar='path',
+                                 help='The paths of files to decrypt, which may be globs, or directories to search '
+                                      'for .yml and .yaml files')
 
 
 def decrypt_file(args):
-    filename = args.filename
+    def transform(env_dicts):
+        return decrypt_all_encrypted_many(env_dicts)
 
-    new_data = load_and_decrypt_file(filename)
-    yaml.save_file(filename, new_data)
-
-    print('Successfully decrypted')
+    transform_files(expand_paths(args.paths), transform, Encrypted, 'decrypted')
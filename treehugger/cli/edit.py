@@ -13,6 +13,8 @@ edit_parser = subparsers.add_parser(
     description='Decrypt a treehugger YAML file temporarily, edit it with $EDITOR, then re-encrypt it.',
 )
 edit_parser.add_argument('filename', type=str, help='The path to the file to edit')
+edit_parser.add_argument('--envelope', action='store_true',
+                         help='Re-encrypt the file in the envelope format, using a single KMS data key')
 
 
 def edit(args):
@@ -34,7 +36,7 @@ def edit(args):
         print('Editor failed with return code {}'.format(retcode), file=sys.stderr)
         raise SystemExit(1)
 
-    new_data = load_and_encrypt_file(temp_fp.name)
+    new_data = load_and_encrypt_file(temp_fp.name, envelope=args.envelope)
     os.unlink(temp_fp.name)
 
     yaml.save_file(filename, new_data)
@@ -1,18 +1,21 @@
-from .. import yaml
+from ..data import ToEncrypt, encrypt_all_to_encrypt_many
+from .batch import expand_paths, transform_files
 from .parser import subparsers
-from .utils import load_and_encrypt_file
 
 encrypt_file_parser = subparsers.add_parser(
     'encrypt-file',
-    description='Encrypt a Treehugger YAML file in-place.'
+    description='Encrypt Treehugger YAML files in-place.'
 )
-encrypt_file_parser.add_argument('filename', type=str, help='The path to the file to encrypt')
+encrypt_file_parser.add_argument('paths', type=str, nargs='+', metavar='path',
+                                 help='The paths of files to encrypt, which may be globs, or directories to search '
+                                      'for .yml and .yaml files')
+encrypt_file_parser.add_argument('--envelope', action='store_true',
+                                 help='Encrypt values locally under a single KMS data key, so that decrypting the '
+                                      'file takes only one KMS call')
 
 
 def encrypt_file(args):
-    filename = args.filename
+    def transform(env_dicts):
+        return encrypt_all_to_encrypt_many(env_dicts, envelope=args.envelope)
 
-    new_data = load_and_encrypt_file(filename)
-    yaml.save_file(filename, new_data)
-
-    print('Successfully encrypted')
+    transform_files(expand_paths(args.paths), transform, ToEncrypt, 'encrypted')
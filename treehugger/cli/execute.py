@@ -2,12 +2,9 @@ import argparse
 import os
 import sys
 
-from .. import yaml
-from ..data import EnvironmentDict
-from ..ec2 import load_user_data_as_yaml_or_die
-from ..s3 import fetch_s3_content_or_die
-from ..yaml import include_remote_yaml_data_or_die, safe_load
-from .parser import subparsers
+from ..environment import EnvironmentLoader
+from .parser import VarOrDefault, subparsers
+from .utils import add_key_filter_arguments, finish, get_key_filter, is_enabled, parse_non_negative_float, parse_signal
 
 exec_parser = subparsers.add_parser(
     'exec',
@@ -22,6 +19,21 @@ exec_parser.add_argument('command', nargs=argparse.REMAINDER)
 
 exec_parser.add_argument('-i', '--ignore-missing', action='store_true', dest='ignoremissing',
                          help="Don't die if there are no variables")
+exec_parser.add_argument('--agent', action='store_const', const='1', default=VarOrDefault('TREEHUGGER_AGENT', ''),
+                         help='Fetch the variables from "treehugger agent", loading them directly if it fails')
+exec_parser.add_argument('--supervise', action='store_true',
+                         help='Run the command as a child process, reloading the variables on SIGHUP and restarting '
+                              'the command when they change')
+exec_parser.add_argument('--reload-interval', type=str, default=VarOrDefault('TREEHUGGER_RELOAD_INTERVAL', '0'),
+                         help='With --supervise, also reload the variables every this many seconds (default: only '
+                              'on SIGHUP)')
+exec_parser.add_argument('--reload-signal', type=str, default=VarOrDefault('TREEHUGGER_RELOAD_SIGNAL', ''),
+                         help='With --supervise, send this signal to the command when the variables change, rather '
+                              'than restarting it')
+exec_parser.add_argument('--stop-timeout', type=str, default=VarOrDefault('TREEHUGGER_STOP_TIMEOUT', '10'),
+                         help='With --supervise, how long to wait for the command to exit after SIGTERM when '
+                              'restarting it, before sending SIGKILL')
+add_key_filter_arguments(exec_parser)
 
 
 def execute(args):
@@ -33,15 +45,35 @@ def execute(args):
         print('No command to execute provided', file=sys.stderr)
         raise SystemExit(1)
 
-    if url is not None:
-        data = safe_load(fetch_s3_content_or_die(url))
-    else:
-        if args.filename:
-            data = yaml.load_file_or_die(args.filename)
-        else:
-            data = load_user_data_as_yaml_or_die(args.ignoremissing)
-        data = include_remote_yaml_data_or_die(data)
-    env_dict = EnvironmentDict.from_yaml_dict(data)
-    unencrypted_env_dict = env_dict.decrypt_all_encrypted(plain=True)
-    os.environ.update(unencrypted_env_dict)
+    key_filter = get_key_filter(args)
+    loader = EnvironmentLoader(url, args.filename, args.ignoremissing, key_filter)
+
+    def load():
+        environment = None
+        if is_enabled(args.agent):
+            from ..agent import fetch_environment
+
+            environment = fetch_environment(url, args.filename, args.ignoremissing, key_filter)
+        if environment is None:
+            environment = loader.load()
+        return environment
+
+    environment = load()
+    finish()
+
+    if args.supervise:
+        from ..supervisor import Supervisor, exit_with_status
+
+        # Reloads skip the agent, which would return its cached environment
+        # rather than any rotated values
+        supervisor = Supervisor(
+            command,
+            loader.load,
+            reload_interval=parse_non_negative_float(args.reload_interval, 'Reload interval'),
+            reload_signal=parse_signal(args.reload_signal) if str(args.reload_signal) else None,
+            stop_timeout=parse_non_negative_float(args.stop_timeout, 'Stop timeout'),
+        )
+        exit_with_status(supervisor.run(environment))
+
+    os.environ.update(environment)
     os.execlp(command[0], *command)
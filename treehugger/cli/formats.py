@@ -0,0 +1,86 @@
+"""
+Rendering decrypted environments for `treehugger print`, to stdout or to
+files with --output.
+"""
+import json
+import shlex
+
+from ..messaging import die
+
+
+def format_shell(environment, single_line=False):
+    output = [
+        '{}={}'.format(key, shlex.quote(value))
+        for key, value in sorted(environment.items())
+    ]
+    return (' ' if single_line else '\n').join(output)
+
+
+def format_json(environment, single_line=False):
+    indent = None if single_line else 4
+    return json.dumps(environment, indent=indent, sort_keys=True)
+
+
+def format_dotenv(environment, single_line=False):
+    """
+    For .env files as read by docker compose and python-dotenv. Single quoted
+    values are taken literally by both, so they're used wherever possible.
+    Others are double quoted, where some readers expand $ variables.
+    """
+    output = []
+    for key, value in sorted(environment.items()):
+        if "'" not in value and '\n' not in value:
+            output.append("{}='{}'".format(key, value))
+        else:
+            escaped = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            output.append('{}="{}"'.format(key, escaped))
+    return '\n'.join(output)
+
+
+def format_systemd(environment, single_line=False):
+    """
+    For systemd's EnvironmentFile=, where double quoted values can contain
+    newlines, and backslash escapes quotes, backslashes, $ and `.
+    """
+    output = []
+    for key, value in sorted(environment.items()):
+        escaped = ''.join('\\' + char if char in '\\"$`' else char for char in value)
+        output.append('{}="{}"'.format(key, escaped))
+    return '\n'.join(output)
+
+
+def format_docker(environment, single_line=False):
+    """
+    For `docker run --env-file`, which takes everything after the = literally
+    and has no way of writing newlines.
+    """
+    output = []
+    for key, value in sorted(environment.items()):
+        if '\n' in value:
+            die("{} contains a newline, which can't be written to a docker env file".format(key))
+        output.append('{}={}'.format(key, value))
+    return '\n'.join(output)
+
+
+formatters = {
+    'docker': format_docker,
+    'dotenv': format_dotenv,
+    'json': format_json,
+    'shell': format_shell,
+    'systemd': format_systemd,
+}
+
+
+def parse_output(value):
+    """
+    Parse a --output argument like "json:/path/to/file.json" into a
+    (formatter, path) pair. The path "-" means stdout.
+    """
+    name, sep, path = value.partition(':')
+    if not sep or not path:
+        die('Output must be like FORMAT:PATH, got {!r}'.format(value))
+    try:
+        formatter = formatters[name]
+    except KeyError:
+        die('Unknown output format {!r}, choose from: {}'.format(name, ', '.join(sorted(formatters))))
+    return formatter, path
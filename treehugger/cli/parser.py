@@ -31,4 +31,267 @@ parser.add_argument(
     dest='key_id',
     help='The key ID, alias, or ARN to use on KMS for encryption.',
 )
+parser.add_argument(
+    '-w',
+    '--workers',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_WORKERS', '8'),
+    dest='workers',
+    help='The maximum number of concurrent KMS requests to make when encrypting or decrypting.',
+)
+parser.add_argument(
+    '-v',
+    '--verbose',
+    action='store_true',
+    help='Print details of what treehugger is doing to stderr.',
+)
+parser.add_argument(
+    '--cache',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_CACHE', ''),
+    dest='cache',
+    help='Cache decrypted values between runs, in "file" (on tmpfs) or "keyring" (the Linux kernel keyring). '
+         'Disabled by default.',
+)
+parser.add_argument(
+    '--cache-ttl',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_CACHE_TTL', '300'),
+    dest='cache_ttl',
+    help='The number of seconds to keep cached decrypted values for.',
+)
+parser.add_argument(
+    '--cache-max-entries',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_CACHE_MAX_ENTRIES', '1000'),
+    dest='cache_max_entries',
+    help='The maximum number of decrypted values to cache.',
+)
+parser.add_argument(
+    '--kms-rate',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_RATE', ''),
+    dest='kms_rate',
+    help='Limit KMS calls to this many per second, adapting to throttling and retrying throttled calls with '
+         'jittered exponential backoff instead of botocore retries. Unlimited by default.',
+)
+parser.add_argument(
+    '--kms-burst',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_BURST', ''),
+    dest='kms_burst',
+    help='The number of KMS calls allowed in a burst with --kms-rate. Defaults to the rate.',
+)
+parser.add_argument(
+    '--kms-rate-shared',
+    action='store_const',
+    const='1',
+    default=VarOrDefault('TREEHUGGER_KMS_RATE_SHARED', ''),
+    dest='kms_rate_shared',
+    help='Share the --kms-rate budget between all treehugger processes on the host, through a lock file.',
+)
+parser.add_argument(
+    '--kms-max-attempts',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_MAX_ATTEMPTS', '5'),
+    dest='kms_max_attempts',
+    help='The number of attempts to make for throttled KMS calls with --kms-rate.',
+)
+parser.add_argument(
+    '--kms-max-backoff',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_MAX_BACKOFF', '5'),
+    dest='kms_max_backoff',
+    help='The maximum number of seconds to back off for between throttled KMS calls with --kms-rate.',
+)
+parser.add_argument(
+    '--kms-start-jitter',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_START_JITTER', '0'),
+    dest='kms_start_jitter',
+    help='Wait a random time up to this many seconds before the first KMS call, to spread out fleet boots.',
+)
+parser.add_argument(
+    '--kms-hedge-after',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_HEDGE_AFTER', ''),
+    dest='kms_hedge_after',
+    help='Send a duplicate KMS decrypt request if one takes longer than this many seconds, using whichever returns '
+         'first. Disabled by default.',
+)
+parser.add_argument(
+    '--kms-hedge-percentile',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_HEDGE_PERCENTILE', ''),
+    dest='kms_hedge_percentile',
+    help='Send a duplicate KMS decrypt request if one takes longer than this percentile of those seen so far, once '
+         'there are enough, e.g. 95.',
+)
+parser.add_argument(
+    '--kms-hedge-max-ratio',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_HEDGE_MAX_RATIO', '0.1'),
+    dest='kms_hedge_max_ratio',
+    help='The most duplicate KMS requests to send with hedging, as a fraction of all requests.',
+)
+parser.add_argument(
+    '--kms-regions',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_KMS_REGIONS', ''),
+    dest='kms_regions',
+    help='Comma separated regions to call KMS in, for multi-region keys. Calls go to the local or fastest region, '
+         'failing over to the others on errors and timeouts. By default only the current region is used.',
+)
+parser.add_argument(
+    '--aws-connect-timeout',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AWS_CONNECT_TIMEOUT', '5'),
+    dest='aws_connect_timeout',
+    help='The number of seconds to wait when connecting to AWS services.',
+)
+parser.add_argument(
+    '--aws-read-timeout',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AWS_READ_TIMEOUT', '15'),
+    dest='aws_read_timeout',
+    help='The number of seconds to wait for a response from AWS services.',
+)
+parser.add_argument(
+    '--aws-retry-mode',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AWS_RETRY_MODE', 'standard'),
+    dest='aws_retry_mode',
+    help='The botocore retry mode for AWS calls: "legacy", "standard", or "adaptive".',
+)
+parser.add_argument(
+    '--aws-max-attempts',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AWS_MAX_ATTEMPTS', '3'),
+    dest='aws_max_attempts',
+    help='The total number of attempts botocore makes for each AWS call.',
+)
+parser.add_argument(
+    '--aws-max-pool-connections',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AWS_MAX_POOL_CONNECTIONS', '10'),
+    dest='aws_max_pool_connections',
+    help='The maximum number of connections to keep open to each AWS service.',
+)
+parser.add_argument(
+    '--imds-cache',
+    action='store_const',
+    const='1',
+    default=VarOrDefault('TREEHUGGER_IMDS_CACHE', ''),
+    dest='imds_cache',
+    help='Cache the EC2 instance identity document (and so the region) on disk until the next reboot.',
+)
+parser.add_argument(
+    '--imds-probe-timeout',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_IMDS_PROBE_TIMEOUT', '1'),
+    dest='imds_probe_timeout',
+    help='The number of seconds to wait when first checking if the EC2 metadata service is reachable, and when '
+         'connecting to it.',
+)
+parser.add_argument(
+    '--imds-connect-retries',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_IMDS_CONNECT_RETRIES', '2'),
+    dest='imds_connect_retries',
+    help='The number of times to retry connecting to the EC2 metadata service once it has been found reachable.',
+)
+parser.add_argument(
+    '--imds-read-retries',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_IMDS_READ_RETRIES', '3'),
+    dest='imds_read_retries',
+    help='The number of times to retry reading from the EC2 metadata service.',
+)
+parser.add_argument(
+    '--imds-negative-cache-ttl',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_IMDS_NEGATIVE_CACHE_TTL', '600'),
+    dest='imds_negative_cache_ttl',
+    help='The number of seconds to remember that the EC2 metadata service is unreachable for, on machines that '
+         "aren't EC2 instances, so later runs fail immediately. 0 disables this.",
+)
+parser.add_argument(
+    '--include-depth',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_INCLUDE_DEPTH', '5'),
+    dest='include_depth',
+    help='The maximum depth that "include"s may be nested to.',
+)
+parser.add_argument(
+    '--s3-cache',
+    action='store_const',
+    const='1',
+    default=VarOrDefault('TREEHUGGER_S3_CACHE', ''),
+    dest='s3_cache',
+    help='Cache versioned S3 objects, such as includes, on local disk.',
+)
+parser.add_argument(
+    '--s3-cache-max-bytes',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_S3_CACHE_MAX_BYTES', str(16 * 1024 * 1024)),
+    dest='s3_cache_max_bytes',
+    help='The maximum total size of the S3 object cache.',
+)
+parser.add_argument(
+    '--max-data-bytes',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_MAX_DATA_BYTES', str(4 * 1024 * 1024)),
+    dest='max_data_bytes',
+    help='The maximum size of data fetched from S3 or EC2 User Data.',
+)
+parser.add_argument(
+    '--yaml-max-nodes',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_YAML_MAX_NODES', '100000'),
+    dest='yaml_max_nodes',
+    help='The maximum number of nodes in a YAML document, counting aliased nodes each time they are used.',
+)
+parser.add_argument(
+    '--yaml-max-aliases',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_YAML_MAX_ALIASES', '1000'),
+    dest='yaml_max_aliases',
+    help='The maximum number of times aliases may be used in a YAML document.',
+)
+parser.add_argument(
+    '--yaml-parse-timeout',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_YAML_PARSE_TIMEOUT', '5'),
+    dest='yaml_parse_timeout',
+    help='The maximum time, in seconds, to spend parsing a YAML document.',
+)
+parser.add_argument(
+    '--agent-socket',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_AGENT_SOCKET', ''),
+    dest='agent_socket',
+    help='The path of the Unix socket for "treehugger agent", by default in a private directory on tmpfs.',
+)
+parser.add_argument(
+    '--trace',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_TRACE', ''),
+    dest='trace',
+    help='Write timings of the steps treehugger takes as lines of JSON, to this file or "-" for stderr.',
+)
+parser.add_argument(
+    '--metrics-textfile',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_METRICS_TEXTFILE', ''),
+    dest='metrics_textfile',
+    help='Write counts and latencies of KMS, S3 and EC2 metadata calls to this file at the end of the run, for the '
+         'Prometheus node exporter textfile collector.',
+)
+parser.add_argument(
+    '--statsd',
+    type=str,
+    default=VarOrDefault('TREEHUGGER_STATSD', ''),
+    dest='statsd',
+    help='Send counts and latencies of KMS, S3 and EC2 metadata calls to this StatsD host:port at the end of the run.',
+)
 subparsers = parser.add_subparsers(dest='command_name')
@@ -1,19 +1,19 @@
-import json
 import os
-import shlex
 
-from .. import yaml
 from ..data import EnvironmentDict
-from ..ec2 import load_user_data_as_yaml_or_die
-from ..s3 import fetch_s3_content_or_die
-from ..yaml import include_remote_yaml_data_or_die, safe_load
-from .parser import subparsers
+from ..environment import apply_key_filter, load_data_or_die, load_data_overlapped_or_die
+from ..messaging import die
+from ..os_ext import atomic_write
+from .formats import format_json, format_shell, parse_output
+from .parser import VarOrDefault, subparsers
+from .utils import add_key_filter_arguments, get_key_filter, is_enabled
 
 print_parser = subparsers.add_parser(
     'print',
     description='''
         Print all environment variables, from EC2 User Data or a file, as
-        either shell variable assignments (default) or JSON (with --json flag).
+        either shell variable assignments (default) or JSON (with --json flag),
+        or write them to files in several formats with --output.
     ''',
 )
 print_parser.add_argument('-f', '--file', type=str, default=None, dest='filename',
@@ -24,38 +24,54 @@ print_parser.add_argument('--json', action='store_true',
                           help='Output as a JSON object rather than shell variable assignments')
 print_parser.add_argument('--single-line', action='store_true',
                           help='Output all the variables on a single line')
+print_parser.add_argument('--agent', action='store_const', const='1', default=VarOrDefault('TREEHUGGER_AGENT', ''),
+                          help='Fetch the variables from "treehugger agent", loading them directly if it fails')
+print_parser.add_argument('--output', action='append', default=[], dest='outputs', metavar='FORMAT:PATH',
+                          help='Write the variables to PATH, or stdout for "-", in FORMAT: one of docker, dotenv, '
+                               'json, shell, or systemd. May be repeated to write several files from one load')
+add_key_filter_arguments(print_parser)
 
 
 def print_out(args):
     url = os.environ.get('TREEHUGGER_DATA')
-    if url is not None:
-        data = safe_load(fetch_s3_content_or_die(url))
-    else:
-        if args.filename:
-            data = yaml.load_file_or_die(args.filename)
+    # Check these before doing any work
+    outputs = [parse_output(value) for value in args.outputs]
+    if outputs and args.json:
+        die('Use --output json:- rather than --json with --output')
+    key_filter = get_key_filter(args)
+    unencrypted_env_dict = None
+    if is_enabled(args.agent) and not args.only_unencrypted:
+        from ..agent import fetch_environment
+
+        unencrypted_env_dict = fetch_environment(url, args.filename, key_filter=key_filter)
+    if unencrypted_env_dict is None:
+        if args.only_unencrypted:
+            env_dict = EnvironmentDict.from_yaml_dict(load_data_or_die(url, args.filename))
+            unencrypted_env_dict = env_dict.remove_all_encrypted(plain=True)
         else:
-            data = load_user_data_as_yaml_or_die()
-        data = include_remote_yaml_data_or_die(data)
-    env_dict = EnvironmentDict.from_yaml_dict(data)
+            data = load_data_overlapped_or_die(url, args.filename, key_filter=key_filter)
+            env_dict = EnvironmentDict.from_yaml_dict(data)
+            unencrypted_env_dict = apply_key_filter(env_dict, key_filter).decrypt_all_encrypted(plain=True)
 
-    if args.only_unencrypted:
-        unencrypted_env_dict = env_dict.remove_all_encrypted(plain=True)
+    if outputs:
+        write_outputs(outputs, unencrypted_env_dict, args.single_line)
+    elif args.json:
+        print(format_json(unencrypted_env_dict, args.single_line))
     else:
-        unencrypted_env_dict = env_dict.decrypt_all_encrypted(plain=True)
+        print(format_shell(unencrypted_env_dict, args.single_line))
 
-    if args.json:
-        indent = None if args.single_line else 4
-        print(json.dumps(unencrypted_env_dict, indent=indent, sort_keys=True))
-        return
 
-    output = [
-        '{}={}'.format(key, shlex.quote(value))
-        for key, value in sorted(unencrypted_env_dict.items())
+def write_outputs(outputs, environment, single_line):
+    # Render everything first, so nothing is written if any format fails
+    contents = [
+        (path, formatter(environment, single_line) + '\n')
+        for formatter, path in outputs
     ]
-
-    if args.single_line:
-        joiner = ' '
-    else:
-        joiner = '\n'
-
-    print(joiner.join(output))
+    for path, content in contents:
+        if path == '-':
+            print(content, end='')
+        else:
+            try:
+                atomic_write(path, content.encode('utf-8'), mode=0o600)
+            except OSError as exc:
+                die('Could not write {}: {}'.format(path, exc.strerror))
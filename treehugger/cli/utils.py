@@ -1,5 +1,10 @@
-from .. import yaml
-from ..data import EnvironmentDict
+import os
+
+from .. import metrics, s3, yaml
+from ..data import EnvironmentDict, KeyFilter
+from ..kms import kms_agent
+from ..messaging import die
+from ..os_ext import get_state_dir
 
 
 def load_and_decrypt_file(filename):
@@ -10,9 +15,171 @@ def load_and_decrypt_file(filename):
     return unencrypted_env_dict.to_yaml_dict()
 
 
-def load_and_encrypt_file(filename):
+def load_and_encrypt_file(filename, envelope=False):
     data = yaml.load_file_or_die(filename)
 
     env_dict = EnvironmentDict.from_yaml_dict(data)
-    encrypted_env_dict = env_dict.encrypt_all_to_encrypt()
+    encrypted_env_dict = env_dict.encrypt_all_to_encrypt(envelope=envelope)
     return encrypted_env_dict.to_yaml_dict()
+
+
+def parse_positive_int(value, description):
+    value = str(value)
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        die('{} must be a positive integer, got {!r}'.format(description, value))
+    return number
+
+
+def parse_non_negative_float(value, description):
+    value = str(value)
+    try:
+        number = float(value)
+    except ValueError:
+        number = -1
+    if not number >= 0:
+        die('{} must be a non-negative number, got {!r}'.format(description, value))
+    return number
+
+
+def parse_non_negative_int(value, description):
+    value = str(value)
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        die('{} must be a non-negative integer, got {!r}'.format(description, value))
+    return number
+
+
+def parse_retry_mode(value):
+    value = str(value)
+    if value not in ('legacy', 'standard', 'adaptive'):
+        die('AWS retry mode must be one of legacy, standard, or adaptive, got {!r}'.format(value))
+    return value
+
+
+def parse_signal(value):
+    import signal
+
+    value = str(value)
+    name = value.upper()
+    if not name.startswith('SIG'):
+        name = 'SIG' + name
+    try:
+        if value.isdigit():
+            return signal.Signals(int(value))
+        return signal.Signals[name]
+    except (KeyError, ValueError):
+        die('Unknown signal {!r}'.format(value))
+
+
+def parse_regions(value):
+    regions = [region.strip() for region in str(value).split(',') if region.strip()]
+    return tuple(dict.fromkeys(regions))
+
+
+def is_enabled(value):
+    return str(value).lower() not in ('', '0', 'false', 'no')
+
+
+def add_key_filter_arguments(parser):
+    parser.add_argument('--only', action='append', default=[], metavar='KEY,...',
+                        help='Only decrypt these encrypted variables, leaving out the others. May be repeated')
+    parser.add_argument('--prefix', action='append', default=[],
+                        help='Only decrypt encrypted variables whose names start with this, leaving out the others. '
+                             'May be repeated, and combined with --only')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help="Don't decrypt encrypted variables whose names match this glob pattern, leaving them "
+                             "out. May be repeated")
+
+
+def get_key_filter(args):
+    only = [key.strip() for value in args.only for key in value.split(',') if key.strip()]
+    if not (only or args.prefix or args.exclude):
+        return None
+    return KeyFilter(only=only, prefixes=args.prefix, excludes=args.exclude)
+
+
+def get_persistent_cache(args):
+    name = str(args.cache)
+    if not name:
+        return None
+
+    from .. import cache
+
+    try:
+        backend = cache.backends[name]
+    except KeyError:
+        die('Unknown cache {!r}, choose from: {}'.format(name, ', '.join(sorted(cache.backends))))
+    return backend(
+        ttl=parse_positive_int(args.cache_ttl, 'Cache TTL'),
+        max_entries=parse_positive_int(args.cache_max_entries, 'Cache max entries'),
+    )
+
+
+def get_rate_limiter(args):
+    if not str(args.kms_rate):
+        return None
+    rate = parse_non_negative_float(args.kms_rate, 'KMS rate')
+    if rate == 0:
+        die('KMS rate must be greater than zero')
+    burst = None
+    if str(args.kms_burst):
+        burst = parse_positive_int(args.kms_burst, 'KMS burst')
+    lock_file = None
+    if is_enabled(args.kms_rate_shared):
+        lock_file = os.path.join(get_state_dir(), 'kms-rate.lock')
+
+    from ..ratelimit import RateLimiter
+
+    return RateLimiter(rate, burst=burst, lock_file=lock_file)
+
+
+def get_hedger(args):
+    if not (str(args.kms_hedge_after) or str(args.kms_hedge_percentile)):
+        return None
+    delay = 0.0
+    if str(args.kms_hedge_after):
+        delay = parse_non_negative_float(args.kms_hedge_after, 'KMS hedge after')
+    percentile = None
+    if str(args.kms_hedge_percentile):
+        percentile = parse_non_negative_float(args.kms_hedge_percentile, 'KMS hedge percentile')
+        if not 0 < percentile < 100:
+            die('KMS hedge percentile must be between 0 and 100, got {!r}'.format(str(args.kms_hedge_percentile)))
+    max_ratio = parse_non_negative_float(args.kms_hedge_max_ratio, 'KMS hedge max ratio')
+
+    from ..hedging import Hedger
+
+    return Hedger(delay=delay, percentile=percentile, max_ratio=max_ratio)
+
+
+def get_object_cache(args):
+    if not is_enabled(args.s3_cache):
+        return None
+
+    from ..cache import ObjectCache
+
+    return ObjectCache(max_bytes=parse_non_negative_int(args.s3_cache_max_bytes, 'S3 cache max bytes'))
+
+
+# Whether finish() has run for the current command
+finished = False
+
+
+def finish():
+    """
+    Report on the run, just before exiting or replacing the process. Only the
+    first call for each command does anything.
+    """
+    global finished
+    if finished:
+        return
+    finished = True
+    kms_agent.report()
+    s3.report()
+    metrics.write()
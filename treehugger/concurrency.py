@@ -0,0 +1,61 @@
+import queue
+import threading
+
+
+def map_in_order(func, items, workers):
+    """
+    Call `func` on every item using up to `workers` threads and return the
+    results in the same order as `items`.
+
+    All calls are allowed to finish before anything is raised; if any failed,
+    the exception from the earliest item is the one re-raised, so errors don't
+    depend on thread scheduling.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+    return [future.result() for future in futures]
+
+
+class BackgroundPool(object):
+    """
+    Runs functions on up to `workers` daemon threads, started as needed, so
+    work that turns out not to be needed doesn't hold up exiting. submit()
+    returns a concurrent.futures.Future, which can be cancelled until the
+    function starts.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func):
+        from concurrent.futures import Future
+
+        future = Future()
+        self._queue.put((future, func))
+        with self._lock:
+            if self._threads < self.workers:
+                self._threads += 1
+                threading.Thread(target=self._work, name='background', daemon=True).start()
+        return future
+
+    def _work(self):
+        while True:
+            future, func = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func()
+            except BaseException as exc:
+                # Including SystemExit from die(), so waiting callers get it
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
@@ -1,8 +1,23 @@
+import fnmatch
+import threading
+import weakref
+from collections.abc import Mapping
+
+from .concurrency import map_in_order
+from .forking import check_fork, register_after_fork
 from .kms import kms_agent
 
+DATA_KEY_KEY = 'treehugger_data_key'
+# Set on envelope encrypted values from included documents, whose data key
+# can differ from the including document's
+VALUE_DATA_KEY_KEY = 'data_key'
+
 
 class EnvironmentDict(dict):
 
+    # Base64 KMS ciphertext of the data key for envelope encrypted values
+    wrapped_data_key = None
+
     @classmethod
     def from_yaml_dict(cls, obj):
         """
@@ -22,11 +37,19 @@ class EnvironmentDict(dict):
         new = EnvironmentDict()
         for key, value in obj.items():
             assert isinstance(key, str), "Keys must be strings in treehugger data"
+            if key == DATA_KEY_KEY:
+                assert isinstance(value, str), "{} must be a string".format(DATA_KEY_KEY)
+                new.wrapped_data_key = value
+                continue
             if isinstance(value, dict):
                 if 'to_encrypt' in value:
                     new_value = ToEncrypt(value['to_encrypt'])
                 elif 'encrypted' in value:
                     new_value = Encrypted(value['encrypted'])
+                elif 'envelope_encrypted' in value:
+                    new_value = EnvelopeEncrypted(value['envelope_encrypted'], value.get(VALUE_DATA_KEY_KEY))
+                else:
+                    raise ValueError('Invalid object in treehugger data: {}'.format(value))
             elif isinstance(value, str):
                 new_value = value
             else:
@@ -41,44 +64,77 @@ class EnvironmentDict(dict):
                 new[key] = value
             elif isinstance(value, ToEncrypt):
                 new[key] = {'to_encrypt': value.plaintext}
+            elif isinstance(value, EnvelopeEncrypted):
+                new[key] = {'envelope_encrypted': value.base64_ciphertext}
+                if value.wrapped_data_key not in (None, self.wrapped_data_key):
+                    new[key][VALUE_DATA_KEY_KEY] = value.wrapped_data_key
             elif isinstance(value, Encrypted):
                 new[key] = {'encrypted': value.base64_ciphertext}
             else:
                 raise ValueError("Invalid object in EnvironmentDict: {}".format(value))
+        if self.wrapped_data_key is not None:
+            new[DATA_KEY_KEY] = self.wrapped_data_key
         return new
 
     def decrypt_all_encrypted(self, plain=False):
-        base_encryption_context = self.get_base_encryption_context()
-        new = EnvironmentDict()
-        for key, value in self.items():
-            if isinstance(value, Encrypted):
-                encryption_context = base_encryption_context.copy()
-                encryption_context['treehugger_key'] = key
-                plaintext = kms_agent.decrypt(value.base64_ciphertext, encryption_context)
-                if plain:
-                    new[key] = plaintext
-                else:
-                    new[key] = ToEncrypt(plaintext)
-            elif isinstance(value, ToEncrypt):
-                if plain:
-                    new[key] = value.plaintext
-                else:
-                    new[key] = value
-            else:
-                new[key] = value
-        return new
+        return decrypt_all_encrypted_many([self], plain)[0]
 
-    def encrypt_all_to_encrypt(self):
+    def decrypt_values(self, keys):
+        """
+        Decrypt the Encrypted values under `keys`, returning a dict of their
+        plaintexts. KMS values are decrypted concurrently, and envelope
+        encrypted values share one data key per wrapped key.
+        """
         base_encryption_context = self.get_base_encryption_context()
+        kms_keys = [key for key in keys if not isinstance(self[key], EnvelopeEncrypted)]
+        plaintexts = kms_agent.decrypt_many(
+            (self[key].base64_ciphertext, self.get_encryption_context(key, base_encryption_context))
+            for key in kms_keys
+        )
+        decrypted = dict(zip(kms_keys, plaintexts))
+
+        envelope_keys = [key for key in keys if isinstance(self[key], EnvelopeEncrypted)]
+        data_keys = {}
+        for key in envelope_keys:
+            wrapped_data_key = self[key].wrapped_data_key or self.wrapped_data_key
+            if wrapped_data_key is None:
+                raise ValueError('Missing {}'.format(DATA_KEY_KEY))
+            if wrapped_data_key not in data_keys:
+                data_keys[wrapped_data_key] = kms_agent.get_data_key(base_encryption_context, wrapped_data_key)
+            decrypted[key] = kms_agent.envelope_decrypt(
+                self[key].base64_ciphertext,
+                self.get_encryption_context(key, base_encryption_context),
+                data_keys[wrapped_data_key],
+            )
+        return decrypted
+
+    def decrypt_lazily(self):
+        """
+        Return a read-only LazyDecryptedDict of the plain values, which only
+        decrypts values as they're used.
+        """
+        return LazyDecryptedDict(self)
+
+    def encrypt_all_to_encrypt(self, envelope=False):
+        """
+        Encrypt all ToEncrypt values. With `envelope`, or if the data already
+        uses the envelope format, values are encrypted locally under a single
+        KMS data key rather than with one KMS call each.
+        """
+        return encrypt_all_to_encrypt_many([self], envelope)[0]
+
+    def select_encrypted(self, key_filter):
+        """
+        Return a copy without the Encrypted values whose keys `key_filter`
+        rejects, so they're never decrypted. Other values are all kept, since
+        TREEHUGGER_APP and TREEHUGGER_STAGE are needed to decrypt.
+        """
         new = EnvironmentDict()
+        new.wrapped_data_key = self.wrapped_data_key
         for key, value in self.items():
-            if isinstance(value, ToEncrypt):
-                encryption_context = base_encryption_context.copy()
-                encryption_context['treehugger_key'] = key
-                base64_ciphertext = kms_agent.encrypt(value.plaintext, encryption_context)
-                new[key] = Encrypted(base64_ciphertext)
-            else:
-                new[key] = value
+            if isinstance(value, Encrypted) and not key_filter(key):
+                continue
+            new[key] = value
         return new
 
     def remove_all_encrypted(self, plain=False):
@@ -106,6 +162,259 @@ class EnvironmentDict(dict):
             'treehugger_stage': stage,
         }
 
+    def get_data_key(self, base_encryption_context=None):
+        """
+        Get the data key for the envelope format. The existing wrapped key
+        must be used whilst any values are encrypted under it, otherwise any
+        key already loaded for the same encryption context is reused.
+        """
+        if base_encryption_context is None:
+            base_encryption_context = self.get_base_encryption_context()
+        if any(isinstance(value, EnvelopeEncrypted) for value in self.values()):
+            if self.wrapped_data_key is None:
+                raise ValueError('Missing {}'.format(DATA_KEY_KEY))
+            return kms_agent.get_data_key(base_encryption_context, self.wrapped_data_key)
+        return kms_agent.get_data_key(base_encryption_context)
+
+    def get_encryption_context(self, key, base_encryption_context=None):
+        if base_encryption_context is None:
+            base_encryption_context = self.get_base_encryption_context()
+        encryption_context = base_encryption_context.copy()
+        encryption_context['treehugger_key'] = key
+        return encryption_context
+
+
+def decrypt_all_encrypted_many(env_dicts, plain=False):
+    """
+    decrypt_all_encrypted() for several EnvironmentDicts, with all their KMS
+    values in one kms_agent.decrypt_many(), so no more than `workers` KMS
+    calls are in flight between them.
+    """
+    env_dicts = list(env_dicts)
+    base_encryption_contexts = [env_dict.get_base_encryption_context() for env_dict in env_dicts]
+    owners = []
+    items = []
+    for index, env_dict in enumerate(env_dicts):
+        for key, value in env_dict.items():
+            if isinstance(value, Encrypted) and not isinstance(value, EnvelopeEncrypted):
+                owners.append((index, key))
+                items.append((
+                    value.base64_ciphertext,
+                    env_dict.get_encryption_context(key, base_encryption_contexts[index]),
+                ))
+    decrypted = [{} for env_dict in env_dicts]
+    for (index, key), plaintext in zip(owners, kms_agent.decrypt_many(items)):
+        decrypted[index][key] = plaintext
+
+    def decrypt_envelope(index):
+        # One KMS call per data key, usually one per file
+        env_dict = env_dicts[index]
+        decrypted[index].update(env_dict.decrypt_values([
+            key for key, value in env_dict.items() if isinstance(value, EnvelopeEncrypted)
+        ]))
+
+    map_in_order(decrypt_envelope, range(len(env_dicts)), kms_agent.workers)
+
+    news = []
+    for env_dict, env_decrypted in zip(env_dicts, decrypted):
+        new = EnvironmentDict()
+        new.wrapped_data_key = env_dict.wrapped_data_key
+        for key, value in env_dict.items():
+            if isinstance(value, Encrypted):
+                plaintext = env_decrypted[key]
+                if plain:
+                    new[key] = plaintext
+                else:
+                    new[key] = ToEncrypt(plaintext)
+            elif isinstance(value, ToEncrypt):
+                if plain:
+                    new[key] = value.plaintext
+                else:
+                    new[key] = value
+            else:
+                new[key] = value
+        news.append(new)
+    return news
+
+
+def encrypt_all_to_encrypt_many(env_dicts, envelope=False):
+    """
+    encrypt_all_to_encrypt() for several EnvironmentDicts, with all their
+    values not in the envelope format in one kms_agent.encrypt_many(), so no
+    more than `workers` KMS calls are in flight between them.
+    """
+    env_dicts = list(env_dicts)
+    base_encryption_contexts = [env_dict.get_base_encryption_context() for env_dict in env_dicts]
+    wrapped_data_keys = [env_dict.wrapped_data_key for env_dict in env_dicts]
+    encrypted = [{} for env_dict in env_dicts]
+    owners = []
+    items = []
+    envelope_indexes = []
+    for index, env_dict in enumerate(env_dicts):
+        to_encrypt_keys = [key for key, value in env_dict.items() if isinstance(value, ToEncrypt)]
+        if not to_encrypt_keys:
+            continue
+        if envelope or env_dict.wrapped_data_key is not None:
+            envelope_indexes.append(index)
+            continue
+        for key in to_encrypt_keys:
+            owners.append((index, key))
+            items.append((
+                env_dict[key].plaintext,
+                env_dict.get_encryption_context(key, base_encryption_contexts[index]),
+            ))
+    for (index, key), ciphertext in zip(owners, kms_agent.encrypt_many(items)):
+        encrypted[index][key] = Encrypted(ciphertext)
+
+    def encrypt_envelope(index):
+        env_dict = env_dicts[index]
+        base_encryption_context = base_encryption_contexts[index]
+        # One KMS call, if the data key isn't already loaded
+        data_key = env_dict.get_data_key(base_encryption_context)
+        wrapped_data_keys[index] = data_key[1]
+        for key, value in env_dict.items():
+            if isinstance(value, ToEncrypt):
+                encrypted[index][key] = EnvelopeEncrypted(kms_agent.envelope_encrypt(
+                    value.plaintext,
+                    env_dict.get_encryption_context(key, base_encryption_context),
+                    data_key,
+                ))
+
+    map_in_order(encrypt_envelope, envelope_indexes, kms_agent.workers)
+
+    news = []
+    for index, env_dict in enumerate(env_dicts):
+        new = EnvironmentDict()
+        new.wrapped_data_key = wrapped_data_keys[index]
+        for key, value in env_dict.items():
+            new[key] = encrypted[index].get(key, value)
+        news.append(new)
+    return news
+
+
+class KeyFilter(object):
+    """
+    Selects keys that are in `only` or start with one of `prefixes` - or all
+    keys, if neither is given - and don't match any of the glob patterns in
+    `excludes`.
+    """
+
+    def __init__(self, only=(), prefixes=(), excludes=()):
+        self.only = frozenset(only)
+        self.prefixes = tuple(prefixes)
+        self.excludes = tuple(excludes)
+
+    def __call__(self, key):
+        if (self.only or self.prefixes) and key not in self.only and not key.startswith(self.prefixes):
+            return False
+        return not any(fnmatch.fnmatchcase(key, pattern) for pattern in self.excludes)
+
+
+class LazyDecryptedDict(Mapping):
+    """
+    A read-only mapping of an EnvironmentDict's variables to their plain
+    values, decrypting each encrypted value the first time it's accessed, so
+    callers that use a few variables only pay for their KMS calls.
+
+    Iterating over it, keys() and membership tests don't decrypt anything.
+    items() and values(), which equality uses, decrypt all the values not yet
+    decrypted concurrently first, so dict(lazy.items()) is the fast way to
+    copy it.
+    """
+
+    def __init__(self, env_dict):
+        self._env_dict = env_dict
+        self._decrypted = {}
+        # Keys being decrypted -> Event set when their decryption finishes
+        self._pending = {}
+        self._lock = threading.Lock()
+        _lazy_dicts[id(self)] = self
+
+    def __getitem__(self, key):
+        value = self._env_dict[key]
+        if isinstance(value, Encrypted):
+            self.prefetch([key])
+            return self._decrypted[key]
+        elif isinstance(value, ToEncrypt):
+            return value.plaintext
+        return value
+
+    def __iter__(self):
+        return iter(self._env_dict)
+
+    def __len__(self):
+        return len(self._env_dict)
+
+    def __contains__(self, key):
+        return key in self._env_dict
+
+    def __repr__(self):
+        # Don't decrypt, or print secrets
+        return '<{} with keys {}>'.format(self.__class__.__name__, sorted(self._env_dict))
+
+    def items(self):
+        self.prefetch()
+        return super().items()
+
+    def values(self):
+        self.prefetch()
+        return super().values()
+
+    def prefetch(self, keys=None):
+        """
+        Decrypt the values of `keys`, or all keys if None, concurrently,
+        skipping any already decrypted, and waiting for any that other threads
+        are decrypting. The lock is only held to choose and record keys, so
+        threads decrypting different keys don't wait on each other.
+        """
+        check_fork()
+        if keys is None:
+            keys = list(self._env_dict)
+        while True:
+            with self._lock:
+                missing = [
+                    key for key in keys
+                    if isinstance(self._env_dict[key], Encrypted) and key not in self._decrypted
+                ]
+                to_decrypt = [key for key in missing if key not in self._pending]
+                waiting = {self._pending[key] for key in missing if key in self._pending}
+                done = threading.Event()
+                for key in to_decrypt:
+                    self._pending[key] = done
+
+            if to_decrypt:
+                decrypted = {}
+                try:
+                    decrypted = self._env_dict.decrypt_values(to_decrypt)
+                finally:
+                    with self._lock:
+                        self._decrypted.update(decrypted)
+                        for key in to_decrypt:
+                            del self._pending[key]
+                    done.set()
+
+            if not waiting:
+                return
+            # Then check again, decrypting here any whose other thread failed
+            for event in waiting:
+                event.wait()
+
+
+# Every LazyDecryptedDict by id, since they're unhashable, for resetting their
+# locks after forking
+_lazy_dicts = weakref.WeakValueDictionary()
+
+
+def _after_fork_in_child():
+    # Another thread may have held a lock, or been decrypting, when the
+    # process forked. Decryptions it started are done again if needed.
+    for lazy_dict in list(_lazy_dicts.values()):
+        lazy_dict._lock = threading.Lock()
+        lazy_dict._pending = {}
+
+
+register_after_fork(_after_fork_in_child)
+
 
 class ToEncrypt(object):
     def __init__(self, plaintext):
@@ -127,3 +436,18 @@ class Encrypted(object):
         return (
             self.__class__ is other.__class__ and self.base64_ciphertext == other.base64_ciphertext
         )
+
+
+class EnvelopeEncrypted(Encrypted):
+    """
+    A value encrypted locally under a data key: its own `wrapped_data_key` if
+    it came from an included document, otherwise its EnvironmentDict's.
+    """
+
+    def __init__(self, base64_ciphertext, wrapped_data_key=None):
+        super().__init__(base64_ciphertext)
+        assert wrapped_data_key is None or isinstance(wrapped_data_key, str)
+        self.wrapped_data_key = wrapped_data_key
+
+    def __eq__(self, other):
+        return super().__eq__(other) and self.wrapped_data_key == other.wrapped_data_key
@@ -1,31 +1,69 @@
-import yaml
-from requests import Session
-from requests.adapters import HTTPAdapter
-from requests.exceptions import ConnectionError, ConnectTimeout, HTTPError
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
 
-from .messaging import die
+from . import limits, metrics, trace
+from .forking import check_fork, register_after_fork
+from .messaging import debug, die
 from .yaml import safe_load
 
-try:
-    from urllib3.util.retry import Retry
-except ImportError:
-    # Requests < 2.16.0
-    from requests.packages.urllib3.util.retry import Retry
+METADATA_URL = 'http://169.254.169.254'
+TOKEN_URL = METADATA_URL + '/latest/api/token'
+USER_DATA_URL = METADATA_URL + '/latest/user-data'
+IDENTITY_URL = METADATA_URL + '/latest/dynamic/instance-identity/document'
 
-USER_DATA_URL = 'http://169.254.169.254/latest/user-data'
+# Files identifying the machine, which on EC2 name Amazon or start "ec2", for
+# Nitro and Xen instances respectively
+EC2_IDENTITY_PATHS = (
+    '/sys/devices/virtual/dmi/id/sys_vendor',
+    '/sys/devices/virtual/dmi/id/bios_vendor',
+    '/sys/devices/virtual/dmi/id/bios_version',
+    '/sys/hypervisor/uuid',
+)
+
+TOKEN_TTL = 21600
+# Refresh tokens this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+
+# Set from global command line arguments
+# Keep the identity document on disk for the rest of the boot
+disk_cache = False
+# Connect timeout for metadata requests, and the whole timeout for the first,
+# un-retried, token request that probes whether the service is reachable
+probe_timeout = 1.0
+read_timeout = 10.0
+connect_retries = 2
+read_retries = 3
+# Seconds to remember that the metadata service is unreachable for
+negative_cache_ttl = 600
+
+_lock = threading.RLock()
+_token = None
+_token_expires = 0.0
+_identity = None
+_session = None
+
+
+class MetadataServiceUnavailable(Exception):
+    pass
 
 
 def load_user_data_as_yaml_or_die(ignore_missing=False):
+    from requests.exceptions import ConnectionError, ConnectTimeout, HTTPError
+    from yaml.error import YAMLError
+
     try:
         data = load_user_data_as_yaml()
-    except (ConnectTimeout, ConnectionError):
+    except (ConnectTimeout, ConnectionError, MetadataServiceUnavailable):
         die('Could not connect to EC2 metadata service - are we on an EC2 instance?')
     except HTTPError as exc:
         if exc.response.status_code == 404 and ignore_missing:
             return {'TREEHUGGER_APP': 'Missing', 'TREEHUGGER_STAGE': 'Missing'}
 
         die('Got a {} from the EC2 metadata service when retrieving user data'.format(exc.response.status_code))
-    except yaml.error.YAMLError:
+    except YAMLError:
         die('Did not find valid YAML in the EC2 user data')
 
     try:
@@ -37,24 +75,238 @@ def load_user_data_as_yaml_or_die(ignore_missing=False):
 
 
 def load_user_data_as_yaml():
-    resp = session.get(USER_DATA_URL, timeout=10.0)
-    resp.raise_for_status()
-    return safe_load(resp.text)
+    with trace.span('ec2.load_user_data') as span:
+        resp = metadata_get(USER_DATA_URL, stream=True)
+        content = limits.read_or_die(
+            resp.iter_content(limits.CHUNK_SIZE),
+            'EC2 user data',
+            resp.headers.get('Content-Length'),
+        )
+        span.set(size=len(content))
+        metrics.increment('imds_bytes_total', len(content))
+        return safe_load(content, name='EC2 user data')
 
 
-IDENTITY_URL = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
+def get_current_region():
+    return get_identity_document()['region']
 
 
-def get_current_region():
-    resp = session.get(IDENTITY_URL, timeout=10.0)
-    resp.raise_for_status()
-    return resp.json()['region']
-
-
-session = Session()
-adapter = HTTPAdapter(max_retries=Retry(
-    total=10,
-    backoff_factor=0.01,
-))
-session.mount('http://', adapter)
-session.mount('https://', adapter)
+def get_identity_document():
+    """
+    Fetch the instance identity document at most once per process, or once
+    per boot with the disk cache enabled.
+    """
+    global _identity
+    check_fork()
+    with _lock:
+        if _identity is None:
+            path = _identity_cache_path()
+            if path is not None:
+                try:
+                    with open(path, 'r') as fp:
+                        _identity = json.load(fp)
+                    debug('Loaded EC2 identity document from {}'.format(path))
+                except (OSError, ValueError):
+                    pass
+            if _identity is None:
+                _identity = metadata_get(IDENTITY_URL).json()
+                if path is not None:
+                    from .os_ext import atomic_write
+
+                    atomic_write(path, json.dumps(_identity).encode('utf-8'))
+        return _identity
+
+
+def _identity_cache_path():
+    if not disk_cache:
+        return None
+    return _boot_state_path('ec2-identity-{}.json')
+
+
+def _unreachable_cache_path():
+    if negative_cache_ttl <= 0:
+        return None
+    return _boot_state_path('ec2-unreachable-{}')
+
+
+def _boot_state_path(name_format):
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as fp:
+            boot_id = fp.read().strip()
+    except OSError:
+        return None
+
+    from .os_ext import get_state_dir
+
+    return os.path.join(get_state_dir(), name_format.format(boot_id))
+
+
+def metadata_get(url, stream=False):
+    """
+    GET from the metadata service with IMDSv2, falling back to IMDSv1 where
+    IMDSv2 isn't available.
+    """
+    token = get_metadata_token()
+    timeout = (probe_timeout, read_timeout)
+    with metrics.timer('imds_requests', path=urlparse(url).path):
+        resp = get_session().get(url, headers=_token_headers(token), timeout=timeout, stream=stream)
+        if resp.status_code == 401 and token is not None:
+            # Token rejected, e.g. the instance was stopped and started
+            resp.close()
+            token = get_metadata_token(refresh=True)
+            resp = get_session().get(url, headers=_token_headers(token), timeout=timeout, stream=stream)
+        resp.raise_for_status()
+    return resp
+
+
+def _token_headers(token):
+    if token is None:
+        return {}
+    return {'X-aws-ec2-metadata-token': token}
+
+
+def get_metadata_token(refresh=False):
+    """
+    Return an IMDSv2 session token, shared by all metadata requests in the
+    process until it's close to expiry. Returns None if the metadata service
+    doesn't support IMDSv2.
+
+    The token request doubles as a quick probe of whether the metadata service
+    is reachable at all, so that off EC2 we fail fast rather than retrying.
+    Connection failures on machines known not to be EC2 instances are
+    remembered for a while so that later runs fail immediately - on EC2 the
+    network may just not be up yet. If the connection succeeds but the response doesn't arrive,
+    as in containers where the hop limit stops only the PUT's response, we
+    fall back to IMDSv1 as botocore does.
+    """
+    global _token, _token_expires
+    check_fork()
+    with _lock:
+        if not refresh and _token_expires > time.monotonic():
+            return _token
+
+        from requests.exceptions import ConnectionError, ReadTimeout
+
+        unreachable_path = _unreachable_cache_path()
+        if unreachable_path is not None and _is_recent(unreachable_path, negative_cache_ttl):
+            debug('EC2 metadata service was recently found to be unreachable')
+            raise MetadataServiceUnavailable('Recently found to be unreachable')
+
+        start = time.monotonic()
+        try:
+            with metrics.timer('imds_requests', path='/latest/api/token'):
+                resp = get_session().put(
+                    TOKEN_URL,
+                    headers={'X-aws-ec2-metadata-token-ttl-seconds': str(TOKEN_TTL)},
+                    timeout=probe_timeout,
+                )
+        except ReadTimeout as exc:
+            debug('EC2 metadata service token request timed out after {:.1f}ms, using IMDSv1: {}'.format(
+                (time.monotonic() - start) * 1000,
+                exc,
+            ))
+            resp = None
+        except ConnectionError as exc:
+            # Including ConnectTimeout
+            debug('EC2 metadata service probe failed after {:.1f}ms: {}'.format(
+                (time.monotonic() - start) * 1000,
+                exc,
+            ))
+            if unreachable_path is not None and not _may_be_ec2():
+                from .os_ext import atomic_write
+
+                atomic_write(unreachable_path, b'')
+            raise MetadataServiceUnavailable(str(exc))
+        if resp is None:
+            token = None
+        elif resp.status_code in (403, 404, 405):
+            debug('EC2 metadata service does not support IMDSv2, using IMDSv1')
+            token = None
+        else:
+            resp.raise_for_status()
+            token = resp.text
+        if resp is not None:
+            debug('EC2 metadata service probe took {:.1f}ms'.format((time.monotonic() - start) * 1000))
+        _token = token
+        _token_expires = time.monotonic() + TOKEN_TTL - TOKEN_EXPIRY_MARGIN
+        return _token
+
+
+def _may_be_ec2():
+    """
+    Whether the machine's DMI or hypervisor details could be an EC2
+    instance's, including when they can't be read.
+    """
+    found = False
+    for path in EC2_IDENTITY_PATHS:
+        try:
+            with open(path, 'r') as fp:
+                value = fp.read().strip().lower()
+        except OSError:
+            continue
+        found = True
+        if 'amazon' in value or value.startswith('ec2'):
+            return True
+    return not found
+
+
+def _is_recent(path, ttl):
+    try:
+        return os.stat(path).st_mtime + ttl > time.time()
+    except OSError:
+        return False
+
+
+def reset():
+    global _token, _token_expires, _identity
+    with _lock:
+        _token = None
+        _token_expires = 0.0
+        _identity = None
+
+
+def _after_fork_in_child():
+    # The requests session's connection pool can't be shared between
+    # processes, and another thread may have held the lock when the process
+    # forked. The token and identity document remain valid.
+    global _lock, _session
+    _lock = threading.RLock()
+    _session = None
+
+
+register_after_fork(_after_fork_in_child)
+
+
+def get_session():
+    """
+    Build the requests Session for the metadata service on first use, since
+    importing requests is slow and many commands never need it.
+    """
+    global _session
+    check_fork()
+    with _lock:
+        if _session is not None:
+            return _session
+
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+
+        try:
+            from urllib3.util.retry import Retry
+        except ImportError:
+            # Requests < 2.16.0
+            from requests.packages.urllib3.util.retry import Retry
+
+        session = Session()
+        adapter = HTTPAdapter(max_retries=Retry(
+            total=connect_retries + read_retries,
+            connect=connect_retries,
+            read=read_retries,
+            backoff_factor=0.01,
+        ))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # The token request is the reachability probe, so mustn't be retried
+        session.mount(TOKEN_URL, HTTPAdapter(max_retries=0))
+        _session = session
+        return _session
@@ -0,0 +1,55 @@
+"""
+Local AEAD encryption of values under a KMS generated data key, for the
+envelope format. Each value is encrypted with AES-256-GCM, using its
+encryption context as associated data so that ciphertexts can't be moved
+between keys, apps, or stages.
+"""
+import base64
+import json
+import os
+
+from .messaging import die
+
+FORMAT_VERSION = b'\x01'
+NONCE_SIZE = 12
+
+
+def encrypt_value(data_key, plaintext, encryption_context):
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = _get_aead(data_key).encrypt(
+        nonce,
+        plaintext.encode('utf-8'),
+        _associated_data(encryption_context),
+    )
+    return base64.b64encode(FORMAT_VERSION + nonce + ciphertext).decode('utf-8')
+
+
+def decrypt_value(data_key, base64_ciphertext, encryption_context):
+    aead = _get_aead(data_key)
+    from cryptography.exceptions import InvalidTag
+
+    try:
+        blob = base64.b64decode(base64_ciphertext.encode('utf-8'))
+        if blob[:1] != FORMAT_VERSION:
+            raise ValueError('Unknown envelope format version')
+        nonce = blob[1:1 + NONCE_SIZE]
+        ciphertext = blob[1 + NONCE_SIZE:]
+        plaintext = aead.decrypt(nonce, ciphertext, _associated_data(encryption_context))
+        return plaintext.decode('utf-8')
+    except (InvalidTag, ValueError):
+        # Also covers bad base64 and UTF-8, which are ValueErrors
+        die('Could not decrypt envelope encrypted value {} - it may be corrupt, or from a different data key, app or '
+            'stage'.format(encryption_context.get('treehugger_key')))
+
+
+def _associated_data(encryption_context):
+    return json.dumps(encryption_context, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _get_aead(data_key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        die('The envelope format requires the "cryptography" package - install it with '
+            '"pip install treehugger[envelope]"')
+    return AESGCM(data_key)
@@ -0,0 +1,145 @@
+"""
+Loading treehugger data from where it's configured - an S3 URL from
+TREEHUGGER_DATA, a file, or EC2 User Data - and decrypting it.
+"""
+import threading
+
+from . import yaml
+from .data import Encrypted, EnvelopeEncrypted, EnvironmentDict
+from .ec2 import load_user_data_as_yaml_or_die
+from .kms import kms_agent
+from .messaging import debug
+
+
+def load_data_or_die(data_url=None, filename=None, ignore_missing=False, on_document=None):
+    """
+    Load the data, with its includes. `on_document` is passed to
+    yaml.include_remote_yaml_data_or_die().
+    """
+    if data_url is not None:
+        return yaml.load_s3_or_die(data_url)
+    if filename:
+        data = yaml.load_file_or_die(filename)
+    else:
+        data = load_user_data_as_yaml_or_die(ignore_missing)
+    return yaml.include_remote_yaml_data_or_die(data, on_document)
+
+
+def load_data_overlapped_or_die(data_url=None, filename=None, ignore_missing=False, key_filter=None):
+    """
+    Load the data as load_data_or_die() does, but once a document with
+    encrypted values is loaded, create the KMS client and start decrypting
+    them while the rest of the includes are fetched.
+    """
+    return load_data_or_die(data_url, filename, ignore_missing, on_document=DecryptPrefetcher(key_filter))
+
+
+class DecryptPrefetcher(object):
+    """
+    Called with each document as it's loaded, starts decrypting its encrypted
+    values with kms_agent.prefetch_decrypts(), warming up the KMS client for
+    the first that has any. This is a guess, since values
+    may be overridden by later includes: TREEHUGGER_APP and TREEHUGGER_STAGE
+    are taken from the document itself, or failing that the first document.
+    Anything wrong is left for the full load to find.
+    """
+
+    def __init__(self, key_filter=None):
+        self.key_filter = key_filter
+        self._first_base_encryption_context = None
+        self._warmed_up = False
+        self._lock = threading.Lock()
+
+    def __call__(self, data):
+        try:
+            env_dict = EnvironmentDict.from_yaml_dict(
+                {key: value for key, value in data.items() if key != yaml.INCLUDE_KEY}
+            )
+        except (AssertionError, ValueError):
+            return
+        if self.key_filter is not None:
+            env_dict = env_dict.select_encrypted(self.key_filter)
+        if any(isinstance(value, Encrypted) for value in env_dict.values()):
+            with self._lock:
+                warm_up = not self._warmed_up
+                self._warmed_up = True
+            if warm_up:
+                kms_agent.warm_up()
+
+        try:
+            base_encryption_context = env_dict.get_base_encryption_context()
+        except ValueError:
+            base_encryption_context = self._first_base_encryption_context
+        if self._first_base_encryption_context is None:
+            self._first_base_encryption_context = base_encryption_context or {}
+        if not base_encryption_context:
+            return
+
+        items = [
+            (value.base64_ciphertext, env_dict.get_encryption_context(key, base_encryption_context))
+            for key, value in env_dict.items()
+            if isinstance(value, Encrypted) and not isinstance(value, EnvelopeEncrypted)
+        ]
+        has_envelope = any(isinstance(value, EnvelopeEncrypted) for value in env_dict.values())
+        if has_envelope and env_dict.wrapped_data_key is not None:
+            items.append((env_dict.wrapped_data_key, base_encryption_context))
+        kms_agent.prefetch_decrypts(items)
+
+
+def load_environment_or_die(data_url=None, filename=None, ignore_missing=False):
+    """
+    Load and decrypt the data, returning a dict of environment variables.
+    """
+    data = load_data_or_die(data_url, filename, ignore_missing)
+    env_dict = EnvironmentDict.from_yaml_dict(data)
+    return env_dict.decrypt_all_encrypted(plain=True)
+
+
+def apply_key_filter(env_dict, key_filter):
+    """
+    Drop the encrypted values `key_filter` rejects before anything is
+    decrypted. `key_filter` may be None to keep them all.
+    """
+    if key_filter is None:
+        return env_dict
+    selected = env_dict.select_encrypted(key_filter)
+    debug('Skipped decrypting {} variables not selected by --only, --prefix or --exclude'.format(
+        len(env_dict) - len(selected),
+    ))
+    return selected
+
+
+class EnvironmentLoader(object):
+    """
+    Loads and decrypts the data repeatedly, as for reloading, only decrypting
+    values whose ciphertext or encryption context changed since the last load.
+    Encrypted values rejected by `key_filter` are left out.
+    """
+
+    def __init__(self, data_url=None, filename=None, ignore_missing=False, key_filter=None):
+        self.data_url = data_url
+        self.filename = filename
+        self.ignore_missing = ignore_missing
+        self.key_filter = key_filter
+        self._previous = None
+
+    def load(self):
+        if self._previous is None:
+            data = load_data_overlapped_or_die(self.data_url, self.filename, self.ignore_missing, self.key_filter)
+        else:
+            # Unchanged values aren't decrypted again, so don't start to
+            data = load_data_or_die(self.data_url, self.filename, self.ignore_missing)
+        env_dict = apply_key_filter(EnvironmentDict.from_yaml_dict(data), self.key_filter)
+
+        to_decrypt = EnvironmentDict(env_dict)
+        to_decrypt.wrapped_data_key = env_dict.wrapped_data_key
+        if self._previous is not None:
+            previous_env_dict, previous_environment = self._previous
+            if previous_env_dict.get_base_encryption_context() == env_dict.get_base_encryption_context():
+                for key, value in env_dict.items():
+                    if isinstance(value, Encrypted) and previous_env_dict.get(key) == value:
+                        to_decrypt[key] = previous_environment[key]
+
+        environment = to_decrypt.decrypt_all_encrypted(plain=True)
+        self._previous = (env_dict, environment)
+        return environment
@@ -0,0 +1,34 @@
+"""
+Replacing locks and connection pools in forked child processes, which can't
+share them with their parent.
+"""
+import os
+
+# Functions for check_fork() to call, on Pythons without os.register_at_fork()
+_after_fork_funcs = []
+_pid = os.getpid()
+
+
+def register_after_fork(func):
+    """
+    Call `func` in the child process after a fork. Python 3.7+ calls it as
+    part of the fork. Older versions have no hook, so check_fork() calls it
+    instead, the first time it runs in the child.
+    """
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=func)
+    else:
+        _after_fork_funcs.append(func)
+
+
+def check_fork():
+    """
+    On Pythons before 3.7, call the registered functions if the process has
+    forked since they were last called. The entry points that use locks or
+    connection pools call this first.
+    """
+    global _pid
+    if _after_fork_funcs and os.getpid() != _pid:
+        _pid = os.getpid()
+        for func in _after_fork_funcs:
+            func()
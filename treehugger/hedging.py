@@ -0,0 +1,117 @@
+"""
+Hedged requests, to cut the tail latency of KMS decrypts. If a call hasn't
+finished after a delay - fixed, or a percentile of the latencies seen so far
+- the same call is made again, and whichever succeeds first is used. The
+number of hedges is capped at a fraction of all calls, so a slow service
+doesn't get double the load.
+"""
+import collections
+import queue
+import threading
+import time
+
+from . import metrics
+from .messaging import debug
+
+# Latencies to keep for the adaptive percentile, and how many are needed
+# before it's used
+MAX_SAMPLES = 1000
+MIN_SAMPLES = 20
+
+
+class Hedger(object):
+    """
+    Hedges calls after `delay` seconds, or once there are enough samples, at
+    the `percentile` of observed latencies if that's set. At most
+    `max_ratio` of calls, plus one, are hedged.
+    """
+
+    def __init__(self, delay=0.0, percentile=None, max_ratio=0.1):
+        self.delay = delay
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+        self._latencies = collections.deque(maxlen=MAX_SAMPLES)
+        self._lock = threading.Lock()
+
+    def call(self, func):
+        """
+        Return `func()`, calling it a second time concurrently if the first
+        call is slow. If both fail, the first call's exception is raised.
+        """
+        with self._lock:
+            self.calls += 1
+        delay = self.get_delay()
+        if delay is None:
+            return self._timed(func)
+
+        results = queue.Queue()
+        self._start(func, results, hedge=False)
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            if not self._take_hedge():
+                outcome = results.get()
+            else:
+                self._start(func, results, hedge=True)
+                outcome = results.get()
+                if outcome[1] is not None:
+                    # Failed, so wait for the other call
+                    other = results.get()
+                    if other[1] is None or outcome[0]:
+                        outcome = other
+                won = outcome[0] and outcome[1] is None
+                if won:
+                    with self._lock:
+                        self.wins += 1
+                metrics.increment('kms_hedges_total', result='won' if won else 'lost')
+
+        hedge, exc, result = outcome
+        if exc is not None:
+            raise exc
+        return result
+
+    def get_delay(self):
+        """
+        The current delay before hedging, or None if calls shouldn't be
+        hedged yet.
+        """
+        if self.percentile is not None:
+            with self._lock:
+                if len(self._latencies) >= MIN_SAMPLES:
+                    latencies = sorted(self._latencies)
+                    index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+                    return latencies[index]
+        return self.delay or None
+
+    def report(self):
+        debug('KMS hedging: {} of {} calls hedged, {} hedges won'.format(self.hedges, self.calls, self.wins))
+
+    def _take_hedge(self):
+        with self._lock:
+            if self.hedges >= self.max_ratio * self.calls + 1:
+                return False
+            self.hedges += 1
+            return True
+
+    def _start(self, func, results, hedge):
+        def run():
+            try:
+                result = self._timed(func)
+            except Exception as exc:
+                results.put((hedge, exc, None))
+            else:
+                results.put((hedge, None, result))
+
+        # Daemon threads so a slow loser doesn't hold up exiting
+        thread = threading.Thread(target=run, name='kms-hedge' if hedge else 'kms-call', daemon=True)
+        thread.start()
+
+    def _timed(self, func):
+        start = time.monotonic()
+        result = func()
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+        return result
@@ -1,38 +1,155 @@
 import base64
+import random
+import threading
+import time
 
-import boto3
-from botocore.exceptions import NoRegionError
-
-from .ec2 import get_current_region
+from . import aws, envelope, metrics, trace
+from .concurrency import BackgroundPool, map_in_order
+from .forking import check_fork, register_after_fork
+from .messaging import Fatal, debug
 
 
 class KMSAgent(object):
 
     key_id = 'alias/treehugger'
+    workers = 8
+    # Optional cache.BaseCache of decrypted values that outlives the process
+    persistent_cache = None
+    # Optional ratelimit.RateLimiter, which replaces botocore's own retries
+    rate_limiter = None
+    # Optional hedging.Hedger for decrypt calls
+    hedger = None
+    max_attempts = 5
+    max_backoff = 5.0
+    # Maximum random delay in seconds before the first KMS call
+    start_jitter = 0.0
+    # Regions to call, for multi-region keys, or empty for the session's region
+    regions = ()
 
     def __init__(self):
+        self._kms_client = None
+        self._client_lock = threading.Lock()
+        self._warm_up_failure = None
+        self._region_pool = None
+        self._region_pool_lock = threading.Lock()
         self.cache = {}
+        self.data_keys = {}
+        self._started = False
+        self._start_lock = threading.Lock()
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+        self._prefetch_pool = None
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        self.prefetches = 0
+        self.prefetches_used = 0
 
     def reset(self):
+        self._region_pool = None
+        self._warm_up_failure = None
         self.cache = {}
+        self.data_keys = {}
+        self._started = False
+        self.calls = 0
+        self._prefetched = {}
+        self.prefetches = 0
+        self.prefetches_used = 0
 
     @property
     def kms_client(self):
-        if not hasattr(self, '_kms_client'):
+        check_fork()
+        with self._client_lock:
+            if self._kms_client is None:
+                self._raise_warm_up_failure()
+                self._kms_client = self._create_client()
+            return self._kms_client
+
+    @property
+    def region_pool(self):
+        check_fork()
+        with self._region_pool_lock:
+            if self._region_pool is None:
+                self._raise_warm_up_failure()
+                from .kms_regions import RegionPool
+
+                # The regions are given, so a default region is only a
+                # preference for which to try first
+                self._region_pool = RegionPool(
+                    self.regions,
+                    create_client=lambda region_name: self._create_client(region_name=region_name),
+                    local_region=aws.get_session(require_region=False).region_name,
+                )
+            return self._region_pool
+
+    def _create_client(self, **config_kwargs):
+        # Each worker thread needs its own connection to avoid waiting on the pool,
+        # and hedged calls may need a second
+        connections = self.workers * (2 if self.hedger is not None else 1)
+        config_kwargs['max_pool_connections'] = max(aws.max_pool_connections, connections)
+        if self.rate_limiter is not None:
+            config_kwargs['retries'] = {'mode': aws.retry_mode, 'total_max_attempts': 1}
+        return aws.create_client('kms', require_region='region_name' not in config_kwargs, **config_kwargs)
+
+    @kms_client.setter
+    def kms_client(self, client):
+        self._kms_client = client
+
+    def warm_up(self):
+        """
+        Create the KMS client in a background thread, resolving the region
+        and credentials, so it's ready by the time anything needs decrypting.
+        """
+        def create():
             try:
-                self._kms_client = boto3.client('kms')
-            except NoRegionError:
-                region_name = get_current_region()
-                self._kms_client = boto3.client('kms', region_name=region_name)
-        return self._kms_client
+                if self.regions:
+                    self.region_pool.warm_up()
+                else:
+                    self.kms_client
+            except Fatal as exc:
+                # die() has already printed the message, so raise the same
+                # exception when the client is needed rather than dying again
+                self._warm_up_failure = exc
+            except Exception:
+                # Raised again when the client is needed
+                pass
+
+        threading.Thread(target=create, name='kms-warm-up', daemon=True).start()
+
+    def _raise_warm_up_failure(self):
+        if self._warm_up_failure is not None:
+            raise self._warm_up_failure
+
+    def prefetch_decrypts(self, items):
+        """
+        Start decrypting (base64_ciphertext, encryption_context) pairs in the
+        background, for decrypt() and get_data_key() to use if they're asked
+        for the same pair. Failures are raised from there.
+        """
+        check_fork()
+        with self._prefetch_lock:
+            if self._prefetch_pool is None:
+                self._prefetch_pool = BackgroundPool(self.workers)
+            for base64_ciphertext, encryption_context in items:
+                prefetch_key = (base64_ciphertext,) + tuple(sorted(encryption_context.items()))
+                if prefetch_key in self._prefetched:
+                    continue
+                self._prefetched[prefetch_key] = self._prefetch_pool.submit(
+                    lambda item=(base64_ciphertext, encryption_context): self._kms_decrypt_now(*item)
+                )
+                self.prefetches += 1
+
+    def _take_prefetched(self, base64_ciphertext, encryption_context):
+        prefetch_key = (base64_ciphertext,) + tuple(sorted(encryption_context.items()))
+        with self._prefetch_lock:
+            future = self._prefetched.pop(prefetch_key, None)
+            if future is None or future.cancel():
+                # Not started yet, so quicker for the caller to do it
+                return None
+            self.prefetches_used += 1
+            return future
 
     def decrypt(self, base64_ciphertext, encryption_context):
-        cipher_blob = base64.b64decode(base64_ciphertext.encode('utf-8'))
-        response = self.kms_client.decrypt(
-            CiphertextBlob=cipher_blob,
-            EncryptionContext=encryption_context,
-        )
-        plaintext = response['Plaintext'].decode('utf-8')
+        plaintext = self._kms_decrypt(base64_ciphertext, encryption_context).decode('utf-8')
         cache_key = self._cache_key(plaintext, encryption_context)
         self.cache[cache_key] = base64_ciphertext
         return plaintext
@@ -40,11 +157,15 @@ class KMSAgent(object):
     def encrypt(self, plaintext, encryption_context):
         cache_key = self._cache_key(plaintext, encryption_context)
         try:
-            return self.cache[cache_key]
+            base64_ciphertext = self.cache[cache_key]
         except KeyError:
-            pass
+            metrics.increment('kms_cache_lookups_total', cache='memory', result='miss')
+        else:
+            metrics.increment('kms_cache_lookups_total', cache='memory', result='hit')
+            return base64_ciphertext
 
-        response = self.kms_client.encrypt(
+        response = self._call(
+            'encrypt',
             KeyId=self.key_id,
             Plaintext=plaintext.encode('utf-8'),
             EncryptionContext=encryption_context
@@ -53,8 +174,217 @@ class KMSAgent(object):
         self.cache[cache_key] = base64_ciphertext
         return base64_ciphertext
 
+    def get_data_key(self, encryption_context, base64_wrapped_key=None):
+        """
+        Return a (plaintext_key, base64_wrapped_key) pair for the envelope
+        format. If base64_wrapped_key is given it's unwrapped with KMS,
+        otherwise the key already used for the encryption context is reused,
+        or a new one generated. Keys are cached so that each costs at most one
+        KMS call per process.
+        """
+        cache_key = tuple(sorted(encryption_context.items()))
+        cached = self.data_keys.get(cache_key)
+        if cached is not None and base64_wrapped_key in (None, cached[1]):
+            return cached
+
+        if base64_wrapped_key is not None:
+            data_key = (self._kms_decrypt(base64_wrapped_key, encryption_context), base64_wrapped_key)
+        else:
+            response = self._call(
+                'generate_data_key',
+                KeyId=self.key_id,
+                KeySpec='AES_256',
+                EncryptionContext=encryption_context,
+            )
+            data_key = (response['Plaintext'], base64.b64encode(response['CiphertextBlob']).decode('utf-8'))
+        self.data_keys[cache_key] = data_key
+        return data_key
+
+    def _kms_decrypt(self, base64_ciphertext, encryption_context):
+        check_fork()
+        future = self._take_prefetched(base64_ciphertext, encryption_context)
+        if future is not None:
+            return future.result()
+        return self._kms_decrypt_now(base64_ciphertext, encryption_context)
+
+    def _kms_decrypt_now(self, base64_ciphertext, encryption_context):
+        if self.persistent_cache is not None:
+            from .cache import make_key
+
+            persistent_key = make_key(base64_ciphertext, encryption_context)
+            cached = self.persistent_cache.get(persistent_key)
+            metrics.increment(
+                'kms_cache_lookups_total',
+                cache=self.persistent_cache.name,
+                result='miss' if cached is None else 'hit',
+            )
+            if cached is not None:
+                return base64.b64decode(cached.encode('utf-8'))
+
+        response = self._call(
+            'decrypt',
+            CiphertextBlob=base64.b64decode(base64_ciphertext.encode('utf-8')),
+            EncryptionContext=encryption_context,
+        )
+        plaintext = response['Plaintext']
+        if self.persistent_cache is not None:
+            self.persistent_cache.set(persistent_key, base64.b64encode(plaintext).decode('utf-8'))
+        return plaintext
+
+    def _call(self, operation_name, **kwargs):
+        check_fork()
+        self._wait_for_start()
+        with self._calls_lock:
+            self.calls += 1
+        with trace.span('kms.' + operation_name, key=kwargs['EncryptionContext'].get('treehugger_key')), \
+                metrics.timer('kms_requests', operation=operation_name):
+            if self.regions:
+                def call():
+                    return self.region_pool.call(
+                        lambda client: self._call_with_retries(getattr(client, operation_name), operation_name, kwargs)
+                    )
+            else:
+                method = getattr(self.kms_client, operation_name)
+
+                def call():
+                    return self._call_with_retries(method, operation_name, kwargs)
+
+            if self.hedger is not None and operation_name == 'decrypt':
+                return self.hedger.call(call)
+            return call()
+
+    def _call_with_retries(self, method, operation_name, kwargs):
+        if self.rate_limiter is None:
+            return method(**kwargs)
+
+        from .ratelimit import is_throttling_error, is_transient_error
+
+        attempt = 1
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                response = method(**kwargs)
+            except Exception as exc:
+                if is_throttling_error(exc):
+                    self.rate_limiter.on_throttle()
+                    reason = 'throttled'
+                elif is_transient_error(exc):
+                    error = getattr(exc, 'response', {}).get('Error', {}).get('Code') or type(exc).__name__
+                    reason = 'failed with {}'.format(error)
+                else:
+                    raise
+                if attempt >= self.max_attempts:
+                    raise
+                delay = self.rate_limiter.backoff(attempt, self.max_backoff)
+                debug('KMS {} {}, retrying after {:.3f}s'.format(operation_name, reason, delay))
+                attempt += 1
+                continue
+            self.rate_limiter.on_success()
+            return response
+
+    def _wait_for_start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            if self.start_jitter > 0:
+                delay = random.uniform(0, self.start_jitter)
+                debug('Delaying first KMS call by {:.3f}s'.format(delay))
+                time.sleep(delay)
+
+    def report(self):
+        if self.prefetches:
+            debug('Started {} KMS decrypts while loading, {} of them used'.format(
+                self.prefetches,
+                self.prefetches_used,
+            ))
+        if self._region_pool is not None:
+            self._region_pool.report()
+        if self.hedger is not None:
+            self.hedger.report()
+        if self.rate_limiter is not None:
+            debug(
+                'KMS rate limiter: {} requests waited {:.3f}s in total (max {:.3f}s), '
+                '{} throttled with {:.3f}s of backoff, rate now {:.1f}/s'.format(
+                    self.rate_limiter.requests,
+                    self.rate_limiter.total_wait,
+                    self.rate_limiter.max_wait,
+                    self.rate_limiter.throttles,
+                    self.rate_limiter.total_backoff,
+                    self.rate_limiter.rate,
+                )
+            )
+        if self.persistent_cache is not None:
+            debug('Decrypted value cache ({}): {} hits, {} misses'.format(
+                self.persistent_cache.name,
+                self.persistent_cache.hits,
+                self.persistent_cache.misses,
+            ))
+
+    def envelope_decrypt(self, base64_ciphertext, encryption_context, data_key):
+        plaintext = envelope.decrypt_value(data_key[0], base64_ciphertext, encryption_context)
+        cache_key = self._cache_key(plaintext, encryption_context) + (data_key[1],)
+        self.cache[cache_key] = base64_ciphertext
+        return plaintext
+
+    def envelope_encrypt(self, plaintext, encryption_context, data_key):
+        cache_key = self._cache_key(plaintext, encryption_context) + (data_key[1],)
+        try:
+            return self.cache[cache_key]
+        except KeyError:
+            pass
+
+        base64_ciphertext = envelope.encrypt_value(data_key[0], plaintext, encryption_context)
+        self.cache[cache_key] = base64_ciphertext
+        return base64_ciphertext
+
+    def decrypt_many(self, items):
+        """
+        Decrypt a list of (base64_ciphertext, encryption_context) pairs using
+        up to `workers` concurrent KMS calls, returning the plaintexts in order.
+        """
+        return self._map(lambda item: self.decrypt(*item), items)
+
+    def encrypt_many(self, items):
+        """
+        Encrypt a list of (plaintext, encryption_context) pairs using up to
+        `workers` concurrent KMS calls, returning the ciphertexts in order.
+        """
+        return self._map(lambda item: self.encrypt(*item), items)
+
+    def _map(self, func, items):
+        items = list(items)
+        if items and not self.regions:
+            # Create the client up front rather than racing to do so in threads
+            self.kms_client
+        return map_in_order(func, items, self.workers)
+
     def _cache_key(self, plaintext, encryption_context):
         return (plaintext,) + tuple(sorted(encryption_context.items()))
 
 
 kms_agent = KMSAgent()
+
+
+def _after_fork_in_child():
+    # Clients' connection pools can't be shared between processes, and another
+    # thread may have held a lock when the process forked
+    kms_agent.kms_client = None
+    kms_agent._client_lock = threading.Lock()
+    kms_agent._warm_up_failure = None
+    kms_agent._prefetch_pool = None
+    kms_agent._prefetched = {}
+    kms_agent._prefetch_lock = threading.Lock()
+    kms_agent._region_pool = None
+    if kms_agent.hedger is not None:
+        kms_agent.hedger._lock = threading.Lock()
+    if kms_agent.rate_limiter is not None:
+        kms_agent.rate_limiter._lock = threading.Lock()
+    if kms_agent.persistent_cache is not None:
+        kms_agent.persistent_cache._after_fork_in_child()
+    kms_agent._region_pool_lock = threading.Lock()
+    kms_agent._start_lock = threading.Lock()
+    kms_agent._calls_lock = threading.Lock()
+
+
+register_after_fork(_after_fork_in_child)
@@ -0,0 +1,165 @@
+"""
+Calling KMS in several regions, for multi-region keys, whose ciphertexts can
+be decrypted by a replica of the key in any region. Calls go to the local
+region first, or the fastest seen so far, and fail over to the next region
+when one errors or times out. Regions that fail are avoided for a while.
+"""
+import threading
+import time
+
+from . import metrics
+from .messaging import debug
+
+# How long to avoid a region for after it fails, in seconds
+COOLDOWN = 30.0
+# Weight of the latest call in each region's moving average latency
+LATENCY_SMOOTHING = 0.3
+
+# Errors that mean a region's KMS is unavailable or lacks the key replica,
+# rather than that the request is wrong
+FAILOVER_ERROR_CODES = frozenset([
+    'DependencyTimeoutException',
+    'KMSInternalException',
+    'KMSInvalidStateException',
+    'NotFoundException',
+    'ThrottlingException',
+])
+
+
+class RegionPool(object):
+    """
+    Clients for `regions`, created with `create_client(region)` when first
+    needed. `local_region` is tried first until latencies are known.
+    """
+
+    def __init__(self, regions, create_client, local_region=None):
+        self.create_client = create_client
+        self.regions = [
+            _Region(name, index, is_local=(name == local_region))
+            for index, name in enumerate(regions)
+        ]
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    def call(self, func):
+        """
+        Call `func(client)` with each region's client in order of preference
+        until one succeeds, returning its result. If every region fails, the
+        last region's exception is raised.
+        """
+        regions = self.ordered()
+        for i, region in enumerate(regions):
+            start = time.monotonic()
+            try:
+                result = func(self._get_client(region))
+            except Exception as exc:
+                if not is_failover_error(exc):
+                    raise
+                self._record_failure(region, exc)
+                if i == len(regions) - 1:
+                    raise
+                with self._lock:
+                    self.failovers += 1
+                metrics.increment('kms_failovers_total', region=region.name)
+                debug('KMS in {} failed with {}, failing over to {}'.format(
+                    region.name,
+                    _describe(exc),
+                    regions[i + 1].name,
+                ))
+                continue
+            self._record_success(region, time.monotonic() - start)
+            return result
+
+    def ordered(self):
+        """
+        Regions in the order to try them: healthy ones first, fastest first,
+        then the local region, then the rest in the configured order.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return sorted(self.regions, key=lambda region: region.sort_key(now))
+
+    def warm_up(self):
+        """
+        Create the client for the region that will be tried first.
+        """
+        self._get_client(self.ordered()[0])
+
+    def report(self):
+        for region in self.regions:
+            if not region.calls and not region.failures:
+                continue
+            debug('KMS region {}: {} calls, mean {:.1f}ms, {} failures{}'.format(
+                region.name,
+                region.calls,
+                (region.total_latency / region.calls * 1000) if region.calls else 0.0,
+                region.failures,
+                ', avoided until cooldown ends' if region.unhealthy_until > time.monotonic() else '',
+            ))
+        if self.failovers:
+            debug('KMS failed over between regions {} times'.format(self.failovers))
+
+    def _get_client(self, region):
+        with region.lock:
+            if region.client is None:
+                region.client = self.create_client(region.name)
+            return region.client
+
+    def _record_success(self, region, latency):
+        with self._lock:
+            region.calls += 1
+            region.total_latency += latency
+            if region.latency is None:
+                region.latency = latency
+            else:
+                region.latency += LATENCY_SMOOTHING * (latency - region.latency)
+            region.unhealthy_until = 0.0
+
+    def _record_failure(self, region, exc):
+        with self._lock:
+            region.failures += 1
+            region.unhealthy_until = time.monotonic() + COOLDOWN
+
+
+class _Region(object):
+
+    def __init__(self, name, index, is_local):
+        self.name = name
+        self.index = index
+        self.is_local = is_local
+        self.lock = threading.Lock()
+        self.client = None
+        # Moving average in seconds, None until the first successful call
+        self.latency = None
+        self.unhealthy_until = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.total_latency = 0.0
+
+    def sort_key(self, now):
+        unhealthy = self.unhealthy_until > now
+        if self.latency is not None:
+            rank = (0, self.latency)
+        elif self.is_local:
+            rank = (1, 0.0)
+        else:
+            rank = (2, 0.0)
+        return (unhealthy, rank, self.index)
+
+
+def is_failover_error(exc):
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+    if isinstance(exc, ClientError):
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return status >= 500 or exc.response['Error']['Code'] in FAILOVER_ERROR_CODES
+    # Connection failures and timeouts
+    return isinstance(exc, (ConnectionError, HTTPClientError))
+
+
+def _describe(exc):
+    from botocore.exceptions import ClientError
+
+    if isinstance(exc, ClientError):
+        return exc.response['Error']['Code']
+    return type(exc).__name__
@@ -0,0 +1,32 @@
+"""
+A limit on the size of data fetched from S3 or the EC2 metadata service, so
+an oversized document fails fast instead of being read into memory whole.
+"""
+from .messaging import die
+
+CHUNK_SIZE = 64 * 1024
+
+# Set from global command line arguments
+max_bytes = 4 * 1024 * 1024
+
+
+def read_or_die(chunks, description, content_length=None):
+    """
+    Join an iterable of byte chunks, dying as soon as they exceed max_bytes.
+    content_length is checked first, when the source gives one.
+    """
+    if content_length is not None and int(content_length) > max_bytes:
+        _too_large(description)
+    data = bytearray()
+    for chunk in chunks:
+        data += chunk
+        if len(data) > max_bytes:
+            _too_large(description)
+    return bytes(data)
+
+
+def _too_large(description):
+    die('{} is larger than the limit of {} bytes, which can be changed with --max-data-bytes'.format(
+        description,
+        max_bytes,
+    ))
@@ -1,6 +1,25 @@
 import sys
 
+# Set from the global --verbose argument
+verbose = False
+
+
+class Fatal(SystemExit):
+    """
+    Raised by die(), keeping the message for callers using treehugger as a
+    library.
+    """
+
+    def __init__(self, message):
+        super().__init__(1)
+        self.message = message
+
 
 def die(message):
     print(message, file=sys.stderr)
-    raise SystemExit(1)
+    raise Fatal(message)
+
+
+def debug(message):
+    if verbose:
+        print(message, file=sys.stderr)
@@ -0,0 +1,270 @@
+"""
+Counters and latency histograms of the calls treehugger makes to KMS, S3 and
+the EC2 metadata service, for planning KMS quotas across a fleet. They're
+kept in memory and written once at the end of a run, just before `exec`
+replaces the process, to a Prometheus node exporter textfile, a StatsD
+server over UDP, or both.
+
+When neither is configured the recording functions return straight away.
+"""
+import socket
+import threading
+import time
+
+from .forking import register_after_fork
+from .messaging import debug, die
+
+PREFIX = 'treehugger_'
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Keep UDP datagrams under a typical MTU
+STATSD_MAX_PACKET = 1400
+
+_registry = None
+_textfile = None
+_statsd_address = None
+
+
+def configure(textfile=None, statsd=None):
+    """
+    Start collecting metrics, to write to the `textfile` path and/or send to
+    the `statsd` "host:port" address. With neither, collecting stops.
+    """
+    global _registry, _textfile, _statsd_address
+    _textfile = textfile or None
+    _statsd_address = parse_statsd_address(statsd) if statsd else None
+    if _textfile is None and _statsd_address is None:
+        _registry = None
+    else:
+        _registry = Registry()
+
+
+def parse_statsd_address(value):
+    host, sep, port = value.rpartition(':')
+    if not sep or not host or not port.isdigit():
+        die('StatsD address must be like host:port, got {!r}'.format(value))
+    return (host.strip('[]'), int(port))
+
+
+def is_enabled():
+    return _registry is not None
+
+
+def increment(name, value=1, **labels):
+    if _registry is None:
+        return
+    _registry.increment(name, value, labels)
+
+
+def timer(name, **labels):
+    """
+    Return a context manager that records how long the code within it takes
+    in the `name`_duration_seconds histogram, and counts it in `name`_total
+    with an "outcome" label of "ok" or "error".
+    """
+    if _registry is None:
+        return _NULL_TIMER
+    return _Timer(_registry, name, labels)
+
+
+class _Timer(object):
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name + '_duration_seconds', time.monotonic() - self._start, self.labels)
+        labels = dict(self.labels, outcome='ok' if exc_type is None else 'error')
+        self.registry.increment(self.name + '_total', 1, labels)
+        return False
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        # Kept to send to StatsD, which does its own aggregation
+        self.samples = []
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.samples.append(seconds)
+
+
+def instrument_client(client):
+    """
+    Count each HTTP attempt a botocore client makes, including retries, which
+    count towards AWS quotas.
+    """
+    service = client.meta.service_model.endpoint_prefix
+    client.meta.events.register('needs-retry.{}'.format(service), _count_attempt)
+
+
+def _count_attempt(response, operation, caught_exception, **kwargs):
+    if caught_exception is not None:
+        result = type(caught_exception).__name__
+    elif response is not None:
+        result = response[1].get('Error', {}).get('Code') or 'ok'
+    else:
+        result = 'unknown'
+    increment(
+        'aws_attempts_total',
+        service=operation.service_model.endpoint_prefix,
+        operation=operation.name,
+        result=result,
+    )
+    return None
+
+
+def write():
+    """
+    Write out the metrics collected so far, if enabled. Failures are only
+    reported with --verbose, since metrics shouldn't stop the command.
+    """
+    if _registry is None:
+        return
+    if _textfile is not None:
+        from .os_ext import atomic_write
+
+        try:
+            # Readable by the node exporter
+            atomic_write(_textfile, format_prometheus(_registry).encode('utf-8'), mode=0o644)
+        except OSError as exc:
+            debug('Could not write metrics to {}: {}'.format(_textfile, exc))
+    if _statsd_address is not None:
+        try:
+            send_statsd(_registry, _statsd_address)
+        except OSError as exc:
+            debug('Could not send metrics to StatsD at {}:{}: {}'.format(_statsd_address[0], _statsd_address[1], exc))
+
+
+def format_prometheus(registry):
+    lines = []
+    with registry._lock:
+        counters = sorted(registry.counters.items())
+        histograms = sorted(registry.histograms.items())
+
+    last_name = None
+    for (name, labels), value in counters:
+        if name != last_name:
+            lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+            last_name = name
+        lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(labels), value))
+
+    last_name = None
+    for (name, labels), histogram in histograms:
+        if name != last_name:
+            lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            last_name = name
+        bucket_counts = list(zip((str(bound) for bound in BUCKETS), histogram.bucket_counts))
+        for le, count in bucket_counts + [('+Inf', histogram.count)]:
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, _format_labels(labels + (('le', le),)), count))
+        lines.append('{}{}_sum{} {:.6f}'.format(PREFIX, name, _format_labels(labels), histogram.sum))
+        lines.append('{}{}_count{} {}'.format(PREFIX, name, _format_labels(labels), histogram.count))
+
+    lines.append('# TYPE {}last_run_timestamp_seconds gauge'.format(PREFIX))
+    lines.append('{}last_run_timestamp_seconds {:.3f}'.format(PREFIX, time.time()))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ) + '}'
+
+
+def format_statsd(registry):
+    """
+    Return StatsD lines, with labels as DogStatsD style tags, which the
+    Prometheus statsd_exporter, Telegraf and Datadog all understand.
+    """
+    lines = []
+    with registry._lock:
+        counters = sorted(registry.counters.items())
+        histograms = sorted(registry.histograms.items())
+    for (name, labels), value in counters:
+        lines.append('{}{}:{}|c{}'.format(PREFIX, name, value, _format_tags(labels)))
+    for (name, labels), histogram in histograms:
+        # StatsD timers are in milliseconds
+        if name.endswith('_seconds'):
+            name = name[:-len('_seconds')]
+        for seconds in histogram.samples:
+            lines.append('{}{}:{:.3f}|ms{}'.format(PREFIX, name, seconds * 1000, _format_tags(labels)))
+    return lines
+
+
+def _format_tags(labels):
+    if not labels:
+        return ''
+    return '|#' + ','.join('{}:{}'.format(key, value) for key, value in labels)
+
+
+def send_statsd(registry, address):
+    lines = format_statsd(registry)
+    family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        packet = b''
+        for line in lines:
+            data = line.encode('utf-8')
+            if packet and len(packet) + 1 + len(data) > STATSD_MAX_PACKET:
+                sock.sendto(packet, address)
+                packet = b''
+            packet = packet + b'\n' + data if packet else data
+        if packet:
+            sock.sendto(packet, address)
+
+
+def _after_fork_in_child():
+    if _registry is not None:
+        _registry._lock = threading.Lock()
+
+
+register_after_fork(_after_fork_in_child)
@@ -1,5 +1,9 @@
 import contextlib
 import os
+import stat
+import tempfile
+
+from .messaging import die
 
 
 @contextlib.contextmanager
@@ -7,3 +11,46 @@ def patch_umask(mask):
     old = os.umask(mask)
     yield
     os.umask(old)
+
+
+def get_state_dir(*parts):
+    """
+    Return (creating if necessary) a directory private to the current user
+    for treehugger's local state. It's on tmpfs where available so nothing
+    survives a reboot, and can be moved with TREEHUGGER_STATE_DIR.
+    """
+    base = os.environ.get('TREEHUGGER_STATE_DIR')
+    if not base:
+        tmp = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        base = os.path.join(tmp, 'treehugger-{}'.format(os.getuid()))
+    path = os.path.join(base, *parts)
+    ensure_private_dir(base)
+    ensure_private_dir(path)
+    return path
+
+
+def ensure_private_dir(path):
+    try:
+        os.makedirs(path, mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        die('{} must be a directory accessible only by the current user'.format(path))
+
+
+def atomic_write(path, data, mode=0o600):
+    """
+    Write bytes to path by renaming a temporary file over it, so readers
+    never see a partial file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_path)
+        raise
@@ -0,0 +1,157 @@
+"""
+Client side rate limiting of KMS calls, so that a fleet booting at once
+spreads its requests out rather than all being throttled together.
+"""
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+
+THROTTLING_ERROR_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+}
+# Errors worth retrying that aren't throttling, as botocore's standard mode
+# retries them
+TRANSIENT_ERROR_CODES = {
+    'DependencyTimeoutException',
+    'InternalError',
+    'InternalFailure',
+    'KMSInternalException',
+    'ServiceUnavailable',
+}
+
+
+def is_throttling_error(exc):
+    try:
+        return exc.response['Error']['Code'] in THROTTLING_ERROR_CODES
+    except (AttributeError, KeyError):
+        return False
+
+
+def is_transient_error(exc):
+    """
+    Whether `exc` is a server error, connection failure or timeout, which is
+    worth retrying but, unlike throttling, says nothing about the rate.
+    """
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+    if isinstance(exc, ClientError):
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return status >= 500 or exc.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES
+    # Including connect and read timeouts
+    return isinstance(exc, (ConnectionError, HTTPClientError))
+
+
+def backoff_delay(attempt, max_backoff, base=0.1):
+    """
+    Capped exponential backoff with full jitter, for the given 1-based retry
+    attempt.
+    """
+    return random.uniform(0, min(max_backoff, base * 2 ** (attempt - 1)))
+
+
+class RateLimiter(object):
+    """
+    A token bucket allowing `rate` requests per second with bursts of up to
+    `burst`. The rate adapts to throttling: it's halved on every throttled
+    request, and recovers gradually as requests succeed.
+
+    With a `lock_file`, the bucket's state lives in that file, locked with
+    flock(), so that all processes on the host using it share one budget.
+    """
+
+    def __init__(self, rate, burst=None, lock_file=None):
+        self.max_rate = float(rate)
+        self.min_rate = min(1.0, self.max_rate)
+        self.burst = float(burst or rate)
+        self.lock_file = lock_file
+        self.requests = 0
+        self.throttles = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_backoff = 0.0
+        self._lock = threading.Lock()
+        self._state = None
+
+    @property
+    def rate(self):
+        return self._update(lambda state, now: self._current_rate(state))
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available. Returns the time slept.
+        """
+        wait = self._update(self._take)
+        if wait > 0:
+            time.sleep(wait)
+        with self._lock:
+            self.requests += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def backoff(self, attempt, max_backoff):
+        delay = backoff_delay(attempt, max_backoff)
+        time.sleep(delay)
+        with self._lock:
+            self.total_backoff += delay
+        return delay
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttles += 1
+
+        def decrease(state, now):
+            state['rate'] = max(self.min_rate, self._current_rate(state) / 2)
+
+        self._update(decrease)
+
+    def on_success(self):
+        def increase(state, now):
+            state['rate'] = min(self.max_rate, self._current_rate(state) + self.max_rate / 20)
+
+        self._update(increase)
+
+    def _take(self, state, now):
+        rate = self._current_rate(state)
+        elapsed = max(0.0, now - state['updated'])
+        tokens = min(self.burst, state['tokens'] + elapsed * rate) - 1
+        state['tokens'] = tokens
+        state['updated'] = now
+        # A negative balance reserves a token that will be refilled by then
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def _current_rate(self, state):
+        # Processes sharing a lock file may have been configured differently
+        return min(self.max_rate, state['rate'])
+
+    def _initial_state(self, now):
+        return {'tokens': self.burst, 'rate': self.max_rate, 'updated': now}
+
+    def _update(self, func):
+        with self._lock:
+            if self.lock_file is None:
+                now = time.time()
+                if self._state is None:
+                    self._state = self._initial_state(now)
+                return func(self._state, now)
+
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, 'r+') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                now = time.time()
+                try:
+                    state = json.loads(fp.read())
+                except ValueError:
+                    state = self._initial_state(now)
+                result = func(state, now)
+                fp.seek(0)
+                fp.truncate()
+                fp.write(json.dumps(state))
+                fp.flush()
+            return result
@@ -1,25 +1,82 @@
+import threading
 from urllib.parse import parse_qs, urlparse
 
-import boto3
-from botocore.exceptions import ClientError
+from . import aws, limits, metrics, trace
+from .forking import check_fork, register_after_fork
+from .messaging import debug, die
 
-from .messaging import die
+_lock = threading.Lock()
+_s3_client = None
 
-s3_client = boto3.client('s3')
+# Set from global command line arguments
+object_cache = None
+
+
+def get_s3_client():
+    global _s3_client
+    check_fork()
+    with _lock:
+        if _s3_client is None:
+            # S3 works without a region, through its global endpoint
+            _s3_client = aws.create_client('s3', require_region=False)
+        return _s3_client
+
+
+def set_s3_client(client):
+    global _s3_client
+    _s3_client = client
+
+
+def _after_fork_in_child():
+    # Clients' connection pools can't be shared between processes, and another
+    # thread may have held the lock when the process forked
+    global _lock, _s3_client
+    _lock = threading.Lock()
+    _s3_client = None
+    if object_cache is not None:
+        object_cache._after_fork_in_child()
+
+
+register_after_fork(_after_fork_in_child)
 
 
 def fetch_s3_content_or_die(url):
+    from botocore.exceptions import ClientError
+
+    check_fork()
     bucket_name, key, version = split_s3_url(url)
-    try:
-        s3_response_object = s3_client.get_object(Bucket=bucket_name, Key=key, VersionId=version)
-    except ClientError as exc:
-        die('Got "{}" when attempting to fetch key {} version {} from bucket {}'.format(
-            exc.response['Error']['Code'],
-            key,
-            version,
-            bucket_name,
-        ))
-    return s3_response_object['Body'].read()
+    if object_cache is not None:
+        cache_key = object_cache.make_key(bucket_name, key, version)
+        content = object_cache.get(cache_key)
+        metrics.increment('s3_object_cache_lookups_total', result='miss' if content is None else 'hit')
+        if content is not None:
+            return content
+    with trace.span('s3.fetch', url=url) as span, metrics.timer('s3_fetches'):
+        try:
+            s3_response_object = get_s3_client().get_object(Bucket=bucket_name, Key=key, VersionId=version)
+        except ClientError as exc:
+            die('Got "{}" when attempting to fetch key {} version {} from bucket {}'.format(
+                exc.response['Error']['Code'],
+                key,
+                version,
+                bucket_name,
+            ))
+        body = s3_response_object['Body']
+        content = limits.read_or_die(
+            iter(lambda: body.read(limits.CHUNK_SIZE), b''),
+            url,
+            s3_response_object.get('ContentLength'),
+        )
+        span.set(size=len(content))
+    metrics.increment('s3_bytes_total', len(content))
+    if object_cache is not None:
+        object_cache.set(cache_key, content)
+    return content
+
+
+def report():
+    if object_cache is not None:
+        debug('S3 object cache: {} hits, {} misses'.format(object_cache.hits, object_cache.misses))
 
 
 def split_s3_url(url):
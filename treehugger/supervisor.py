@@ -0,0 +1,126 @@
+"""
+Running a command as a child process, rather than replacing treehugger with
+it, so its environment can be reloaded without restarting the service.
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from .messaging import debug, die
+
+# Signals passed on to the child. SIGHUP is kept to trigger reloads.
+FORWARDED_SIGNALS = ('SIGINT', 'SIGTERM', 'SIGQUIT', 'SIGUSR1', 'SIGUSR2', 'SIGWINCH')
+
+# How often to check on the child and for reloads, in seconds
+POLL_INTERVAL = 0.1
+
+
+class Supervisor(object):
+    """
+    Runs `command` with the environment from `load`, calling `load` again on
+    SIGHUP or every `reload_interval` seconds. When the environment changes
+    the command is restarted, or sent `reload_signal` if that's set.
+    """
+
+    def __init__(self, command, load, reload_interval=0, reload_signal=None, stop_timeout=10.0):
+        self.command = command
+        self.load = load
+        self.reload_interval = reload_interval
+        self.reload_signal = reload_signal
+        self.stop_timeout = stop_timeout
+        self.environment = None
+        self.child = None
+        self._reload_requested = False
+
+    def run(self, environment):
+        """
+        Supervise the command until it exits, returning its exit status.
+        """
+        self.environment = environment
+        self._install_signal_handlers()
+        self._start()
+        next_reload = self._next_reload_time()
+        while True:
+            try:
+                return self.child.wait(timeout=POLL_INTERVAL)
+            except subprocess.TimeoutExpired:
+                pass
+            if self._reload_requested or (next_reload is not None and time.monotonic() >= next_reload):
+                self._reload_requested = False
+                self.reload()
+                next_reload = self._next_reload_time()
+
+    def reload(self):
+        start = time.monotonic()
+        try:
+            environment = self.load()
+        except SystemExit:
+            # die() has already said why
+            print('Reloading failed, keeping the current environment', file=sys.stderr)
+            return
+        except Exception as exc:
+            # Such as KMS errors that outlasted their retries - the command
+            # mustn't be left without its supervisor
+            print('Reloading failed, keeping the current environment: {}: {}'.format(type(exc).__name__, exc),
+                  file=sys.stderr)
+            return
+        debug('Reloaded the environment in {:.1f}ms'.format((time.monotonic() - start) * 1000))
+        if environment == self.environment:
+            return
+        self.environment = environment
+        if self.reload_signal is not None:
+            debug('Environment changed, sending {} to the command'.format(self.reload_signal.name))
+            self.child.send_signal(self.reload_signal)
+        else:
+            debug('Environment changed, restarting the command')
+            self._stop()
+            self._start()
+
+    def _next_reload_time(self):
+        if not self.reload_interval:
+            return None
+        return time.monotonic() + self.reload_interval
+
+    def _start(self):
+        env = os.environ.copy()
+        env.update(self.environment)
+        try:
+            self.child = subprocess.Popen(self.command, env=env)
+        except FileNotFoundError:
+            die('Command not found: {}'.format(self.command[0]))
+
+    def _stop(self):
+        self.child.terminate()
+        try:
+            self.child.wait(timeout=self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            self.child.kill()
+            self.child.wait()
+
+    def _install_signal_handlers(self):
+        signal.signal(signal.SIGHUP, self._on_reload_signal)
+        for name in FORWARDED_SIGNALS:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self._forward_signal)
+
+    def _on_reload_signal(self, signum, frame):
+        self._reload_requested = True
+
+    def _forward_signal(self, signum, frame):
+        if self.child is not None and self.child.poll() is None:
+            self.child.send_signal(signum)
+
+
+def exit_with_status(returncode):
+    """
+    Exit with the same status as a child process. If it was killed by a
+    signal, kill ourselves with it too so the parent sees the same.
+    """
+    if returncode < 0:
+        signum = -returncode
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        returncode = 128 + signum
+    raise SystemExit(returncode)
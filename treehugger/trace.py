@@ -0,0 +1,172 @@
+"""
+Opt-in tracing of where the time goes in a run, for slow boots. Each span is
+written as a line of JSON when it ends, like:
+
+{"name": "kms.decrypt", "id": 4, "parent_id": null, "start": 1579500000.123,
+ "duration_ms": 12.5, "pid": 123, "thread": "MainThread", "key": "MY_VAR"}
+
+Spans are written to stderr or appended to a file, never stdout, and are
+flushed straight away since `exec` replaces the process without exiting.
+When tracing is off, span() returns a shared object that does nothing.
+"""
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from .forking import register_after_fork
+from .messaging import die
+
+_output = None
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_local = threading.local()
+
+
+def configure(destination):
+    """
+    Start writing spans to `destination`, a file path or '-' for stderr, or
+    stop tracing if it's empty.
+    """
+    global _output
+    with _lock:
+        if _output not in (None, sys.stderr):
+            _output.close()
+        if not destination:
+            _output = None
+        elif destination == '-':
+            _output = sys.stderr
+        else:
+            # Line buffered, and not inherited by the command exec replaces us with
+            try:
+                _output = open(destination, 'a', buffering=1)
+            except OSError as exc:
+                _output = None
+                die('Could not open trace file {}: {}'.format(destination, exc.strerror))
+
+
+def is_enabled():
+    return _output is not None
+
+
+def span(name, **attributes):
+    """
+    Return a context manager timing the code within it as a span.
+    Attributes can be added with its set() method.
+    """
+    if _output is None:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+
+class Span(object):
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.id = next(_ids)
+        self.parent_id = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = _get_stack()
+        if stack:
+            self.parent_id = stack[-1].id
+        stack.append(self)
+        self._start = time.time()
+        self._start_monotonic = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.monotonic() - self._start_monotonic
+        _get_stack().pop()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        write(self.name, self.id, self.parent_id, self._start, duration, self.attributes)
+        return False
+
+
+class _NullSpan(object):
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def write(name, span_id, parent_id, start, duration, attributes):
+    record = {
+        'name': name,
+        'id': span_id,
+        'parent_id': parent_id,
+        'start': round(start, 6),
+        'duration_ms': round(duration * 1000, 3),
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+    }
+    record.update(attributes)
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if _output is not None:
+            _output.write(line)
+            _output.flush()
+
+
+def _get_stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def instrument_client(client):
+    """
+    Add a span for each HTTP attempt a botocore client makes, so retries
+    show up within the span of the call that made them.
+    """
+    service = client.meta.service_model.endpoint_prefix
+    client.meta.events.register('request-created.{}'.format(service), _on_request_created)
+    client.meta.events.register('needs-retry.{}'.format(service), _on_needs_retry)
+
+
+def _on_request_created(request, operation_name, **kwargs):
+    stack = _get_stack()
+    _local.attempt = (next(_ids), stack[-1].id if stack else None, time.time(), time.monotonic(), operation_name)
+
+
+def _on_needs_retry(response, attempts, caught_exception, **kwargs):
+    attempt = getattr(_local, 'attempt', None)
+    if attempt is None:
+        return None
+    _local.attempt = None
+    span_id, parent_id, start, start_monotonic, operation_name = attempt
+    attributes = {'operation': operation_name, 'attempt': attempts}
+    if caught_exception is not None:
+        attributes['error'] = type(caught_exception).__name__
+    elif response is not None:
+        attributes['status'] = response[0].status_code
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code:
+            attributes['error'] = error_code
+    write('aws.attempt', span_id, parent_id, start, time.monotonic() - start_monotonic, attributes)
+    return None
+
+
+def _after_fork_in_child():
+    global _lock
+    _lock = threading.Lock()
+
+
+register_after_fork(_after_fork_in_child)
@@ -1,25 +1,151 @@
 import errno
+import json
+import time
 
-import yaml
+from . import s3, trace
+from .concurrency import map_in_order
+from .data import DATA_KEY_KEY, VALUE_DATA_KEY_KEY
+from .messaging import debug, die
+from .s3 import fetch_s3_content_or_die, split_s3_url
 
-from .messaging import die
-from .s3 import fetch_s3_content_or_die
+INCLUDE_KEY = 'include'
 
+# Set from global command line arguments
+max_include_depth = 5
+workers = 8
+# Limits on parsing YAML, counting nodes repeatedly if they're referenced by
+# aliases, to stop "billion laughs" style documents
+max_nodes = 100000
+max_aliases = 1000
+parse_timeout = 5.0
 
-def safe_load(fp_or_text):
-    obj = yaml.safe_load(fp_or_text)
+
+def get_loader():
+    """
+    The fastest safe YAML loader available, using libyaml if PyYAML was built
+    with it.
+    """
+    import yaml
+
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def safe_load(fp_or_text, name='YAML'):
+    if hasattr(fp_or_text, 'read'):
+        fp_or_text = fp_or_text.read()
+
+    with trace.span('yaml.safe_load', source=name, size=len(fp_or_text)):
+        return _safe_load(fp_or_text, name)
+
+
+def _safe_load(text, name):
+    # JSON is valid YAML, and much faster to parse with the json module. It
+    # has no aliases, and its size is bounded by the limit on fetched data.
+    obj = load_json_or_none(text)
+    if obj is not None:
+        return obj
+
+    deadline = time.monotonic() + parse_timeout
+    loader = get_loader()(text)
+    try:
+        node = loader.get_single_node()
+        if node is None:
+            return None
+        check_limits_or_die(node, name, deadline)
+        obj = loader.construct_document(node)
+    finally:
+        loader.dispose()
+    check_deadline_or_die(name, deadline)
     return obj
 
 
+def check_limits_or_die(root, name, deadline):
+    """
+    Walk the composed node graph as construction would, following aliases,
+    and die if it exceeds the node, alias or time limits.
+    """
+    from yaml.nodes import MappingNode, SequenceNode
+
+    seen = set()
+    nodes = 0
+    aliases = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        if nodes > max_nodes:
+            die('{} has more than {} nodes, which can be changed with --yaml-max-nodes'.format(name, max_nodes))
+        if id(node) in seen:
+            aliases += 1
+            if aliases > max_aliases:
+                die('{} has more than {} aliases, which can be changed with --yaml-max-aliases'.format(
+                    name,
+                    max_aliases,
+                ))
+        else:
+            seen.add(id(node))
+        if isinstance(node, SequenceNode):
+            stack.extend(node.value)
+        elif isinstance(node, MappingNode):
+            for key_node, value_node in node.value:
+                stack.append(key_node)
+                stack.append(value_node)
+        if nodes % 1000 == 0:
+            check_deadline_or_die(name, deadline)
+    check_deadline_or_die(name, deadline)
+
+
+def check_deadline_or_die(name, deadline):
+    if time.monotonic() > deadline:
+        die('{} took more than {}s to parse, which can be changed with --yaml-parse-timeout'.format(
+            name,
+            parse_timeout,
+        ))
+
+
+def load_json_or_none(text):
+    if isinstance(text, bytes):
+        if text.lstrip()[:1] not in (b'{', b'['):
+            return None
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    elif text.lstrip()[:1] not in ('{', '['):
+        return None
+
+    try:
+        return json.loads(text)
+    except ValueError:
+        # e.g. YAML flow style that isn't strict JSON
+        return None
+
+
+def load_s3_or_die(url):
+    """
+    Fetch and parse the YAML at an S3 URL, using the parsed form from the S3
+    object cache if it's enabled.
+    """
+    object_cache = s3.object_cache
+    if object_cache is None:
+        return safe_load(fetch_s3_content_or_die(url), name=url)
+    cache_key = object_cache.make_key(*split_s3_url(url))
+    data = object_cache.get_parsed(cache_key)
+    if data is None:
+        data = safe_load(fetch_s3_content_or_die(url), name=url)
+        object_cache.set_parsed(cache_key, data)
+    return data
+
+
 def load_file_or_die(filename):
     if filename.startswith('s3://'):
-        return safe_load(fetch_s3_content_or_die(filename))
+        return load_s3_or_die(filename)
     try:
         with open(filename, 'r') as fp:
             return safe_load(fp)
     except IOError as exc:
         if exc.errno == errno.ENOENT:
-            die('File does not exist!')
+            die('File does not exist: {}'.format(filename))
         raise
 
 
@@ -29,24 +155,100 @@ def save_file(filename, data):
 
 
 def save_fp(fp, data):
-    yaml.safe_dump(
+    import yaml
+
+    # Not libyaml's CSafeDumper, which escapes characters such as emoji even
+    # with allow_unicode, changing users' files
+    yaml.dump(
         data,
         fp,
+        Dumper=yaml.SafeDumper,
         allow_unicode=True,
         width=10000,
     )
 
 
-def include_remote_yaml_data_or_die(data):
+def include_remote_yaml_data_or_die(data, on_document=None):
     """
-    Check for "include" key with URL(s), if found fetch & include the yaml
+    Check for "include" key with URL(s), if found fetch & include the yaml.
+
+    The value may be one URL or a list of them, and included documents may
+    include others in turn. All the includes at each level of nesting are
+    fetched concurrently. Keys from included documents override those of the
+    document including them, and later includes in a list override earlier
+    ones.
+
+    If there are includes, `on_document` is called with `data` and then with
+    each included document as soon as it's loaded, from any thread.
     """
-    include_key = 'include'
-    if include_key in data:
-        url = data.pop(include_key)
-        if not isinstance(url, str):
-            die("'include' value should be a string")
-        yaml_str = fetch_s3_content_or_die(url)
-        yaml_data = yaml.safe_load(yaml_str)
-        data.update(yaml_data)
+    documents = {}
+    pending = get_include_urls(data)
+    if pending and on_document is not None:
+        on_document(data)
+
+    def load(url):
+        document = load_include_or_die(url)
+        if on_document is not None:
+            on_document(document)
+        return document
+
+    depth = 0
+    while pending:
+        depth += 1
+        if depth > max_include_depth:
+            die('Includes are nested more than {} deep'.format(max_include_depth))
+        to_fetch = []
+        for url in pending:
+            if url not in documents and url not in to_fetch:
+                to_fetch.append(url)
+        fetched = map_in_order(load, to_fetch, workers)
+        documents.update(zip(to_fetch, fetched))
+        pending = [nested_url for url in to_fetch for nested_url in get_include_urls(documents[url])]
+    return _merge_includes(data, documents, ())
+
+
+def get_include_urls(data):
+    urls = data.get(INCLUDE_KEY, [])
+    if isinstance(urls, str):
+        urls = [urls]
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        die("'include' value should be a string or a list of strings")
+    return urls
+
+
+def load_include_or_die(url):
+    from yaml.error import YAMLError
+
+    start = time.monotonic()
+    try:
+        data = load_s3_or_die(url)
+    except YAMLError:
+        die('Did not find valid YAML in {}'.format(url))
+    if not isinstance(data, dict):
+        die('{} is not a YAML dictionary'.format(url))
+    debug('Included {} in {:.1f}ms'.format(url, (time.monotonic() - start) * 1000))
     return data
+
+
+def _merge_includes(data, documents, ancestors):
+    merged = {key: value for key, value in data.items() if key != INCLUDE_KEY}
+    if documents:
+        _pin_data_key(merged)
+    for url in get_include_urls(data):
+        if url in ancestors:
+            die('Include cycle: {}'.format(' -> '.join(ancestors + (url,))))
+        merged.update(_merge_includes(documents[url], documents, ancestors + (url,)))
+    return merged
+
+
+def _pin_data_key(data):
+    """
+    Copy a document's envelope data key onto each of its envelope encrypted
+    values, since only one document's top level key survives merging.
+    """
+    wrapped_data_key = data.get(DATA_KEY_KEY)
+    if not isinstance(wrapped_data_key, str):
+        return
+    for key, value in data.items():
+        if isinstance(value, dict) and 'envelope_encrypted' in value and VALUE_DATA_KEY_KEY not in value:
+            data[key] = dict(value, **{VALUE_DATA_KEY_KEY: wrapped_data_key})